@@ -9,7 +9,10 @@ from __future__ import print_function
 
 import xml.etree.ElementTree as ET
 import os
+import glob
+import hashlib
 import pickle
+import multiprocessing
 import numpy as np
 
 from libs.label_name_dict.label_dict import NAME_LABEL_MAP
@@ -68,6 +71,79 @@ def parse_rec(filename):
   return objects
 
 
+ANNO_CACHE_VERSION = 'v1'
+
+
+def _anno_cache_key(annopath, imagenames):
+  """ md5 of the names and contents of the annotation files of imagenames """
+  md5 = hashlib.md5(ANNO_CACHE_VERSION.encode('utf-8'))
+  for imagename in imagenames:
+    md5.update(imagename.encode('utf-8'))
+    with open(os.path.join(annopath, imagename + '.xml'), 'rb') as f:
+      md5.update(f.read())
+  return md5.hexdigest()
+
+
+def build_annotation_array(annopath, imagenames):
+  """
+  parse the xml files once into a structured array, one row per object:
+  image name, class name, difficult flag and the box [xmin, ymin, xmax, ymax].
+  Rows are grouped by image in the order of imagenames.
+  """
+  image_col, name_col, difficult_col, bboxes = [], [], [], []
+  for imagename in imagenames:
+    for obj in parse_rec(os.path.join(annopath, imagename + '.xml')):
+      image_col.append(imagename)
+      name_col.append(obj['name'])
+      difficult_col.append(obj['difficult'])
+      bboxes.append(obj['bbox'])
+
+  num_objs = len(image_col)
+  max_image_len = max([len(x) for x in image_col] + [1])
+  max_name_len = max([len(x) for x in name_col] + [1])
+  annos = np.zeros(num_objs, dtype=[('image', 'U%d' % max_image_len),
+                                    ('name', 'U%d' % max_name_len),
+                                    ('difficult', np.bool_),
+                                    ('bbox', np.float64, (4,))])
+  if num_objs > 0:
+    annos['image'] = image_col
+    annos['name'] = name_col
+    annos['difficult'] = difficult_col
+    annos['bbox'] = bboxes
+  return annos
+
+
+def annotation_cache_file(annopath, imagenames, cache_dir=None):
+  """
+  path of the .npy file caching build_annotation_array(annopath, imagenames), built if missing.
+  The file is keyed by the content hash of the xml files, stale cache files of the same
+  directory are removed when a new one is written.
+  """
+  if cache_dir is None:
+    cache_dir = os.path.join(cfgs.ROOT_PATH, 'output/anno_cache')
+  mkdir(cache_dir)
+
+  prefix = 'anno_' + hashlib.md5(os.path.abspath(annopath).encode('utf-8')).hexdigest()[:8]
+  cache_file = os.path.join(cache_dir, '{}_{}.npy'.format(prefix, _anno_cache_key(annopath, imagenames)))
+  if os.path.exists(cache_file):
+    return cache_file
+
+  annos = build_annotation_array(annopath, imagenames)
+  for stale_file in glob.glob(os.path.join(cache_dir, prefix + '_*.npy')):
+    os.remove(stale_file)
+  tmp_file = cache_file + '.tmp.npy'
+  np.save(tmp_file, annos)
+  os.rename(tmp_file, cache_file)
+  return cache_file
+
+
+def load_annotation_cache(annopath, imagenames, cache_dir=None):
+  """
+  annotations of imagenames, memory mapped from the cache file of annotation_cache_file
+  """
+  return np.load(annotation_cache_file(annopath, imagenames, cache_dir), mmap_mode='r')
+
+
 def voc_ap(rec, prec, use_07_metric=False):
   """ ap = voc_ap(rec, prec, [use_07_metric])
   Compute VOC AP given precision and recall.
@@ -103,7 +179,7 @@ def voc_ap(rec, prec, use_07_metric=False):
 
 
 def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
-                 use_07_metric=False, use_diff=False):
+                 use_07_metric=False, use_diff=False, annos=None):
   '''
 
   :param detpath:
@@ -113,6 +189,7 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
   :param ovthresh:
   :param use_07_metric:
   :param use_diff:
+  :param annos: annotations from load_annotation_cache, loaded here if None
   :return:
   '''
   # 1. parse xml to get gtboxes
@@ -120,30 +197,28 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
   # read list of images
   imagenames = test_imgid_list
 
-  recs = {}
-  for i, imagename in enumerate(imagenames):
-    recs[imagename] = parse_rec(os.path.join(annopath, imagename+'.xml'))
-    # if i % 100 == 0:
-    #   print('Reading annotation for {:d}/{:d}'.format(
-    #     i + 1, len(imagenames)))
+  if annos is None:
+    annos = load_annotation_cache(annopath, imagenames)
 
   # 2. get gtboxes for this class.
+  cls_annos = annos[annos['name'] == cls_name]
   class_recs = {}
-  num_pos = 0
-  # if cls_name == 'person':
-  #   print ("aaa")
   for imagename in imagenames:
-    R = [obj for obj in recs[imagename] if obj['name'] == cls_name]
-    bbox = np.array([x['bbox'] for x in R])
-    if use_diff:
-      difficult = np.array([False for x in R]).astype(np.bool)
-    else:
-      difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-    det = [False] * len(R)
-    num_pos = num_pos + sum(~difficult)  # ignored the diffcult boxes
-    class_recs[imagename] = {'bbox': bbox,
-                             'difficult': difficult,
-                             'det': det} # det means that gtboxes has already been detected
+    class_recs[imagename] = {'bbox': np.zeros([0, 4]),
+                             'difficult': np.zeros([0], np.bool_),
+                             'det': []}
+  if cls_annos.shape[0] > 0:
+    cls_images = cls_annos['image']
+    starts = np.flatnonzero(np.concatenate([[True], cls_images[1:] != cls_images[:-1]]))
+    ends = np.append(starts[1:], cls_images.shape[0])
+    for start, end in zip(starts, ends):
+      difficult = np.array(cls_annos['difficult'][start:end])
+      if use_diff:
+        difficult[:] = False
+      class_recs[cls_images[start]] = {'bbox': np.array(cls_annos['bbox'][start:end]),
+                                       'difficult': difficult,
+                                       'det': [False] * (end - start)}  # det means that gtboxes has already been detected
+  num_pos = sum([np.sum(~R['difficult']) for R in class_recs.values()])  # ignored the diffcult boxes
 
   # 3. read the detection file
   detfile = os.path.join(detpath, "det_"+cls_name+".txt")
@@ -216,19 +291,38 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
   return rec, prec, ap
 
 
-def do_python_eval(test_imgid_list, test_annotation_path):
+def _eval_class(job):
+  """ voc_eval of one class, run in the pool workers. The memory mapped cache is shared between them """
+  cls, detpath, annopath, test_imgid_list, cache_file = job
+  return voc_eval(detpath=detpath,
+                  test_imgid_list=test_imgid_list,
+                  cls_name=cls,
+                  annopath=annopath,
+                  annos=np.load(cache_file, mmap_mode='r'))
+
+
+def do_python_eval(test_imgid_list, test_annotation_path, workers=1):
   AP_list = []
   # import matplotlib.pyplot as plt
   # import matplotlib.colors as colors
   # color_list = colors.cnames.keys()[::6]
 
-  for cls, index in NAME_LABEL_MAP.items():
-    if cls == 'back_ground':
-      continue
-    recall, precision, AP = voc_eval(detpath=os.path.join(cfgs.EVALUATE_DIR, cfgs.VERSION),
-                                     test_imgid_list=test_imgid_list,
-                                     cls_name=cls,
-                                     annopath=test_annotation_path)
+  # parsed once for all the classes
+  cache_file = annotation_cache_file(test_annotation_path, test_imgid_list)
+
+  classes = [cls for cls in NAME_LABEL_MAP.keys() if cls != 'back_ground']
+  jobs = [(cls, os.path.join(cfgs.EVALUATE_DIR, cfgs.VERSION), test_annotation_path, test_imgid_list, cache_file)
+          for cls in classes]
+  if workers > 1:
+    # map keeps the order of the classes
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    results = pool.map(_eval_class, jobs)
+    pool.close()
+    pool.join()
+  else:
+    results = [_eval_class(job) for job in jobs]
+
+  for cls, (recall, precision, AP) in zip(classes, results):
     AP_list += [AP]
     print("cls : {}|| Recall: {} || Precison: {}|| AP: {}".format(cls, recall[-1], precision[-1], AP))
     # plt.plot(recall, precision, label=cls, color=color_list[index])
@@ -239,20 +333,21 @@ def do_python_eval(test_imgid_list, test_annotation_path):
   print("mAP is : {}".format(np.mean(AP_list)))
 
 
-def voc_evaluate_detections(all_boxes, test_annotation_path, test_imgid_list):
+def voc_evaluate_detections(all_boxes, test_annotation_path, test_imgid_list, workers=1):
   '''
 
   :param all_boxes: is a list. each item reprensent the detections of a img.
 
   The detections is a array. shape is [-1, 6]. [category, score, xmin, ymin, xmax, ymax]
   Note that: if none detections in this img. that the detetions is : []
+  :param workers: number of processes evaluating the classes in parallel
   :return:
   '''
   test_imgid_list = [item.split('.')[0] for item in test_imgid_list]
 
   write_voc_results_file(all_boxes, test_imgid_list=test_imgid_list,
                          det_save_dir=os.path.join(cfgs.EVALUATE_DIR, cfgs.VERSION))
-  do_python_eval(test_imgid_list, test_annotation_path=test_annotation_path)
+  do_python_eval(test_imgid_list, test_annotation_path=test_annotation_path, workers=workers)
 
 
 
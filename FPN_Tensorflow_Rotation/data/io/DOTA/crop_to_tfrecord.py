@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import time
+import random
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import tensorflow as tf
+import cv2
+import sys
+sys.path.append('../../..')
+
+from help_utils.tools import mkdir
+from libs.label_name_dict.label_dict import NAME_LABEL_MAP
+from data.io.convert_data_to_tfrecord import build_example, shard_path, index_path, write_shard_index
+from data.io.DOTA.data_crop import class_list, format_label, iter_crops
+
+
+def write_shard(job):
+    """
+    crop the source images of one shard in memory and write the crops straight into its tfrecord,
+    the same examples data_crop.py + convert_data_to_tfrecord.py produce. Crops of a scene are
+    spread by a shuffle buffer so that neighbouring examples do not all come from the same scene.
+    :return: dict of shard path, example count and per-stage costs
+    """
+    path, img_names, raw_images_dir, raw_label_dir, img_w, img_h, stride_w, stride_h, shuffle_buffer, seed, \
+        img_format, gt_forms = job
+    rng = random.Random(seed)
+    # class_list index -> label of the tfrecord
+    label_map = np.array([NAME_LABEL_MAP.get(name, -1) for name in class_list], np.int32)
+    stats = {'path': path, 'examples': 0, 'images': 0, 'read': 0., 'crop': 0., 'write': 0.}
+
+    writer = tf.python_io.TFRecordWriter(path=path)
+    buffer = []
+    for img_name in img_names:
+        file_idx = os.path.splitext(img_name)[0]
+        label_path = os.path.join(raw_label_dir, file_idx + '.txt')
+        if not os.path.exists(label_path):
+            continue
+
+        start = time.time()
+        img_data = cv2.imread(os.path.join(raw_images_dir, img_name))
+        with open(label_path, 'r') as f:
+            boxes = format_label(f.readlines())
+        stats['read'] += time.time() - start
+        stats['images'] += 1
+
+        start = time.time()
+        write_cost = 0.
+        for top_left_row, top_left_col, subImage, box in iter_crops(img_data, boxes, img_w, img_h, stride_w, stride_h):
+            gtbox_label = box.astype(np.int32)
+            gtbox_label[:, 8] = label_map[gtbox_label[:, 8]]
+            assert np.all(gtbox_label[:, 8] >= 0), 'label of {} is not in NAME_LABEL_MAP'.format(img_name)
+
+            example = build_example("%s_%04d_%04d.png" % (file_idx, top_left_row, top_left_col),
+                                    subImage[:, :, ::-1], gtbox_label, img_format, gt_forms)
+            buffer.append(example.SerializeToString())
+
+            if len(buffer) >= shuffle_buffer:
+                write_start = time.time()
+                writer.write(buffer.pop(rng.randrange(len(buffer))))
+                write_cost += time.time() - write_start
+                stats['examples'] += 1
+        stats['crop'] += time.time() - start - write_cost
+        stats['write'] += write_cost
+
+    start = time.time()
+    rng.shuffle(buffer)
+    for example in buffer:
+        writer.write(example)
+    stats['examples'] += len(buffer)
+    writer.close()
+    stats['write'] += time.time() - start
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('crop DOTA scenes straight into sharded tfrecords.')
+    parser.add_argument('--raw_data', dest='raw_data',
+                        help='dir with images/ and labelTxt/',
+                        default='/data/yangxue/dataset/DOTA/train/', type=str)
+    parser.add_argument('--save_dir', dest='save_dir', help='tfrecord dir', default='../../tfrecord/', type=str)
+    parser.add_argument('--dataset', dest='dataset', help='dataset name, prefix of the shards', default='DOTA', type=str)
+    parser.add_argument('--save_name', dest='save_name', help='train or test', default='train', type=str)
+    parser.add_argument('--num_shards', dest='num_shards', help='number of tfrecord files', default=16, type=int)
+    parser.add_argument('--workers', dest='workers', help='number of processes', default=8, type=int)
+    parser.add_argument('--shuffle_buffer', dest='shuffle_buffer',
+                        help='examples held per shard to shuffle the crops', default=256, type=int)
+    parser.add_argument('--img_h', dest='img_h', help='window height', default=800, type=int)
+    parser.add_argument('--img_w', dest='img_w', help='window width', default=800, type=int)
+    parser.add_argument('--stride_h', dest='stride_h', help='vertical stride', default=600, type=int)
+    parser.add_argument('--stride_w', dest='stride_w', help='horizontal stride', default=600, type=int)
+    parser.add_argument('--image_ext', dest='image_ext', help='source image format', default='.png', type=str)
+    parser.add_argument('--img_format', dest='img_format',
+                        help='how crops are stored: raw, png or jpeg', default='raw', type=str)
+    parser.add_argument('--gt_forms', dest='gt_forms', help='also store the rotated and horizontal gtboxes',
+                        action='store_true')
+    parser.add_argument('--seed', dest='seed', help='random seed', default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    raw_images_dir = os.path.join(args.raw_data, 'images')
+    raw_label_dir = os.path.join(args.raw_data, 'labelTxt')
+    mkdir(args.save_dir)
+
+    images = sorted([i for i in os.listdir(raw_images_dir) if i.endswith(args.image_ext)])
+    random.Random(args.seed).shuffle(images)
+    print('find image', len(images))
+
+    jobs = [(shard_path(args.save_dir, args.dataset, args.save_name, shard_id, args.num_shards),
+             images[shard_id::args.num_shards], raw_images_dir, raw_label_dir,
+             args.img_w, args.img_h, args.stride_w, args.stride_h, max(args.shuffle_buffer, 1), args.seed + shard_id,
+             args.img_format, args.gt_forms)
+            for shard_id in range(args.num_shards)]
+
+    total = {'examples': 0, 'images': 0, 'read': 0., 'crop': 0., 'write': 0.}
+    shards = []
+    start = time.time()
+    pool = Pool(max(args.workers, 1))
+    for idx, stats in enumerate(pool.imap_unordered(write_shard, jobs)):
+        for k in total:
+            total[k] += stats[k]
+        shards.append((stats['path'], stats['examples']))
+        print('%d/%d shards, %s: %d images, %d examples' % (
+            idx + 1, len(jobs), os.path.basename(stats['path']), stats['images'], stats['examples']))
+    pool.close()
+    pool.join()
+    write_shard_index(index_path(args.save_dir, args.dataset, args.save_name), sorted(shards))
+
+    cost = time.time() - start
+    print('%d images, %d examples in %.1fs (%.2f images/s, %.2f examples/s)' % (
+        total['images'], total['examples'], cost, total['images'] / cost, total['examples'] / cost))
+    print('read: %.1fs, crop: %.1fs, write: %.1fs (summed over %d workers)' % (
+        total['read'], total['crop'], total['write'], args.workers))
@@ -1,7 +1,14 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
 import os
+import time
+import argparse
+from multiprocessing import Pool
 from xml.dom.minidom import Document
 import numpy as np
-import copy
 import cv2
 import sys
 sys.path.append('../../..')
@@ -145,79 +152,156 @@ def format_label(txt_list):
     return np.array(format_data)
 
 
-def clip_image(file_idx, image, boxes_all, width, height, stride_w, stride_h):
-    if len(boxes_all) > 0:
-        shape = image.shape
-        for start_h in range(0, shape[0], stride_h):
-            for start_w in range(0, shape[1], stride_w):
-                boxes = copy.deepcopy(boxes_all)
-                box = np.zeros_like(boxes_all)
-                start_h_new = start_h
-                start_w_new = start_w
-                if start_h + height > shape[0]:
-                    start_h_new = shape[0] - height
-                if start_w + width > shape[1]:
-                    start_w_new = shape[1] - width
-                top_left_row = max(start_h_new, 0)
-                top_left_col = max(start_w_new, 0)
-                bottom_right_row = min(start_h + height, shape[0])
-                bottom_right_col = min(start_w + width, shape[1])
-
-                subImage = image[top_left_row:bottom_right_row, top_left_col: bottom_right_col]
-
-                box[:, 0] = boxes[:, 0] - top_left_col
-                box[:, 2] = boxes[:, 2] - top_left_col
-                box[:, 4] = boxes[:, 4] - top_left_col
-                box[:, 6] = boxes[:, 6] - top_left_col
-
-                box[:, 1] = boxes[:, 1] - top_left_row
-                box[:, 3] = boxes[:, 3] - top_left_row
-                box[:, 5] = boxes[:, 5] - top_left_row
-                box[:, 7] = boxes[:, 7] - top_left_row
-                box[:, 8] = boxes[:, 8]
-                center_y = 0.25 * (box[:, 1] + box[:, 3] + box[:, 5] + box[:, 7])
-                center_x = 0.25 * (box[:, 0] + box[:, 2] + box[:, 4] + box[:, 6])
-
-                cond1 = np.intersect1d(np.where(center_y[:] >= 0)[0], np.where(center_x[:] >= 0)[0])
-                cond2 = np.intersect1d(np.where(center_y[:] <= (bottom_right_row - top_left_row))[0],
-                                       np.where(center_x[:] <= (bottom_right_col - top_left_col))[0])
-                idx = np.intersect1d(cond1, cond2)
-                if len(idx) > 0 and (subImage.shape[0] > 5 and subImage.shape[1] > 5):
-                    mkdir(os.path.join(save_dir, 'images'))
-                    img = os.path.join(save_dir, 'images',
-                                       "%s_%04d_%04d.png" % (file_idx, top_left_row, top_left_col))
-                    cv2.imwrite(img, subImage)
-
-                    mkdir(os.path.join(save_dir, 'labeltxt'))
-                    xml = os.path.join(save_dir, 'labeltxt',
-                                       "%s_%04d_%04d.xml" % (file_idx, top_left_row, top_left_col))
-                    save_to_xml(xml, subImage.shape[0], subImage.shape[1], box[idx, :], class_list)
-
-
-print('class_list', len(class_list))
-raw_data = '/data/yangxue/dataset/DOTA/test/'
-raw_images_dir = os.path.join(raw_data, 'images')
-raw_label_dir = os.path.join(raw_data, 'labelTxt')
-
-save_dir = '/data/yangxue/dataset/DOTA/DOTA1.0/test-800/'
-
-images = [i for i in os.listdir(raw_images_dir) if 'png' in i]
-labels = [i for i in os.listdir(raw_label_dir) if 'txt' in i]
-
-print('find image', len(images))
-print('find label', len(labels))
-
-min_length = 1e10
-max_length = 1
-
-img_h, img_w, stride_h, stride_w = 800, 800, 600, 600
-
-for idx, img in enumerate(images):
-    print(idx, 'read image', img)
-    if not os.path.exists(os.path.join(raw_label_dir, img.replace('png', 'txt'))):
-        continue
-    img_data = cv2.imread(os.path.join(raw_images_dir, img))
-
-    txt_data = open(os.path.join(raw_label_dir, img.replace('png', 'txt')), 'r').readlines()
-    box = format_label(txt_data)
-    clip_image(img.strip('.png'), img_data, box, img_w, img_h, stride_w, stride_h)
+def crop_windows(img_h, img_w, height, width, stride_h, stride_w):
+    """
+    sliding windows over an image, the last window of a row/column is shifted back
+    to end at the image border, repeated windows are dropped
+    :return: [W, 4] int array of (top_left_row, top_left_col, bottom_right_row, bottom_right_col)
+    """
+    rows = []
+    for start_h in range(0, img_h, stride_h):
+        top_left_row = max(start_h if start_h + height <= img_h else img_h - height, 0)
+        rows.append((top_left_row, min(start_h + height, img_h)))
+    cols = []
+    for start_w in range(0, img_w, stride_w):
+        top_left_col = max(start_w if start_w + width <= img_w else img_w - width, 0)
+        cols.append((top_left_col, min(start_w + width, img_w)))
+
+    windows = []
+    for top_left_row, bottom_right_row in rows:
+        for top_left_col, bottom_right_col in cols:
+            window = (top_left_row, top_left_col, bottom_right_row, bottom_right_col)
+            if window not in windows:
+                windows.append(window)
+    return np.array(windows, np.int64).reshape([-1, 4])
+
+
+def assign_boxes(boxes, windows):
+    """
+    a box goes to every window containing its center, computed for all windows at once
+    :param boxes: [N, 9], x0, y0, ..., x3, y3, label
+    :param windows: [W, 4], from crop_windows
+    :return: [W, N] bool
+    """
+    center_x = 0.25 * (boxes[:, 0] + boxes[:, 2] + boxes[:, 4] + boxes[:, 6])
+    center_y = 0.25 * (boxes[:, 1] + boxes[:, 3] + boxes[:, 5] + boxes[:, 7])
+    return np.logical_and.reduce([center_x[None, :] >= windows[:, 1:2], center_x[None, :] <= windows[:, 3:4],
+                                  center_y[None, :] >= windows[:, 0:1], center_y[None, :] <= windows[:, 2:3]])
+
+
+def iter_crops(image, boxes_all, width, height, stride_w, stride_h):
+    """
+    crops of image holding at least one box center
+    :return: generator of (top_left_row, top_left_col, crop view, boxes shifted into the crop)
+    """
+    if len(boxes_all) == 0:
+        return
+
+    windows = crop_windows(image.shape[0], image.shape[1], height, width, stride_h, stride_w)
+    inside = assign_boxes(boxes_all, windows)
+    offsets = np.zeros([windows.shape[0], boxes_all.shape[1]])
+    offsets[:, 0:8:2] = windows[:, 1:2]
+    offsets[:, 1:8:2] = windows[:, 0:1]
+
+    for (top_left_row, top_left_col, bottom_right_row, bottom_right_col), idx, offset in zip(windows, inside, offsets):
+        if not idx.any() or bottom_right_row - top_left_row <= 5 or bottom_right_col - top_left_col <= 5:
+            continue
+        subImage = image[top_left_row:bottom_right_row, top_left_col: bottom_right_col]
+        yield top_left_row, top_left_col, subImage, boxes_all[idx] - offset
+
+
+def clip_image(file_idx, image, boxes_all, width, height, stride_w, stride_h, save_dir):
+    """
+    write the crops holding at least one box center, with their boxes, to save_dir/images and save_dir/labeltxt
+    :return: cost of cropping and of writing, number of crops
+    """
+    write_cost, num_crops = 0., 0
+    start = time.time()
+    for top_left_row, top_left_col, subImage, box in iter_crops(image, boxes_all, width, height, stride_w, stride_h):
+        write_start = time.time()
+        img = os.path.join(save_dir, 'images',
+                           "%s_%04d_%04d.png" % (file_idx, top_left_row, top_left_col))
+        cv2.imwrite(img, subImage)
+
+        xml = os.path.join(save_dir, 'labeltxt',
+                           "%s_%04d_%04d.xml" % (file_idx, top_left_row, top_left_col))
+        save_to_xml(xml, subImage.shape[0], subImage.shape[1], box, class_list)
+        write_cost += time.time() - write_start
+        num_crops += 1
+    return time.time() - start - write_cost, write_cost, num_crops
+
+
+def crop_one_image(job):
+    """
+    read, crop and write one source image, runs in the pool workers
+    :return: dict of per-stage costs and counts
+    """
+    img_name, raw_images_dir, raw_label_dir, save_dir, img_w, img_h, stride_w, stride_h = job
+    file_idx = os.path.splitext(img_name)[0]
+    stats = {'read': 0., 'crop': 0., 'write': 0., 'crops': 0, 'images': 0}
+    label_path = os.path.join(raw_label_dir, file_idx + '.txt')
+    if not os.path.exists(label_path):
+        return stats
+
+    start = time.time()
+    img_data = cv2.imread(os.path.join(raw_images_dir, img_name))
+    with open(label_path, 'r') as f:
+        box = format_label(f.readlines())
+    stats['read'] = time.time() - start
+
+    stats['crop'], stats['write'], stats['crops'] = clip_image(file_idx, img_data, box, img_w, img_h,
+                                                               stride_w, stride_h, save_dir)
+    stats['images'] = 1
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('crop DOTA images and labels into sliding windows.')
+    parser.add_argument('--raw_data', dest='raw_data',
+                        help='dir with images/ and labelTxt/',
+                        default='/data/yangxue/dataset/DOTA/test/', type=str)
+    parser.add_argument('--save_dir', dest='save_dir',
+                        help='output dir, crops go to images/ and labeltxt/',
+                        default='/data/yangxue/dataset/DOTA/DOTA1.0/test-800/', type=str)
+    parser.add_argument('--img_h', dest='img_h', help='window height', default=800, type=int)
+    parser.add_argument('--img_w', dest='img_w', help='window width', default=800, type=int)
+    parser.add_argument('--stride_h', dest='stride_h', help='vertical stride', default=600, type=int)
+    parser.add_argument('--stride_w', dest='stride_w', help='horizontal stride', default=600, type=int)
+    parser.add_argument('--image_ext', dest='image_ext', help='source image format', default='.png', type=str)
+    parser.add_argument('--workers', dest='workers', help='number of processes', default=8, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print('class_list', len(class_list))
+    raw_images_dir = os.path.join(args.raw_data, 'images')
+    raw_label_dir = os.path.join(args.raw_data, 'labelTxt')
+
+    images = [i for i in os.listdir(raw_images_dir) if i.endswith(args.image_ext)]
+    labels = [i for i in os.listdir(raw_label_dir) if 'txt' in i]
+
+    print('find image', len(images))
+    print('find label', len(labels))
+
+    mkdir(os.path.join(args.save_dir, 'images'))
+    mkdir(os.path.join(args.save_dir, 'labeltxt'))
+
+    jobs = [(img, raw_images_dir, raw_label_dir, args.save_dir, args.img_w, args.img_h, args.stride_w, args.stride_h)
+            for img in images]
+    total = {'read': 0., 'crop': 0., 'write': 0., 'crops': 0, 'images': 0}
+    start = time.time()
+    pool = Pool(max(args.workers, 1))
+    for idx, stats in enumerate(pool.imap_unordered(crop_one_image, jobs)):
+        for k in total:
+            total[k] += stats[k]
+        if (idx + 1) % 50 == 0 or idx + 1 == len(jobs):
+            cost = time.time() - start
+            print('%d/%d images, %d crops, %.2f images/s, %.2f crops/s' % (
+                idx + 1, len(jobs), total['crops'], (idx + 1) / cost, total['crops'] / cost))
+    pool.close()
+    pool.join()
+
+    # stage costs are summed over the workers
+    print('read: %.1fs, crop: %.1fs, write: %.1fs (summed over %d workers), wall: %.1fs' % (
+        total['read'], total['crop'], total['write'], args.workers, time.time() - start))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import sys
+sys.path.append('../../')
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from data.io import image_preprocess_multi_gpu as image_preprocess
+
+
+def augment(img, gtboxes_and_label, use_py_func):
+    # every image is rotated, not only the random share of training
+    img = image_preprocess.random_rgb2gray(img, gtboxes_and_label, use_py_func=use_py_func)
+    img, gtboxes_and_label = image_preprocess.rotate_img(img, gtboxes_and_label, use_py_func=use_py_func)
+    return img, gtboxes_and_label
+
+
+def benchmark(use_py_func, img_h, img_w, num_boxes, num_parallel_calls, steps, warmup):
+    """
+    :return: images/s of grayscale + rotation with num_parallel_calls concurrent map calls
+    """
+    tf.reset_default_graph()
+    rng = np.random.RandomState(0)
+    img = rng.uniform(0, 255, size=(img_h, img_w, 3)).astype(np.float32)
+    gtboxes_and_label = np.concatenate([rng.randint(0, min(img_h, img_w), size=(num_boxes, 8)),
+                                        rng.randint(1, 16, size=(num_boxes, 1))], axis=1).astype(np.int32)
+
+    dataset = tf.data.Dataset.from_tensors((img, gtboxes_and_label)).repeat()
+    dataset = dataset.map(lambda img, gtboxes_and_label: augment(img, gtboxes_and_label, use_py_func),
+                          num_parallel_calls=num_parallel_calls)
+    dataset = dataset.prefetch(num_parallel_calls)
+    batch = dataset.make_one_shot_iterator().get_next()
+
+    with tf.Session() as sess:
+        for _ in range(warmup):
+            sess.run(batch)
+        start = time.time()
+        for _ in range(steps):
+            sess.run(batch)
+        cost = time.time() - start
+    return steps / cost
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('images/s of the grayscale and rotation augmentation, py_func vs in graph.')
+    parser.add_argument('--img_h', dest='img_h', help='image height', default=800, type=int)
+    parser.add_argument('--img_w', dest='img_w', help='image width', default=800, type=int)
+    parser.add_argument('--num_boxes', dest='num_boxes', help='boxes per image', default=100, type=int)
+    parser.add_argument('--num_parallel_calls', dest='num_parallel_calls', help='concurrent map calls',
+                        default=16, type=int)
+    parser.add_argument('--steps', dest='steps', help='timed images', default=200, type=int)
+    parser.add_argument('--warmup', dest='warmup', help='images before timing', default=20, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    for use_py_func in [True, False]:
+        img_per_sec = benchmark(use_py_func, args.img_h, args.img_w, args.num_boxes,
+                                args.num_parallel_calls, args.steps, args.warmup)
+        print('%-8s %dx%d, %d parallel calls: %.2f images/s' % ('py_func' if use_py_func else 'in graph',
+                                                                 args.img_w, args.img_h, args.num_parallel_calls,
+                                                                 img_per_sec))
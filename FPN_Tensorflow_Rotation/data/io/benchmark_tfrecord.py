@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+import sys
+sys.path.append('../../')
+import os
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+import cv2
+
+from data.io.convert_data_to_tfrecord import build_example
+from data.io.read_tfrecord_multi_gpu import decode_img
+
+
+def load_images(img_dir, image_ext, num_imgs, img_h, img_w):
+    """
+    crops of the first num_imgs images of img_dir, or smooth synthetic images when img_dir is empty,
+    so that png/jpeg see content that compresses like aerial scenes rather than noise
+    :return: list of [img_h, img_w, 3] uint8 RGB
+    """
+    imgs = []
+    img_paths = sorted(glob.glob(os.path.join(img_dir, '*' + image_ext)))[:num_imgs] if img_dir else []
+    for img_path in img_paths:
+        img = cv2.imread(img_path)
+        if img is None or img.shape[0] < img_h or img.shape[1] < img_w:
+            continue
+        imgs.append(np.ascontiguousarray(img[:img_h, :img_w, ::-1]))
+
+    rng = np.random.RandomState(0)
+    while len(imgs) < num_imgs:
+        small = rng.randint(0, 256, size=(img_h // 32, img_w // 32, 3)).astype(np.uint8)
+        img = cv2.resize(small, (img_w, img_h), interpolation=cv2.INTER_CUBIC)
+        img = np.clip(img.astype(np.int32) + rng.randint(-8, 9, size=img.shape), 0, 255).astype(np.uint8)
+        imgs.append(img)
+    return imgs
+
+
+def write_records(path, imgs, img_format):
+    gtbox_label = np.array([[0, 0, 10, 0, 10, 10, 0, 10, 1]], dtype=np.int32)
+    start = time.time()
+    writer = tf.python_io.TFRecordWriter(path=path)
+    for i, img in enumerate(imgs):
+        writer.write(build_example('%06d.png' % i, img, gtbox_label, img_format).SerializeToString())
+    writer.close()
+    return time.time() - start
+
+
+def read_records(path, num_epochs, num_threads):
+    """
+    decode every example of path num_epochs times through the queue based reader of read_tfrecord
+    :return: examples, seconds
+    """
+    tf.reset_default_graph()
+    filename_queue = tf.train.string_input_producer([path], num_epochs=num_epochs, shuffle=False)
+    imgs = []
+    for _ in range(num_threads):
+        _, serialized_example = tf.TFRecordReader().read(filename_queue)
+        features = tf.parse_single_example(
+            serialized=serialized_example,
+            features={
+                'img_height': tf.FixedLenFeature([], tf.int64),
+                'img_width': tf.FixedLenFeature([], tf.int64),
+                'img': tf.FixedLenFeature([], tf.string),
+                'img_format': tf.FixedLenFeature([], tf.string, default_value='raw'),
+            }
+        )
+        img = decode_img(features['img'], features['img_format'],
+                         tf.cast(features['img_height'], tf.int32), tf.cast(features['img_width'], tf.int32))
+        imgs.append([tf.reduce_sum(tf.cast(img[:1, :1], tf.int32))])
+    batch = tf.train.batch_join(imgs, batch_size=1, capacity=8)
+
+    count = 0
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess, coord)
+        start = time.time()
+        try:
+            while not coord.should_stop():
+                sess.run(batch)
+                count += 1
+        except tf.errors.OutOfRangeError:
+            pass
+        cost = time.time() - start
+        coord.request_stop()
+        coord.join(threads)
+    return count, cost
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('size and read throughput of raw, png and jpeg tfrecords.')
+    parser.add_argument('--img_dir', dest='img_dir', help='images to crop, synthetic images if empty',
+                        default='', type=str)
+    parser.add_argument('--image_ext', dest='image_ext', help='format of the images', default='.png', type=str)
+    parser.add_argument('--num_imgs', dest='num_imgs', help='examples per tfrecord', default=100, type=int)
+    parser.add_argument('--img_h', dest='img_h', help='crop height', default=800, type=int)
+    parser.add_argument('--img_w', dest='img_w', help='crop width', default=800, type=int)
+    parser.add_argument('--num_epochs', dest='num_epochs', help='passes over each tfrecord', default=3, type=int)
+    parser.add_argument('--num_threads', dest='num_threads', help='reader threads', default=1, type=int)
+    parser.add_argument('--save_dir', dest='save_dir', help='where the tfrecords are written, a temp dir if empty',
+                        default='', type=str)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    imgs = load_images(args.img_dir, args.image_ext, args.num_imgs, args.img_h, args.img_w)
+    save_dir = args.save_dir if args.save_dir else tempfile.mkdtemp()
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    print('%d images of %dx%d, %d epochs, %d reader threads' % (
+        len(imgs), args.img_w, args.img_h, args.num_epochs, args.num_threads))
+    print('%-6s %10s %8s %10s %12s' % ('format', 'size(MB)', 'ratio', 'write(s)', 'read(img/s)'))
+    raw_size = None
+    try:
+        for img_format in ['raw', 'png', 'jpeg']:
+            path = os.path.join(save_dir, 'benchmark_%s.tfrecord' % img_format)
+            write_cost = write_records(path, imgs, img_format)
+            size = os.path.getsize(path)
+            raw_size = raw_size or size
+            count, read_cost = read_records(path, args.num_epochs, args.num_threads)
+            print('%-6s %10.1f %8.2f %10.2f %12.1f' % (
+                img_format, size / 1024. ** 2, raw_size / size, write_cost, count / read_cost))
+    finally:
+        if not args.save_dir:
+            shutil.rmtree(save_dir)
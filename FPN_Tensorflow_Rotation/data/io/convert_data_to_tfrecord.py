@@ -7,8 +7,12 @@ import numpy as np
 import tensorflow as tf
 import glob
 import cv2
+import json
+import time
 import random
+from multiprocessing import Pool, Value
 from libs.label_name_dict.label_dict import *
+from libs.box_utils.coordinate_convert import backward_convert
 from help_utils.tools import *
 
 tf.app.flags.DEFINE_string('VOC_dir', '/home/20184868@software.com/PM/datasets/HRSC2016/HRSC2016_train/', 'Voc dir')
@@ -18,6 +22,10 @@ tf.app.flags.DEFINE_string('save_name', 'train', 'save name')
 tf.app.flags.DEFINE_string('save_dir', '../tfrecord/', 'save name')
 tf.app.flags.DEFINE_string('img_format', '.jpg', 'format of image')
 tf.app.flags.DEFINE_string('dataset', 'HRSC2016', 'dataset')
+tf.app.flags.DEFINE_string('encode_format', 'raw', 'how images are stored: raw, png or jpeg')
+tf.app.flags.DEFINE_integer('num_shards', 8, 'number of tfrecord files')
+tf.app.flags.DEFINE_integer('num_workers', 8, 'number of processes writing the shards')
+tf.app.flags.DEFINE_boolean('gt_forms', False, 'also store the rotated and horizontal gtboxes')
 FLAGS = tf.app.flags.FLAGS
 
 
@@ -71,27 +79,98 @@ def read_xml_gtbox_and_label(xml_path):
     return img_height, img_width, gtbox_label
 
 
-def convert_pascal_to_tfrecord():
-    xml_path = os.path.join(FLAGS.VOC_dir, FLAGS.xml_dir)
-    image_path = os.path.join(FLAGS.VOC_dir, FLAGS.image_dir)
-    save_path = os.path.join(FLAGS.save_dir, FLAGS.dataset + '_' + FLAGS.save_name + '.tfrecord')
-    mkdir(FLAGS.save_dir)
+def encode_img(img, img_format='raw', jpeg_quality=95):
+    """
+    :param img: [h, w, 3] uint8 RGB
+    :param img_format: 'raw' keeps the pixels, 'png' or 'jpeg' compress them
+    :return: bytes
+    """
+    if img_format == 'raw':
+        return img.tostring()
+    if img_format == 'png':
+        ok, buf = cv2.imencode('.png', img[:, :, ::-1])
+    elif img_format == 'jpeg':
+        ok, buf = cv2.imencode('.jpg', img[:, :, ::-1], [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality])
+    else:
+        raise ValueError('img_format must be in raw, png, jpeg')
+    assert ok, 'failed to encode the image as {}'.format(img_format)
+    return buf.tostring()
+
+
+def build_example(img_name, img, gtbox_label, img_format='raw', gt_forms=False):
+    """
+    :param img_name: str
+    :param img: [h, w, 3] uint8 RGB
+    :param gtbox_label: [num_of_gtboxes, 9] int32, [x1, y1, x2, y2, x3, y3, x4, y4, label] in a per row
+    :param img_format: see encode_img, stored in the 'img_format' feature for the reader
+    :param gt_forms: also store 'gtboxes_r' [x_c, y_c, w, h, theta] of backward_convert and
+                     'gtboxes_h' [xmin, ymin, xmax, ymax], float32, so training does not compute them
+    :return: tf.train.Example
+    """
+    feature = {
+        # do not need encode() in linux
+        'img_name': _bytes_feature(img_name.encode()),
+        # 'img_name': _bytes_feature(img_name),
+        'img_height': _int64_feature(img.shape[0]),
+        'img_width': _int64_feature(img.shape[1]),
+        'img': _bytes_feature(encode_img(img, img_format)),
+        'img_format': _bytes_feature(img_format.encode()),
+        'gtboxes_and_label': _bytes_feature(gtbox_label.tostring()),
+        'num_objects': _int64_feature(gtbox_label.shape[0])
+    }
+    if gt_forms:
+        points = gtbox_label[:, :8].reshape([-1, 4, 2])
+        gtboxes_h = np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1).astype(np.float32)
+        feature['gtboxes_r'] = _bytes_feature(backward_convert(gtbox_label, with_label=False).tostring())
+        feature['gtboxes_h'] = _bytes_feature(gtboxes_h.tostring())
+
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def shard_path(save_dir, dataset, save_name, shard_id, num_shards):
+    """
+    a single shard keeps the old <dataset>_<save_name>.tfrecord name, all names match
+    the <dataset>_<save_name>* patterns of the readers
+    """
+    if num_shards == 1:
+        return os.path.join(save_dir, '%s_%s.tfrecord' % (dataset, save_name))
+    return os.path.join(save_dir, '%s_%s_%05d-of-%05d.tfrecord' % (dataset, save_name, shard_id, num_shards))
 
-    # writer_options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.ZLIB)
-    # writer = tf.python_io.TFRecordWriter(path=save_path, options=writer_options)
-    writer = tf.python_io.TFRecordWriter(path=save_path)
-    xml_path_list = glob.glob(xml_path + '/*.xml')
-    random.shuffle(xml_path_list)
-    for count, xml in enumerate(xml_path_list):
-        # to avoid path error in different development platform
-        xml = xml.replace('\\', '/')
 
-        img_name = xml.split('/')[-1].split('.')[0] + FLAGS.img_format
-        img_path = image_path + '/' + img_name
+def index_path(save_dir, dataset, save_name):
+    # must not match the <dataset>_<save_name>* patterns of the readers
+    return os.path.join(save_dir, 'index_%s_%s.json' % (dataset, save_name))
 
-        if not os.path.exists(img_path):
-            print('{} is not exist!'.format(img_path))
-            continue
+
+def write_shard_index(path, shards):
+    """
+    :param shards: list of (shard path, number of examples)
+    """
+    index = {'num_examples': sum([num for _, num in shards]),
+             'shards': [{'path': os.path.basename(shard), 'num_examples': num} for shard, num in shards]}
+    with open(path, 'w') as fw:
+        json.dump(index, fw, indent=2, sort_keys=True)
+
+
+_progress = None
+
+
+def _init_worker(progress):
+    global _progress
+    _progress = progress
+
+
+def write_pascal_shard(job):
+    """
+    parse, encode and write the examples of one shard
+    :return: shard path, number of examples
+    """
+    path, xml_list, image_path, image_ext, encode_format, gt_forms = job
+    num_examples = 0
+    writer = tf.python_io.TFRecordWriter(path=path)
+    for xml in xml_list:
+        img_name = xml.split('/')[-1].split('.')[0] + image_ext
+        img_path = image_path + '/' + img_name
 
         img_height, img_width, gtbox_label = read_xml_gtbox_and_label(xml)
         # if img_height != 600 or img_width != 600:
@@ -100,25 +179,57 @@ def convert_pascal_to_tfrecord():
         # img = np.array(Image.open(img_path))
         img = cv2.imread(img_path)[:, :, ::-1]
 
-        feature = tf.train.Features(feature={
-            # do not need encode() in linux
-            'img_name': _bytes_feature(img_name.encode()),
-            # 'img_name': _bytes_feature(img_name),
-            'img_height': _int64_feature(img_height),
-            'img_width': _int64_feature(img_width),
-            'img': _bytes_feature(img.tostring()),
-            'gtboxes_and_label': _bytes_feature(gtbox_label.tostring()),
-            'num_objects': _int64_feature(gtbox_label.shape[0])
-        })
+        example = build_example(img_name, img, gtbox_label, encode_format, gt_forms)
+        writer.write(example.SerializeToString())
+        num_examples += 1
 
-        example = tf.train.Example(features=feature)
+        if _progress is not None:
+            with _progress.get_lock():
+                _progress.value += 1
+    writer.close()
+    return path, num_examples
 
-        writer.write(example.SerializeToString())
 
-        view_bar('Conversion progress', count + 1, len(glob.glob(xml_path + '/*.xml')))
+def convert_pascal_to_tfrecord():
+    xml_path = os.path.join(FLAGS.VOC_dir, FLAGS.xml_dir)
+    image_path = os.path.join(FLAGS.VOC_dir, FLAGS.image_dir)
+    mkdir(FLAGS.save_dir)
 
+    # to avoid path error in different development platform
+    xml_path_list = []
+    for xml in glob.glob(xml_path + '/*.xml'):
+        xml = xml.replace('\\', '/')
+        img_path = image_path + '/' + xml.split('/')[-1].split('.')[0] + FLAGS.img_format
+        if not os.path.exists(img_path):
+            print('{} is not exist!'.format(img_path))
+            continue
+        xml_path_list.append(xml)
+    random.shuffle(xml_path_list)
+    num_shards = max(min(FLAGS.num_shards, len(xml_path_list)), 1)
+
+    # round robin over the shuffled list, shard sizes differ by one at most
+    jobs = [(shard_path(FLAGS.save_dir, FLAGS.dataset, FLAGS.save_name, shard_id, num_shards),
+             xml_path_list[shard_id::num_shards], image_path, FLAGS.img_format, FLAGS.encode_format,
+             FLAGS.gt_forms)
+            for shard_id in range(num_shards)]
+
+    start = time.time()
+    progress = Value('i', 0)
+    pool = Pool(max(min(FLAGS.num_workers, num_shards), 1), initializer=_init_worker, initargs=(progress,))
+    result = pool.map_async(write_pascal_shard, jobs)
+    while not result.ready():
+        result.wait(1)
+        view_bar('Conversion progress', progress.value, len(xml_path_list))
+    shards = result.get()
+    pool.close()
+    pool.join()
+    cost = time.time() - start
+
+    write_shard_index(index_path(FLAGS.save_dir, FLAGS.dataset, FLAGS.save_name), shards)
+    num_examples = sum([num for _, num in shards])
     print('\nConversion is complete!')
-    writer.close()
+    print('%d examples in %d shards, %.1fs (%.2f examples/s)' % (num_examples, num_shards, cost,
+                                                                 num_examples / max(cost, 1e-6)))
 
 
 if __name__ == '__main__':
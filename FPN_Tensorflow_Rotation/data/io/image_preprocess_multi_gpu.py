@@ -9,6 +9,7 @@ import cv2
 import numpy as np
 from libs.label_name_dict.label_dict import NAME_LABEL_MAP
 from libs.configs import cfgs
+from libs.box_utils.coordinate_convert import get_horizen_minAreaRectangle
 
 
 def max_length_limitation(length, length_limitation):
@@ -146,37 +147,50 @@ def random_flip_up_down(img_tensor, gtboxes_and_label):
     return img_tensor, gtboxes_and_label
 
 
-def random_rgb2gray(img_tensor, gtboxes_and_label):
-    '''
-    :param img_tensor: tf.float32
-    :return:
-    '''
-    def rgb2gray(img, gtboxes_and_label):
+def rgb2gray_np(img, gtboxes_and_label):
 
-        label = gtboxes_and_label[:, -1]
+    label = gtboxes_and_label[:, -1]
 
-        if cfgs.DATASET_NAME.startswith('DOTA'):
-            if NAME_LABEL_MAP['swimming-pool'] in label:
-                # do not change color, because swimming-pool need color
-                return img
-
-        coin = np.random.rand()
-        if coin < 0.3:
-            img = np.asarray(img, dtype=np.float32)
-            r, g, b = img[:, :, 0], img[:, :, 1], img[:, :, 2]
-            gray = r * 0.299 + g * 0.587 + b * 0.114
-            img = np.stack([gray, gray, gray], axis=2)
-            return img
-        else:
+    if cfgs.DATASET_NAME.startswith('DOTA'):
+        if NAME_LABEL_MAP['swimming-pool'] in label:
+            # do not change color, because swimming-pool need color
             return img
 
-    h, w, c = tf.shape(img_tensor)[0], tf.shape(img_tensor)[1], tf.shape(img_tensor)[2]
-    img_tensor = tf.py_func(rgb2gray,
-                            inp=[img_tensor, gtboxes_and_label],
-                            Tout=tf.float32)
-    img_tensor = tf.reshape(img_tensor, shape=[h, w, c])
+    coin = np.random.rand()
+    if coin < 0.3:
+        img = np.asarray(img, dtype=np.float32)
+        r, g, b = img[:, :, 0], img[:, :, 1], img[:, :, 2]
+        gray = r * 0.299 + g * 0.587 + b * 0.114
+        img = np.stack([gray, gray, gray], axis=2)
+        return img
+    else:
+        return img
 
-    return img_tensor
+
+def random_rgb2gray(img_tensor, gtboxes_and_label, use_py_func=False):
+    '''
+    :param img_tensor: tf.float32
+    :param use_py_func: the old numpy version, kept to benchmark against
+    :return:
+    '''
+    if use_py_func:
+        h, w, c = tf.shape(img_tensor)[0], tf.shape(img_tensor)[1], tf.shape(img_tensor)[2]
+        img_tensor = tf.py_func(rgb2gray_np,
+                                inp=[img_tensor, gtboxes_and_label],
+                                Tout=tf.float32)
+        img_tensor = tf.reshape(img_tensor, shape=[h, w, c])
+        return img_tensor
+
+    to_gray = tf.less(tf.random_uniform(shape=[], minval=0, maxval=1), 0.3)
+    if cfgs.DATASET_NAME.startswith('DOTA'):
+        # do not change color, because swimming-pool need color
+        has_pool = tf.reduce_any(tf.equal(gtboxes_and_label[:, -1], NAME_LABEL_MAP['swimming-pool']))
+        to_gray = tf.logical_and(to_gray, tf.logical_not(has_pool))
+
+    gray = tf.reduce_sum(img_tensor * tf.constant([0.299, 0.587, 0.114]), axis=2, keepdims=True)
+    return tf.cond(to_gray,
+                   lambda: tf.tile(gray, [1, 1, 3]),
+                   lambda: img_tensor)
 
 
 def rotate_img_np(img, gtboxes_and_label, r_theta):
@@ -206,7 +220,51 @@ def rotate_img_np(img, gtboxes_and_label, r_theta):
     return rotated_img, gtboxes_and_label
 
 
-def rotate_img(img_tensor, gtboxes_and_label):
+def rotation_matrix(h, w, r_theta):
+    '''
+    cv2.getRotationMatrix2D around (w // 2, h // 2), shifted to the canvas holding the whole rotated image.
+    float64 like cv2, so the int32 boxes truncate the same way
+    :return: alpha, beta, tx, ty of [x', y'] = [[alpha, beta], [-beta, alpha]] * [x, y] + [tx, ty], new_h, new_w
+    '''
+    cx, cy = tf.cast(w // 2, tf.float64), tf.cast(h // 2, tf.float64)
+    h_f, w_f = tf.cast(h, tf.float64), tf.cast(w, tf.float64)
+
+    theta = tf.cast(r_theta, tf.float64) * np.pi / 180.
+    alpha, beta = tf.cos(theta), tf.sin(theta)
+    new_w = tf.cast(h_f * tf.abs(beta) + w_f * tf.abs(alpha), tf.int32)
+    new_h = tf.cast(h_f * tf.abs(alpha) + w_f * tf.abs(beta), tf.int32)
+
+    tx = ((1. - alpha) * cx - beta * cy) + (tf.cast(new_w, tf.float64) / 2. - cx)
+    ty = (beta * cx + (1. - alpha) * cy) + (tf.cast(new_h, tf.float64) / 2. - cy)
+    return alpha, beta, tx, ty, new_h, new_w
+
+
+def rotate_img_tf(img_tensor, gtboxes_and_label, r_theta):
+    '''
+    rotate_img_np in graph: tf.contrib.image.transform samples the rotated canvas with the inverse mapping
+    :param r_theta: degree, counter-clockwise
+    '''
+    alpha, beta, tx, ty, new_h, new_w = rotation_matrix(tf.shape(img_tensor)[0], tf.shape(img_tensor)[1], r_theta)
+
+    # inverse matrix for the output -> input mapping of transform
+    transform = tf.stack([alpha, -beta, -alpha * tx + beta * ty,
+                          beta, alpha, -beta * tx - alpha * ty,
+                          tf.constant(0., tf.float64), tf.constant(0., tf.float64)])
+    transform = tf.cast(transform, tf.float32)
+    rotated_img = tf.contrib.image.transform(tf.expand_dims(img_tensor, axis=0), tf.expand_dims(transform, axis=0),
+                                             interpolation='BILINEAR', output_shape=tf.stack([new_h, new_w]))
+    rotated_img = tf.squeeze(rotated_img, axis=0)
+
+    points = tf.reshape(tf.cast(gtboxes_and_label[:, :8], tf.float64), [-1, 4, 2])
+    xs, ys = points[:, :, 0], points[:, :, 1]
+    new_points = tf.stack([alpha * xs + beta * ys + tx, -beta * xs + alpha * ys + ty], axis=2)
+    new_points = tf.cast(tf.reshape(new_points, [-1, 8]), tf.int32)
+    gtboxes_and_label = tf.concat([new_points, gtboxes_and_label[:, 8:]], axis=1)
+
+    return rotated_img, gtboxes_and_label
+
+
+def rotate_img(img_tensor, gtboxes_and_label, use_py_func=False):
 
     # thetas = tf.constant([-30, -60, -90, 30, 60, 90])
     thetas = tf.range(-90, 90+16, delta=15)
@@ -214,6 +272,9 @@ def rotate_img(img_tensor, gtboxes_and_label):
 
     theta = tf.random_shuffle(thetas)[0]
 
+    if not use_py_func:
+        return rotate_img_tf(img_tensor, gtboxes_and_label, theta)
+
     img_tensor, gtboxes_and_label = tf.py_func(rotate_img_np,
                                                inp=[img_tensor, gtboxes_and_label, theta],
                                                Tout=[tf.float32, tf.int32])
@@ -225,12 +286,117 @@ def rotate_img(img_tensor, gtboxes_and_label):
     return img_tensor, gtboxes_and_label
 
 
-def random_rotate_img(img_tensor, gtboxes_and_label):
+def random_rotate_img(img_tensor, gtboxes_and_label, use_py_func=False):
 
     img_tensor, gtboxes_and_label = tf.cond(tf.less(tf.random_uniform(shape=[], minval=0, maxval=1), 0.6),
-                                            lambda: rotate_img(img_tensor, gtboxes_and_label),
+                                            lambda: rotate_img(img_tensor, gtboxes_and_label, use_py_func),
                                             lambda: (img_tensor, gtboxes_and_label))
 
     return img_tensor, gtboxes_and_label
 
 
+# --------------------------------------------- precomputed gt forms
+# gt_forms: [N, 9] float32, [x_c, y_c, w, h, theta, xmin, ymin, xmax, ymax] of the boxes in gtboxes_and_label,
+# written by convert_data_to_tfrecord --gt_forms and kept in step with the 8 points by the ops below.
+# The horizontal boxes follow the points exactly, the rotated boxes are moved analytically instead of
+# running backward_convert again, which may differ from it by the integer truncation of the points.
+
+def normalize_rbox_theta(w, h, theta):
+    '''
+    back to the backward_convert convention, theta in [-90, 0) and w the side along theta
+    '''
+    theta = tf.floormod(theta + 90., 180.) - 90.
+    swap = tf.greater_equal(theta, 0.)
+    return tf.where(swap, h, w), tf.where(swap, w, h), tf.where(swap, theta - 90., theta)
+
+
+def resize_gt_forms(gt_forms, img_h, img_w, new_h, new_w):
+    x_c, y_c, w, h, theta, x_min, y_min, x_max, y_max = tf.unstack(gt_forms, axis=1)
+    sx = tf.cast(new_w, tf.float32) / tf.cast(img_w, tf.float32)
+    sy = tf.cast(new_h, tf.float32) / tf.cast(img_h, tf.float32)
+
+    # both sides of the rectangle are scaled along their own direction
+    cos, sin = tf.cos(theta * np.pi / 180.), tf.sin(theta * np.pi / 180.)
+    w = w * tf.sqrt(tf.square(sx * cos) + tf.square(sy * sin))
+    h = h * tf.sqrt(tf.square(sx * sin) + tf.square(sy * cos))
+    theta = tf.atan2(sy * sin, sx * cos) * 180. / np.pi
+    w, h, theta = normalize_rbox_theta(w, h, theta)
+
+    # the same integer floor division as the points in short_side_resize
+    def floor_resize(v, new_len, old_len):
+        return tf.cast(tf.cast(v, tf.int32) * new_len // old_len, tf.float32)
+
+    return tf.transpose(tf.stack([x_c * sx, y_c * sy, w, h, theta,
+                                  floor_resize(x_min, new_w, img_w), floor_resize(y_min, new_h, img_h),
+                                  floor_resize(x_max, new_w, img_w), floor_resize(y_max, new_h, img_h)], axis=0))
+
+
+def flip_left_right_gt_forms(gt_forms, img_w):
+    x_c, y_c, w, h, theta, x_min, y_min, x_max, y_max = tf.unstack(gt_forms, axis=1)
+    img_w = tf.cast(img_w, tf.float32)
+    w, h, theta = normalize_rbox_theta(w, h, -theta)
+    return tf.transpose(tf.stack([img_w - x_c, y_c, w, h, theta,
+                                  img_w - x_max, y_min, img_w - x_min, y_max], axis=0))
+
+
+def flip_up_down_gt_forms(gt_forms, img_h):
+    x_c, y_c, w, h, theta, x_min, y_min, x_max, y_max = tf.unstack(gt_forms, axis=1)
+    img_h = tf.cast(img_h, tf.float32)
+    w, h, theta = normalize_rbox_theta(w, h, -theta)
+    return tf.transpose(tf.stack([x_c, img_h - y_c, w, h, theta,
+                                  x_min, img_h - y_max, x_max, img_h - y_min], axis=0))
+
+
+def rotate_gt_forms(gt_forms, rotated_gtboxes_and_label, img_h, img_w, r_theta):
+    '''
+    :param rotated_gtboxes_and_label: the output of rotate_img_tf, the horizontal boxes are taken from its points
+    '''
+    x_c, y_c, w, h, theta = tf.unstack(gt_forms[:, :5], axis=1)
+    alpha, beta, tx, ty, _, _ = rotation_matrix(img_h, img_w, r_theta)
+    alpha, beta, tx, ty = [tf.cast(v, tf.float32) for v in [alpha, beta, tx, ty]]
+
+    new_x_c = alpha * x_c + beta * y_c + tx
+    new_y_c = -beta * x_c + alpha * y_c + ty
+    w, h, theta = normalize_rbox_theta(w, h, theta - tf.cast(r_theta, tf.float32))
+
+    x_min, y_min, x_max, y_max = tf.unstack(tf.cast(get_horizen_minAreaRectangle(rotated_gtboxes_and_label[:, :8],
+                                                                                 with_label=False),
+                                                    tf.float32), axis=1)
+    return tf.transpose(tf.stack([new_x_c, new_y_c, w, h, theta, x_min, y_min, x_max, y_max], axis=0))
+
+
+def short_side_resize_with_forms(img_tensor, gtboxes_and_label, gt_forms, target_shortside_len, length_limitation=1200):
+    img_h, img_w = tf.shape(img_tensor)[0], tf.shape(img_tensor)[1]
+    img_tensor, gtboxes_and_label, new_h, new_w = short_side_resize(img_tensor, gtboxes_and_label,
+                                                                    target_shortside_len, length_limitation)
+    gt_forms = resize_gt_forms(gt_forms, img_h, img_w, new_h, new_w)
+    return img_tensor, gtboxes_and_label, gt_forms, new_h, new_w
+
+
+def random_flip_left_right_with_forms(img_tensor, gtboxes_and_label, gt_forms):
+    img_w = tf.shape(img_tensor)[1]
+    return tf.cond(tf.less(tf.random_uniform(shape=[], minval=0, maxval=1), 0.5),
+                   lambda: flip_left_to_right(img_tensor, gtboxes_and_label) +
+                           (flip_left_right_gt_forms(gt_forms, img_w), ),
+                   lambda: (img_tensor, gtboxes_and_label, gt_forms))
+
+
+def random_flip_up_down_with_forms(img_tensor, gtboxes_and_label, gt_forms):
+    img_h = tf.shape(img_tensor)[0]
+    return tf.cond(tf.less(tf.random_uniform(shape=[], minval=0, maxval=1), 0.5),
+                   lambda: flip_up_down(img_tensor, gtboxes_and_label) + (flip_up_down_gt_forms(gt_forms, img_h), ),
+                   lambda: (img_tensor, gtboxes_and_label, gt_forms))
+
+
+def random_rotate_img_with_forms(img_tensor, gtboxes_and_label, gt_forms):
+
+    def rotate():
+        theta = tf.random_shuffle(tf.range(-90, 90+16, delta=15))[0]
+        rotated_img, rotated_gtboxes_and_label = rotate_img_tf(img_tensor, gtboxes_and_label, theta)
+        rotated_gt_forms = rotate_gt_forms(gt_forms, rotated_gtboxes_and_label,
+                                           tf.shape(img_tensor)[0], tf.shape(img_tensor)[1], theta)
+        return rotated_img, rotated_gtboxes_and_label, rotated_gt_forms
+
+    return tf.cond(tf.less(tf.random_uniform(shape=[], minval=0, maxval=1), 0.6),
+                   rotate,
+                   lambda: (img_tensor, gtboxes_and_label, gt_forms))
@@ -11,6 +11,18 @@ from data.io import image_preprocess
 from libs.configs import cfgs
 
 
+def decode_img(img, img_format, img_height, img_width):
+    """
+    :param img: the 'img' feature, raw pixels or png/jpeg bytes
+    :param img_format: the 'img_format' feature, 'raw' for records written without it
+    :return: [img_height, img_width, 3] uint8 RGB
+    """
+    img = tf.cond(tf.equal(img_format, 'raw'),
+                  lambda: tf.decode_raw(img, tf.uint8),
+                  lambda: tf.image.decode_image(img, channels=3))
+    return tf.reshape(img, shape=[img_height, img_width, 3])
+
+
 def read_single_example_and_decode(filename_queue):
 
     tfrecord_options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.ZLIB)
@@ -26,6 +38,7 @@ def read_single_example_and_decode(filename_queue):
             'img_height': tf.FixedLenFeature([], tf.int64),
             'img_width': tf.FixedLenFeature([], tf.int64),
             'img': tf.FixedLenFeature([], tf.string),
+            'img_format': tf.FixedLenFeature([], tf.string, default_value='raw'),
             'gtboxes_and_label': tf.FixedLenFeature([], tf.string),
             'num_objects': tf.FixedLenFeature([], tf.int64)
         }
@@ -33,9 +46,7 @@ def read_single_example_and_decode(filename_queue):
     img_name = features['img_name']
     img_height = tf.cast(features['img_height'], tf.int32)
     img_width = tf.cast(features['img_width'], tf.int32)
-    img = tf.decode_raw(features['img'], tf.uint8)
-
-    img = tf.reshape(img, shape=[img_height, img_width, 3])
+    img = decode_img(features['img'], features['img_format'], img_height, img_width)
     gtboxes_and_label = tf.decode_raw(features['gtboxes_and_label'], tf.int32)
     gtboxes_and_label = tf.reshape(gtboxes_and_label, [-1, 9])
     num_objects = tf.cast(features['num_objects'], tf.int32)
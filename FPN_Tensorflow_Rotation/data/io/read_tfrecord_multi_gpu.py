@@ -13,53 +13,83 @@ from data.io import image_preprocess_multi_gpu as image_preprocess
 from libs.configs import cfgs
 
 
-def read_single_example_and_decode(filename_queue):
-
-    # tfrecord_options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.ZLIB)
+def decode_img(img, img_format, img_height, img_width):
+    """
+    :param img: the 'img' feature, raw pixels or png/jpeg bytes
+    :param img_format: the 'img_format' feature, 'raw' for records written without it
+    :return: [img_height, img_width, 3] uint8 RGB
+    """
+    img = tf.cond(tf.equal(img_format, 'raw'),
+                  lambda: tf.decode_raw(img, tf.uint8),
+                  lambda: tf.image.decode_image(img, channels=3))
+    return tf.reshape(img, shape=[img_height, img_width, 3])
 
-    # reader = tf.TFRecordReader(options=tfrecord_options)
-    reader = tf.TFRecordReader()
-    _, serialized_example = reader.read(filename_queue)
 
-    features = tf.parse_single_example(
-        serialized=serialized_example,
-        features={
-            'img_name': tf.FixedLenFeature([], tf.string),
-            'img_height': tf.FixedLenFeature([], tf.int64),
-            'img_width': tf.FixedLenFeature([], tf.int64),
-            'img': tf.FixedLenFeature([], tf.string),
-            'gtboxes_and_label': tf.FixedLenFeature([], tf.string),
-            'num_objects': tf.FixedLenFeature([], tf.int64)
-        }
-    )
+def parse_example(serialized_example, gt_forms=False):
+    """
+    :param gt_forms: also return the [num_objects, 9] gt forms of image_preprocess, built from the
+                     'gtboxes_r' and 'gtboxes_h' features of convert_data_to_tfrecord --gt_forms
+    """
+    features = {
+        'img_name': tf.FixedLenFeature([], tf.string),
+        'img_height': tf.FixedLenFeature([], tf.int64),
+        'img_width': tf.FixedLenFeature([], tf.int64),
+        'img': tf.FixedLenFeature([], tf.string),
+        'img_format': tf.FixedLenFeature([], tf.string, default_value='raw'),
+        'gtboxes_and_label': tf.FixedLenFeature([], tf.string),
+        'num_objects': tf.FixedLenFeature([], tf.int64)
+    }
+    if gt_forms:
+        features['gtboxes_r'] = tf.FixedLenFeature([], tf.string, default_value='')
+        features['gtboxes_h'] = tf.FixedLenFeature([], tf.string, default_value='')
+    features = tf.parse_single_example(serialized=serialized_example, features=features)
     img_name = features['img_name']
     img_height = tf.cast(features['img_height'], tf.int32)
     img_width = tf.cast(features['img_width'], tf.int32)
-    img = tf.decode_raw(features['img'], tf.uint8)
-
-    img = tf.reshape(img, shape=[img_height, img_width, 3])
+    img = decode_img(features['img'], features['img_format'], img_height, img_width)
 
     gtboxes_and_label = tf.decode_raw(features['gtboxes_and_label'], tf.int32)
     gtboxes_and_label = tf.reshape(gtboxes_and_label, [-1, 9])
 
     num_objects = tf.cast(features['num_objects'], tf.int32)
-    return img_name, img, gtboxes_and_label, num_objects
+    if not gt_forms:
+        return img_name, img, gtboxes_and_label, num_objects
 
+    gtboxes_r = tf.reshape(tf.decode_raw(features['gtboxes_r'], tf.float32), [-1, 5])
+    gtboxes_h = tf.reshape(tf.decode_raw(features['gtboxes_h'], tf.float32), [-1, 4])
+    check = tf.Assert(tf.equal(tf.shape(gtboxes_r)[0], tf.shape(gtboxes_and_label)[0]),
+                      ['tfrecord has no gtboxes_r/gtboxes_h, convert it again with --gt_forms', img_name])
+    with tf.control_dependencies([check]):
+        gt_forms = tf.concat([gtboxes_r, gtboxes_h], axis=1)
+    return img_name, img, gtboxes_and_label, num_objects, gt_forms
 
-def read_and_prepocess_single_img(filename_queue, shortside_len, is_training):
+
+def read_single_example_and_decode(filename_queue):
+
+    # tfrecord_options = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.ZLIB)
+
+    # reader = tf.TFRecordReader(options=tfrecord_options)
+    reader = tf.TFRecordReader()
+    _, serialized_example = reader.read(filename_queue)
+
+    return parse_example(serialized_example, gt_forms=cfgs.PRECOMPUTED_GT)
+
+
+def preprocess_img(img_name, img, gtboxes_and_label, num_objects, shortside_len, is_training, gt_forms=None):
     """
 
-    :param filename_queue:
     :param shortside_len: cfgs.IMG_SHORT_SIDE_LEN
     :param is_training:
+    :param gt_forms: precomputed gt forms, moved along with gtboxes_and_label and returned last
     :return:
     """
 
-    img_name, img, gtboxes_and_label, num_objects = read_single_example_and_decode(filename_queue)
-
     img = tf.cast(img, tf.float32)
 
-    if is_training:
+    if gt_forms is not None:
+        img, gtboxes_and_label, gt_forms, img_h, img_w = preprocess_img_with_forms(img, gtboxes_and_label, gt_forms,
+                                                                                   shortside_len, is_training)
+    elif is_training:
 
         if cfgs.RGB2GRAY:
             # img, gtboxes_and_label = image_preprocess.aspect_ratio_jittering(img, gtboxes_and_label)
@@ -88,44 +118,183 @@ def read_and_prepocess_single_img(filename_queue, shortside_len, is_training):
         img = img / 255 - tf.constant([[cfgs.PIXEL_MEAN_]])
     else:
         img = img - tf.constant([[cfgs.PIXEL_MEAN]])  # sub pixel mean at last
+    if gt_forms is not None:
+        return img_name, img, gtboxes_and_label, num_objects, img_h, img_w, gt_forms
     return img_name, img, gtboxes_and_label, num_objects, img_h, img_w
 
 
-def next_batch(dataset_name, batch_size, shortside_len, is_training):
-    '''
+def preprocess_img_with_forms(img, gtboxes_and_label, gt_forms, shortside_len, is_training):
+    """
+    the augmentation of preprocess_img, with the precomputed gt forms updated by the same ops
+    """
+    if is_training:
+
+        if cfgs.RGB2GRAY:
+            img = image_preprocess.random_rgb2gray(img_tensor=img, gtboxes_and_label=gtboxes_and_label)
+
+        if cfgs.IMG_ROTATE:
+            img, gtboxes_and_label, gt_forms = image_preprocess.random_rotate_img_with_forms(img, gtboxes_and_label,
+                                                                                            gt_forms)
+
+    img, gtboxes_and_label, gt_forms, img_h, img_w = \
+        image_preprocess.short_side_resize_with_forms(img, gtboxes_and_label, gt_forms,
+                                                      target_shortside_len=shortside_len,
+                                                      length_limitation=cfgs.IMG_MAX_LENGTH)
+    if is_training:
+        if cfgs.HORIZONTAL_FLIP:
+            img, gtboxes_and_label, gt_forms = image_preprocess.random_flip_left_right_with_forms(
+                img, gtboxes_and_label, gt_forms)
+        if cfgs.VERTICAL_FLIP:
+            img, gtboxes_and_label, gt_forms = image_preprocess.random_flip_up_down_with_forms(
+                img, gtboxes_and_label, gt_forms)
+
+    return img, gtboxes_and_label, gt_forms, img_h, img_w
+
+
+def read_and_prepocess_single_img(filename_queue, shortside_len, is_training):
+    """
+
+    :param filename_queue:
+    :param shortside_len: cfgs.IMG_SHORT_SIDE_LEN
+    :param is_training:
     :return:
-    img_name_batch: shape(1, 1)
-    img_batch: shape:(1, new_imgH, new_imgW, C)
-    gtboxes_and_label_batch: shape(1, Num_Of_objects, 5] .each row is [x1, y1, x2, y2, label]
-    '''
-    # assert batch_size == 1, "we only support batch_size is 1.We may support large batch_size in the future"
+    """
+
+    example = read_single_example_and_decode(filename_queue)
+    return preprocess_img(*example[:4], shortside_len=shortside_len, is_training=is_training,
+                          gt_forms=example[4] if cfgs.PRECOMPUTED_GT else None)
 
+
+def random_shortside_len(shortside_len):
+    """
+    a list of short sides (image pyramid) becomes a tensor drawing one of them per image
+    """
+    if isinstance(shortside_len, (list, tuple)):
+        return tf.random_shuffle(tf.constant(shortside_len))[0]
+    return shortside_len
+
+
+def tfrecord_pattern(dataset_name, is_training, tfrecord_dir='../data/tfrecord'):
     valid_dataset= ['DOTA1.5', 'ICDAR2015', 'pascal', 'coco', 'bdd100k', 'DOTA', 'HRSC2016', 'UCAS-AOD']
     if dataset_name not in valid_dataset:
         raise ValueError('dataSet name must be in {}'.format(valid_dataset))
 
     if is_training:
-        pattern = os.path.join('../data/tfrecord', dataset_name + '*_train*')
+        pattern = os.path.join(tfrecord_dir, dataset_name + '*_train*')
     else:
-        pattern = os.path.join('../data/tfrecord', dataset_name + '_test*')
+        pattern = os.path.join(tfrecord_dir, dataset_name + '_test*')
 
     print('tfrecord path is -->', os.path.abspath(pattern))
+    return pattern
+
+
+def queue_next_batch(pattern, batch_size, shortside_len, is_training):
 
     filename_tensorlist = tf.train.match_filenames_once(pattern)
 
     filename_queue = tf.train.string_input_producer(filename_tensorlist)
 
-    img_name, img, gtboxes_and_label, num_obs, img_h, img_w = read_and_prepocess_single_img(filename_queue, shortside_len,
-                                                                                            is_training=is_training)
-    img_name_batch, img_batch, gtboxes_and_label_batch, num_obs_batch, img_h_batch, img_w_batch = \
-        tf.train.batch(
-                       [img_name, img, gtboxes_and_label, num_obs, img_h, img_w],
-                       batch_size=batch_size,
-                       capacity=16,
-                       num_threads=16,
-                       dynamic_pad=True)
-
-    return img_name_batch, img_batch, gtboxes_and_label_batch, num_obs_batch, img_h_batch, img_w_batch
+    example = read_and_prepocess_single_img(filename_queue, random_shortside_len(shortside_len),
+                                            is_training=is_training)
+    batch = tf.train.batch(
+                           list(example),
+                           batch_size=batch_size,
+                           capacity=16,
+                           num_threads=16,
+                           dynamic_pad=True)
+
+    return tuple(batch)
+
+
+def bucket_key(img_h, img_w, bucket_boundaries, short_side_bin=32):
+    """
+    examples with the same key are batched together: the aspect ratio bucket (w / h against
+    bucket_boundaries) and the resized short side in bins of short_side_bin pixels, so an image pyramid
+    is not mixed in a batch either. The bins keep the number of keys small when the random rotation
+    enlarges the canvas by a different amount for every image.
+    :return: int64 scalar
+    """
+    ratio = tf.cast(img_w, tf.float32) / tf.cast(img_h, tf.float32)
+    ratio_bucket = tf.reduce_sum(tf.cast(tf.greater(ratio, tf.constant(bucket_boundaries, tf.float32)), tf.int64))
+    short_side = tf.cast(tf.minimum(img_h, img_w), tf.int64) // short_side_bin
+    return short_side * (len(bucket_boundaries) + 1) + ratio_bucket
+
+
+def padding_waste(img_batch, img_h_batch, img_w_batch):
+    """
+    fraction of the pixels of a padded batch that belong to no image
+    """
+    batch_shape = tf.shape(img_batch)
+    padded_pixels = tf.cast(batch_shape[0] * batch_shape[1] * batch_shape[2], tf.float32)
+    valid_pixels = tf.reduce_sum(tf.cast(img_h_batch, tf.float32) * tf.cast(img_w_batch, tf.float32))
+    return 1. - valid_pixels / padded_pixels
+
+
+def dataset_next_batch(pattern, batch_size, shortside_len, is_training, num_parallel_calls=16,
+                       shuffle_buffer=64, prefetch=2, cache=False, bucket_boundaries=None):
+    """
+    tf.data version of queue_next_batch: shards are read with a parallel interleave, examples are
+    decoded and augmented by num_parallel_calls map calls, and batches are prefetched.
+    Nothing has to be initialized or started before the first sess.run.
+    :param shortside_len: int or list of int, a tensor can not be captured by the one shot iterator
+    :param cache: keep the decoded images in memory after the first epoch
+    :param bucket_boundaries: w / h boundaries of the aspect ratio buckets, None pads any examples
+                              together. Only used when batch_size > 1
+    """
+    if isinstance(shortside_len, tf.Tensor):
+        raise ValueError('shortside_len must be an int or a list of int with tf.data')
+
+    files = tf.data.Dataset.list_files(pattern, shuffle=is_training)
+    dataset = files.apply(tf.data.experimental.parallel_interleave(tf.data.TFRecordDataset,
+                                                                   cycle_length=num_parallel_calls,
+                                                                   sloppy=is_training))
+    gt_forms = cfgs.PRECOMPUTED_GT
+    dataset = dataset.map(lambda serialized_example: parse_example(serialized_example, gt_forms),
+                          num_parallel_calls=num_parallel_calls)
+    if cache:
+        dataset = dataset.cache()
+    if is_training:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.repeat()
+    dataset = dataset.map(lambda *example:
+                          preprocess_img(*example[:4], shortside_len=random_shortside_len(shortside_len),
+                                         is_training=is_training, gt_forms=example[4] if gt_forms else None),
+                          num_parallel_calls=num_parallel_calls)
+    # zero padding like dynamic_pad of tf.train.batch
+    padded_shapes = ([], [None, None, 3], [None, 9], [], [], []) + (([None, 9], ) if gt_forms else ())
+    if bucket_boundaries and batch_size > 1:
+        dataset = dataset.apply(tf.data.experimental.group_by_window(
+            key_func=lambda *example: bucket_key(example[4], example[5], bucket_boundaries),
+            reduce_func=lambda key, bucket: bucket.padded_batch(batch_size, padded_shapes=padded_shapes,
+                                                                drop_remainder=True),
+            window_size=batch_size))
+    else:
+        dataset = dataset.padded_batch(batch_size, padded_shapes=padded_shapes, drop_remainder=True)
+    dataset = dataset.prefetch(prefetch)
+    return dataset.make_one_shot_iterator().get_next()
+
+
+def next_batch(dataset_name, batch_size, shortside_len, is_training):
+    '''
+    :return:
+    img_name_batch: shape(1, 1)
+    img_batch: shape:(1, new_imgH, new_imgW, C)
+    gtboxes_and_label_batch: shape(1, Num_Of_objects, 5] .each row is [x1, y1, x2, y2, label]
+    img_h_batch, img_w_batch
+    gt_forms_batch: only with cfgs.PRECOMPUTED_GT, shape(1, Num_Of_objects, 9),
+                    each row is [x_c, y_c, w, h, theta, xmin, ymin, xmax, ymax]
+    '''
+    # assert batch_size == 1, "we only support batch_size is 1.We may support large batch_size in the future"
+
+    pattern = tfrecord_pattern(dataset_name, is_training)
+    if cfgs.USE_TF_DATA:
+        return dataset_next_batch(pattern, batch_size, shortside_len, is_training,
+                                  num_parallel_calls=cfgs.NUM_PARALLEL_CALLS,
+                                  shuffle_buffer=cfgs.SHUFFLE_BUFFER,
+                                  prefetch=cfgs.PREFETCH_BATCHES,
+                                  cache=cfgs.CACHE_DATASET,
+                                  bucket_boundaries=cfgs.BUCKET_BOUNDARIES)
+    return queue_next_batch(pattern, batch_size, shortside_len, is_training)
 
 
 if __name__ == '__main__':
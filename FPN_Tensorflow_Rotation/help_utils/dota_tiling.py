@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+
+import sys
+import time
+import resource
+import threading
+from contextlib import contextmanager
+import numpy as np
+import cv2
+from PIL import Image
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+
+def get_crop_grid(img_h, img_w, h_len, w_len, h_overlap, w_overlap):
+    """
+    top-left corners of the sliding windows. The last window of a row/column is
+    shifted back to end at the image border, windows are not repeated.
+    An image smaller than the window gets a single window at 0 along that side.
+    :return: list of (hh_, ww_)
+    """
+    img_h, img_w = max(img_h, h_len), max(img_w, w_len)
+    grid = []
+    for hh in range(0, img_h, h_len - h_overlap):
+        if img_h - hh - 1 < h_len:
+            hh_ = img_h - h_len
+        else:
+            hh_ = hh
+        for ww in range(0, img_w, w_len - w_overlap):
+            if img_w - ww - 1 < w_len:
+                ww_ = img_w - w_len
+            else:
+                ww_ = ww
+            if (hh_, ww_) not in grid:
+                grid.append((hh_, ww_))
+    return grid
+
+
+def crop_tile(img, hh_, ww_, h_len, w_len):
+    """
+    the window as a view of img. Only a window running past the border of an image
+    smaller than the window is copied, into a zero padded tile of the same dtype.
+    """
+    tile = img[hh_:(hh_ + h_len), ww_:(ww_ + w_len)]
+    if tile.shape[0] == h_len and tile.shape[1] == w_len:
+        return tile
+    padded = np.zeros((h_len, w_len) + tile.shape[2:], dtype=tile.dtype)
+    padded[:tile.shape[0], :tile.shape[1]] = tile
+    return padded
+
+
+def batch_tiles(img, crop_grid, h_len, w_len, batch_size, resize_fn=None):
+    """
+    cut the windows of crop_grid out of img on demand and stack them into fixed-size batches,
+    the last batch is zero padded. With batch_size 1 the batches are views of img, otherwise
+    one batch buffer is reused, so the caller must be done with a batch before the next one.
+    :param img: [H, W, 3] image
+    :param crop_grid: list of (hh_, ww_), returned with its batch
+    :param batch_size: number of tiles per batch
+    :param resize_fn: applied to each tile, e.g. the resize of a test scale
+    :return: generator of (batch [batch_size, h, w, 3], crop_grid of the valid tiles in the batch)
+    """
+    batch = None
+    for start in range(0, len(crop_grid), batch_size):
+        batch_grid = crop_grid[start:start + batch_size]
+        tiles = [crop_tile(img, hh_, ww_, h_len, w_len) for hh_, ww_ in batch_grid]
+        if resize_fn is not None:
+            tiles = [resize_fn(tile) for tile in tiles]
+        if batch_size == 1:
+            yield tiles[0][np.newaxis], batch_grid
+            continue
+
+        if batch is None or batch.shape[1:] != tiles[0].shape:
+            batch = np.empty([batch_size] + list(tiles[0].shape), dtype=tiles[0].dtype)
+        for i, tile in enumerate(tiles):
+            batch[i] = tile
+        batch[len(tiles):] = 0
+        yield batch, batch_grid
+
+
+def image_area(img_path):
+    """
+    h * w read from the image header, without decoding the pixels.
+    Images PIL can not open are decoded with cv2, -1 if that fails too so they go last.
+    """
+    try:
+        w, h = Image.open(img_path).size
+        return w * h
+    except Exception:
+        img = cv2.imread(img_path)
+        return -1 if img is None else img.shape[0] * img.shape[1]
+
+
+def fill_task_queue(task_queue, img_paths, num_workers):
+    """
+    put the images largest first in a queue shared by the workers, followed by
+    one None per worker, so big scenes do not end up in the tail of a run
+    """
+    for img_path in sorted(img_paths, key=image_area, reverse=True):
+        task_queue.put(img_path)
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+
+def iter_task_queue(task_queue):
+    """
+    pull images from the shared queue on demand until its None
+    """
+    while True:
+        img_path = task_queue.get()
+        if img_path is None:
+            break
+        yield img_path
+
+
+def peak_rss_mb():
+    """
+    peak resident set size over the whole life of this process, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB on Linux
+    return peak / (1024. ** 2) if sys.platform == 'darwin' else peak / 1024.
+
+
+def current_rss_mb():
+    """
+    resident set size of this process right now, in MB. Falls back to peak_rss_mb
+    where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * resource.getpagesize() / (1024. ** 2)
+    except (IOError, OSError, IndexError, ValueError):
+        return peak_rss_mb()
+
+
+class StageTimer(object):
+    """
+    thread-safe wall time and call counters per pipeline stage
+    """
+
+    def __init__(self):
+        self.cost = {}
+        self.count = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def add(self, stage, cost):
+        with self._lock:
+            self.cost[stage] = self.cost.get(stage, 0.) + cost
+            self.count[stage] = self.count.get(stage, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return ', '.join(['{}: {:.2f}s/{}'.format(stage, self.cost[stage], self.count[stage])
+                              for stage in sorted(self.cost.keys())])
+
+
+class ImagePrefetcher(object):
+    """
+    load images ahead of the consumer with a pool of threads.
+    Iterating yields (img_path, load_fn(img_path)) in completion order, at most
+    `prefetch` loaded images wait in the queue.
+    """
+
+    def __init__(self, img_paths, load_fn, num_threads=2, prefetch=4, timer=None):
+        self.load_fn = load_fn
+        self.timer = timer if timer is not None else StageTimer()
+        self._paths = iter(img_paths)
+        self._paths_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max(prefetch, 1))
+        self._num_threads = max(num_threads, 1)
+        self._threads = [threading.Thread(target=self._load_loop) for _ in range(self._num_threads)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _next_path(self):
+        with self._paths_lock:
+            return next(self._paths, None)
+
+    def _load_loop(self):
+        while True:
+            img_path = self._next_path()
+            if img_path is None:
+                break
+            try:
+                with self.timer.time('load'):
+                    item = (img_path, self.load_fn(img_path), None)
+            except Exception as e:
+                item = (img_path, None, e)
+            self._queue.put(item)
+        self._queue.put(None)
+
+    def __iter__(self):
+        finished = 0
+        while finished < self._num_threads:
+            with self.timer.time('wait'):
+                item = self._queue.get()
+            if item is None:
+                finished += 1
+                continue
+            img_path, data, error = item
+            if error is not None:
+                raise RuntimeError('failed to load {}: {}'.format(img_path, error))
+            yield img_path, data
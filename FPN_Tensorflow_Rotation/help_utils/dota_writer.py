@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import numpy as np
+
+
+class RunManifest(object):
+    """
+    append-only JSON-lines log of the finished images of a test run, one line per image:
+        {"image": "P0001.png", "offsets": {"plane": [start, end], ...}}
+    with the byte range of its detections in each Task<n>_<class>.txt file.
+    Lookups are set-backed, and a torn last line left by a crash is dropped on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.ends = {}
+
+        valid_len = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as fr:
+                for line in fr:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    valid_len += len(line)
+                    self.done.add(record['image'])
+                    for name, (_, end) in record['offsets'].items():
+                        self.ends[name] = max(self.ends.get(name, 0), end)
+            if valid_len != os.path.getsize(path):
+                with open(path, 'ab') as fw:
+                    fw.truncate(valid_len)
+
+    def __contains__(self, img_name):
+        return img_name in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def append(self, records):
+        """
+        :param records: list of {"image": name, "offsets": {class name: [start, end]}}
+        """
+        if not records:
+            return
+        with open(self.path, 'ab') as fw:
+            fw.write(''.join([json.dumps(record, sort_keys=True) + '\n' for record in records]).encode('utf-8'))
+            fw.flush()
+            os.fsync(fw.fileno())
+        for record in records:
+            self.done.add(record['image'])
+            for name, (_, end) in record['offsets'].items():
+                self.ends[name] = max(self.ends.get(name, 0), end)
+
+
+class DotaResultWriter(object):
+    """
+    long-lived writer of the DOTA submission files (Task1_<class>.txt).
+    Per-class files stay open for the whole run, the detections of one image are
+    formatted with one string operation per class, and the files are flushed every
+    `flush_every` images before the images are committed to the RunManifest.
+    On resume every class file is truncated back to the end of its last committed
+    detections, so results of images that were not committed are never duplicated.
+    """
+
+    def __init__(self, save_dir, class_names, progress_file, flush_every=20,
+                 task='Task1', buffer_size=1 << 20):
+        """
+        :param save_dir: directory of the Task1_<class>.txt files
+        :param class_names: dict of label -> class name, 'back_ground' is skipped
+        :param progress_file: path of the RunManifest of this run
+        :param flush_every: number of images between two flushes
+        """
+        self.manifest = RunManifest(progress_file)
+        self.flush_every = max(flush_every, 1)
+        self.class_names = dict([(label, name) for label, name in class_names.items() if name != 'back_ground'])
+
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self._handles = {}
+        for label, name in self.class_names.items():
+            handle = open(os.path.join(save_dir, '%s_%s.txt' % (task, name)), 'ab', buffer_size)
+            handle.truncate(self.manifest.ends.get(name, 0))
+            handle.seek(0, os.SEEK_END)
+            self._handles[label] = handle
+        self._pending = []
+
+    def write(self, img_name, boxes, scores, labels):
+        """
+        :param img_name: image file name, the extension is dropped in the submission
+        :param boxes: [N, 8] quadrilaterals
+        :param scores: [N, ]
+        :param labels: [N, ]
+        """
+        img_id = img_name.split('.')[0].replace('%', '%%')
+        boxes = np.reshape(np.asarray(boxes, dtype=np.float64), [-1, 8])
+        scores = np.asarray(scores, dtype=np.float64).reshape([-1])
+        labels = np.asarray(labels).reshape([-1])
+
+        rows = np.concatenate([scores[:, np.newaxis], boxes], axis=1)
+        line_fmt = img_id + ' %.3f' + ' %.1f' * 8 + '\n'
+        offsets = {}
+        for label in np.unique(labels):
+            class_rows = rows[labels == label]
+            handle = self._handles[label]
+            start = handle.tell()
+            handle.write(((line_fmt * class_rows.shape[0]) % tuple(class_rows.ravel())).encode('utf-8'))
+            offsets[self.class_names[label]] = [start, handle.tell()]
+
+        self._pending.append({'image': img_name, 'offsets': offsets})
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        for handle in self._handles.values():
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        self.manifest.append(self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        for handle in self._handles.values():
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -9,11 +9,121 @@ import numpy as np
 import tensorflow as tf
 
 
+def rbox_corners(boxes):
+    """
+    vectorized cv2.boxPoints
+    :param boxes: [N, 5], format [x_c, y_c, w, h, theta], theta in degree
+    :return: [N, 4, 2], corners in counter-clockwise order
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape([-1, np.shape(boxes)[-1]])
+    x_c, y_c, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    theta = boxes[:, 4] * np.pi / 180.
+
+    b = np.cos(theta) * 0.5
+    a = np.sin(theta) * 0.5
+
+    x0 = x_c - a * h - b * w
+    y0 = y_c + b * h - a * w
+    x1 = x_c + a * h - b * w
+    y1 = y_c - b * h - a * w
+    x2 = 2 * x_c - x0
+    y2 = 2 * y_c - y0
+    x3 = 2 * x_c - x1
+    y3 = 2 * y_c - y1
+
+    return np.stack([np.stack([x0, x1, x2, x3], axis=1),
+                     np.stack([y0, y1, y2, y3], axis=1)], axis=2)
+
+
+def min_area_rect(points):
+    """
+    vectorized cv2.minAreaRect with the OpenCV 3.x convention: theta in [-90, 0),
+    w is the side along theta
+    :param points: [N, K, 2]
+    :return: [N, 5], format [x_c, y_c, w, h, theta]
+    """
+    points = np.asarray(points, dtype=np.float64)
+    px, py = points[:, :, 0].T, points[:, :, 1].T  # [K, N]
+
+    # one side of the minimum area rectangle is collinear with a hull edge,
+    # and every hull edge is the segment between some pair of points
+    first, second = np.triu_indices(points.shape[1], k=1)
+    ux, uy = px[second] - px[first], py[second] - py[first]  # [E, N]
+    length = np.sqrt(ux ** 2 + uy ** 2)
+    degenerate = length == 0
+    length[degenerate] = 1.
+    ux, uy = np.where(degenerate, 1., ux / length), uy / length
+
+    u_min = v_min = np.inf
+    u_max = v_max = -np.inf
+    for k in range(px.shape[0]):
+        proj_u = ux * px[k] + uy * py[k]  # [E, N]
+        proj_v = -uy * px[k] + ux * py[k]
+        u_min, u_max = np.minimum(u_min, proj_u), np.maximum(u_max, proj_u)
+        v_min, v_max = np.minimum(v_min, proj_v), np.maximum(v_max, proj_v)
+
+    best = np.argmin((u_max - u_min) * (v_max - v_min), axis=0)[None, :]
+    ux, uy, u_min, u_max, v_min, v_max = [np.take_along_axis(x, best, axis=0)[0]
+                                          for x in [ux, uy, u_min, u_max, v_min, v_max]]
+
+    u_c, v_c = (u_min + u_max) / 2., (v_min + v_max) / 2.
+    x_c = ux * u_c - uy * v_c
+    y_c = uy * u_c + ux * v_c
+
+    # orientation of the u side in [-90, 90). If it falls in [0, 90), the v side is in [-90, 0)
+    theta = np.arctan2(uy, ux) * 180. / np.pi
+    theta = np.mod(theta + 90., 180.) - 90.
+    u_side = theta < 0
+    w = np.where(u_side, u_max - u_min, v_max - v_min)
+    h = np.where(u_side, v_max - v_min, u_max - u_min)
+    theta = np.where(u_side, theta, theta - 90.)
+
+    return np.stack([x_c, y_c, w, h, theta], axis=1)
+
+
 def forward_convert(coordinate, with_label=True):
     """
     :param coordinate: format [x_c, y_c, w, h, theta]
     :return: format [x1, y1, x2, y2, x3, y3, x4, y4]
     """
+    coordinate = np.asarray(coordinate, dtype=np.float32)
+    num = coordinate.shape[0]
+    if coordinate.size == 0:
+        return np.zeros([0, 9 if with_label else 8], dtype=np.float32)
+    coordinate = coordinate.reshape([num, -1])
+
+    boxes = rbox_corners(coordinate[:, :5]).reshape([num, 8])
+    if with_label:
+        boxes = np.concatenate([boxes, coordinate[:, -1:]], axis=1)
+
+    return np.array(boxes, dtype=np.float32)
+
+
+def backward_convert(coordinate, with_label=True):
+    """
+    :param coordinate: format [x1, y1, x2, y2, x3, y3, x4, y4, (label)]
+    :param with_label: default True
+    :return: format [x_c, y_c, w, h, theta, (label)]
+    """
+    coordinate = np.asarray(coordinate, dtype=np.float32)
+    num = coordinate.shape[0]
+    if coordinate.size == 0:
+        return np.zeros([0, 6 if with_label else 5], dtype=np.float32)
+    coordinate = coordinate.reshape([num, -1])
+
+    # same integer truncation as the np.int0 cast fed to cv2.minAreaRect
+    points = np.trunc(coordinate[:, :8]).reshape([num, 4, 2])
+    boxes = min_area_rect(points)
+    if with_label:
+        boxes = np.concatenate([boxes, coordinate[:, -1:]], axis=1)
+
+    return np.array(boxes, dtype=np.float32)
+
+
+def forward_convert_cv2(coordinate, with_label=True):
+    """
+    reference implementation with one cv2.boxPoints call per box, kept for parity checks
+    """
 
     boxes = []
     if with_label:
@@ -30,30 +140,25 @@ def forward_convert(coordinate, with_label=True):
     return np.array(boxes, dtype=np.float32)
 
 
-def backward_convert(coordinate, with_label=True):
+def backward_convert_cv2(coordinate, with_label=True):
     """
-    :param coordinate: format [x1, y1, x2, y2, x3, y3, x4, y4, (label)]
-    :param with_label: default True
-    :return: format [x_c, y_c, w, h, theta, (label)]
+    reference implementation with one cv2.minAreaRect call per box, kept for parity checks.
+    OpenCV >= 4.5.1 reports theta in (0, 90], it is mapped back to [-90, 0) here
     """
 
     boxes = []
-    if with_label:
-        for rect in coordinate:
-            box = np.int0(rect[:-1])
-            box = box.reshape([4, 2])
-            rect1 = cv2.minAreaRect(box)
-
-            x, y, w, h, theta = rect1[0][0], rect1[0][1], rect1[1][0], rect1[1][1], rect1[2]
+    for rect in coordinate:
+        box = np.array(rect[:8], np.int32).reshape([4, 2])
+        rect1 = cv2.minAreaRect(box)
+
+        x, y, w, h, theta = rect1[0][0], rect1[0][1], rect1[1][0], rect1[1][1], rect1[2]
+        if theta >= 90:
+            theta -= 180
+        elif theta > 0:
+            w, h, theta = h, w, theta - 90
+        if with_label:
             boxes.append([x, y, w, h, theta, rect[-1]])
-
-    else:
-        for rect in coordinate:
-            box = np.int0(rect)
-            box = box.reshape([4, 2])
-            rect1 = cv2.minAreaRect(box)
-
-            x, y, w, h, theta = rect1[0][0], rect1[0][1], rect1[1][0], rect1[1][1], rect1[2]
+        else:
             boxes.append([x, y, w, h, theta])
 
     return np.array(boxes, dtype=np.float32)
@@ -234,29 +339,45 @@ def coordinate_present_convert(coords, mode=1):
 
 
 if __name__ == '__main__':
+    import time
+
     coord = np.array([[150, 150, 50, 100, -90, 1],
                       [150, 150, 100, 50, -90, 1],
                       [150, 150, 50, 100, -45, 1],
                       [150, 150, 100, 50, -45, 1]])
 
-    coord1 = np.array([[150, 150, 100, 50, 0],
-                      [150, 150, 100, 50, -90],
-                      [150, 150, 100, 50, 45],
-                      [150, 150, 100, 50, -45]])
-
     coord2 = forward_convert(coord)
-    # coord3 = forward_convert(coord1, mode=-1)
     print(coord2)
-    # print(coord3-coord2)
-    # coord_label = np.array([[167., 203., 96., 132., 132., 96., 203., 167., 1.]])
-    #
-    # coord4 = back_forward_convert(coord_label, mode=1)
-    # coord5 = back_forward_convert(coord_label)
-
-    # print(coord4)
-    # print(coord5)
-
-    # coord3 = coordinate_present_convert(coord, -1)
-    # print(coord3)
-    # coord4 = coordinate_present_convert(coord3, mode=1)
-    # print(coord4)
\ No newline at end of file
+    print(backward_convert(coord2))
+
+    # parity with cv2
+    np.random.seed(0)
+    num = 100000
+    rboxes = np.zeros([num, 6], dtype=np.float32)
+    rboxes[:, :2] = np.random.uniform(0, 1000, [num, 2])
+    rboxes[:, 2:4] = np.random.uniform(2, 300, [num, 2])
+    rboxes[:, 4] = np.random.uniform(-90, 0, [num])
+    rboxes[:, 5] = np.random.randint(1, 16, [num])
+
+    start = time.time()
+    quads = forward_convert(rboxes)
+    forward_cost = time.time() - start
+    start = time.time()
+    quads_cv2 = forward_convert_cv2(rboxes)
+    forward_cost_cv2 = time.time() - start
+    print('forward_convert: max diff {:.5f}, {:.3f}s vs cv2 {:.3f}s'.format(
+        np.abs(quads - quads_cv2).max(), forward_cost, forward_cost_cv2))
+
+    start = time.time()
+    rects = backward_convert(quads)
+    backward_cost = time.time() - start
+    start = time.time()
+    rects_cv2 = backward_convert_cv2(quads)
+    backward_cost_cv2 = time.time() - start
+    # integer corners often admit several minimum area rectangles (equal area, different
+    # sides), cv2 and the closed form may pick different ones there
+    area_diff = np.abs(rects[:, 2] * rects[:, 3] - rects_cv2[:, 2] * rects_cv2[:, 3]) / \
+                np.maximum(rects_cv2[:, 2] * rects_cv2[:, 3], 1.)
+    same_rect = np.all(np.abs(rects[:, :5] - rects_cv2[:, :5]) < 0.01, axis=1)
+    print('backward_convert: max relative area diff {:.2e}, same rectangle {:.2%}, {:.3f}s vs cv2 {:.3f}s'.format(
+        area_diff.max(), np.mean(same_rect), backward_cost, backward_cost_cv2))
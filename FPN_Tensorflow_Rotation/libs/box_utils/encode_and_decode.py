@@ -159,4 +159,38 @@ def encode_boxes_rotate(unencode_boxes, reference_boxes, scale_factors=None):
         t_w *= scale_factors[2]
         t_h *= scale_factors[3]
         t_theta *= scale_factors[4]
-    return np.transpose(np.stack([t_xcenter, t_ycenter, t_w, t_h, t_theta]))
\ No newline at end of file
+    return np.transpose(np.stack([t_xcenter, t_ycenter, t_w, t_h, t_theta]))
+
+
+def encode_boxes_rotate_tf(unencode_boxes, reference_boxes, scale_factors=None):
+    '''
+    encode_boxes_rotate in the graph
+    :param unencode_boxes: [N, 5]
+    :param reference_boxes: [N, 4]
+    :return: encode_boxes [N, 5]
+    '''
+    x_center, y_center, w, h, theta = tf.unstack(unencode_boxes, axis=1)
+    reference_xmin, reference_ymin, reference_xmax, reference_ymax = tf.unstack(reference_boxes, axis=1)
+    reference_x_center = (reference_xmin + reference_xmax) / 2.
+    reference_y_center = (reference_ymin + reference_ymax) / 2.
+    # w and h exchanged as in encode_boxes_rotate
+    reference_h = reference_xmax - reference_xmin
+    reference_w = reference_ymax - reference_ymin
+
+    reference_theta = -90.
+    reference_w += 1e-8
+    reference_h += 1e-8
+    w += 1e-8
+    h += 1e-8  # to avoid NaN in division and log below
+    t_xcenter = (x_center - reference_x_center) / reference_w
+    t_ycenter = (y_center - reference_y_center) / reference_h
+    t_w = tf.log(w / reference_w)
+    t_h = tf.log(h / reference_h)
+    t_theta = (theta - reference_theta) * np.pi / 180
+    if scale_factors:
+        t_xcenter *= scale_factors[0]
+        t_ycenter *= scale_factors[1]
+        t_w *= scale_factors[2]
+        t_h *= scale_factors[3]
+        t_theta *= scale_factors[4]
+    return tf.transpose(tf.stack([t_xcenter, t_ycenter, t_w, t_h, t_theta]))
@@ -61,6 +61,29 @@ def iou_calculate1(boxes_1, boxes_2):
     return iou
 
 
+def bbox_overlaps_tf(boxes, query_boxes):
+    """
+    cython_bbox.bbox_overlaps in the graph: widths and heights are +1, computed in float64
+    so that the thresholds see exactly the same values
+    :param boxes: [N, 4]
+    :param query_boxes: [K, 4]
+    :return: [N, K] float64
+    """
+    with tf.name_scope('bbox_overlaps'):
+        boxes = tf.cast(boxes, tf.float64)
+        query_boxes = tf.cast(query_boxes, tf.float64)
+        xmin_1, ymin_1, xmax_1, ymax_1 = tf.split(boxes, 4, axis=1)  # [N, 1]
+        xmin_2, ymin_2, xmax_2, ymax_2 = tf.unstack(query_boxes, axis=1)  # [K, ]
+
+        box_area = (xmax_2 - xmin_2 + 1) * (ymax_2 - ymin_2 + 1)
+        iw = tf.minimum(xmax_1, xmax_2) - tf.maximum(xmin_1, xmin_2) + 1
+        ih = tf.minimum(ymax_1, ymax_2) - tf.maximum(ymin_1, ymin_2) + 1
+        ua = (xmax_1 - xmin_1 + 1) * (ymax_1 - ymin_1 + 1) + box_area - iw * ih
+
+        overlaps = iw * ih / ua
+        return tf.where(tf.logical_and(iw > 0, ih > 0), overlaps, tf.zeros_like(overlaps))
+
+
 if __name__ == '__main__':
     import os
     os.environ["CUDA_VISIBLE_DEVICES"] = '13'
@@ -8,7 +8,6 @@ import time
 import tensorflow as tf
 from libs.box_utils.coordinate_convert import *
 from libs.box_utils.rbbox_overlaps import rbbx_overlaps
-from libs.box_utils.iou_cpu import get_iou_matrix
 
 
 def iou_rotate_calculate(boxes1, boxes2, use_gpu=True, gpu_id=0):
@@ -27,7 +26,7 @@ def iou_rotate_calculate(boxes1, boxes2, use_gpu=True, gpu_id=0):
                                 inp=[boxes1, boxes2, gpu_id],
                                 Tout=tf.float32)
     else:
-        iou_matrix = tf.py_func(get_iou_matrix, inp=[boxes1, boxes2],
+        iou_matrix = tf.py_func(iou_rotate_cpu, inp=[boxes1, boxes2],
                                 Tout=tf.float32)
 
     iou_matrix = tf.reshape(iou_matrix, [tf.shape(boxes1)[0], tf.shape(boxes2)[0]])
@@ -35,48 +34,242 @@ def iou_rotate_calculate(boxes1, boxes2, use_gpu=True, gpu_id=0):
     return iou_matrix
 
 
+def _cross(v1, v2):
+    return v1[..., 0] * v2[..., 1] - v1[..., 1] * v2[..., 0]
+
+
+def _points_in_quads(points, quads, eps=1e-6):
+    """
+    :param points: [P, K, 2]
+    :param quads: [P, 4, 2], convex and counter-clockwise
+    :return: [P, K] bool
+    """
+    start = quads[:, None, :, :]  # [P, 1, 4, 2]
+    edge = np.roll(quads, -1, axis=1)[:, None, :, :] - start
+    edge_len = np.sqrt(np.sum(edge ** 2, axis=-1))
+    dist = _cross(edge, points[:, :, None, :] - start)  # [P, K, 4]
+    # a zero-length edge has a zero cross product with every point, such a quad contains nothing
+    degenerate = np.any(edge_len <= eps, axis=2)  # [P, 1]
+    return np.logical_and(np.all(dist >= -eps * np.maximum(edge_len, 1.), axis=2), ~degenerate)
+
+
+def rotate_intersection_area(corners1, corners2):
+    """
+    intersection area of paired convex quadrilaterals
+    :param corners1: [P, 4, 2], counter-clockwise
+    :param corners2: [P, 4, 2], counter-clockwise
+    :return: [P, ]
+    """
+    num = corners1.shape[0]
+    if num == 0:
+        return np.zeros([0], dtype=np.float64)
+
+    # 1. vertices of one box that lie inside the other
+    in_2 = _points_in_quads(corners1, corners2)
+    in_1 = _points_in_quads(corners2, corners1)
+
+    # 2. intersections of all 4x4 edge pairs
+    d1 = (np.roll(corners1, -1, axis=1) - corners1)[:, :, None, :]  # [P, 4, 1, 2]
+    d2 = (np.roll(corners2, -1, axis=1) - corners2)[:, None, :, :]  # [P, 1, 4, 2]
+    diff = corners2[:, None, :, :] - corners1[:, :, None, :]  # [P, 4, 4, 2]
+    denom = _cross(d1, d2)
+    not_parallel = np.abs(denom) > 1e-12
+    denom = np.where(not_parallel, denom, 1.)
+    t = _cross(diff, d2) / denom
+    u = _cross(diff, d1) / denom
+    cross_valid = not_parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    cross_pts = corners1[:, :, None, :] + t[..., None] * d1
+
+    pts = np.concatenate([corners1, corners2, cross_pts.reshape([num, 16, 2])], axis=1)  # [P, 24, 2]
+    valid = np.concatenate([in_2, in_1, cross_valid.reshape([num, 16])], axis=1)
+    num_valid = np.sum(valid, axis=1)
+
+    # 3. sort the vertices of the (convex) intersection polygon by angle
+    center = np.sum(pts * valid[..., None], axis=1) / np.maximum(num_valid, 1)[:, None]
+    angle = np.arctan2(pts[..., 1] - center[:, None, 1], pts[..., 0] - center[:, None, 0])
+    angle = np.where(valid, angle, 4 * np.pi)
+    order = np.argsort(angle, axis=1)
+    pts = np.take_along_axis(pts, order[..., None], axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+
+    # invalid vertices collapse onto the first one, so they add nothing to the shoelace sum
+    pts = np.where(valid[..., None], pts, pts[:, :1, :])
+    area = 0.5 * np.abs(np.sum(_cross(pts, np.roll(pts, -1, axis=1)), axis=1))
+    area[num_valid < 3] = 0.
+
+    # a box with w == 0 or h == 0 intersects nothing, as with cv2
+    area1 = 0.5 * np.abs(np.sum(_cross(corners1, np.roll(corners1, -1, axis=1)), axis=1))
+    area2 = 0.5 * np.abs(np.sum(_cross(corners2, np.roll(corners2, -1, axis=1)), axis=1))
+    area[(area1 <= 1e-12) | (area2 <= 1e-12)] = 0.
+
+    return area
+
+
+def overlap_candidate_pairs(boxes_min, boxes_max, cell_size=None):
+    """
+    find all pairs (i, j), i < j, whose horizontal bounding rectangles overlap,
+    using a uniform grid so that only boxes sharing a cell are compared
+    :param boxes_min: [N, 2], (xmin, ymin) of the bounding rectangles
+    :param boxes_max: [N, 2], (xmax, ymax)
+    :param cell_size: grid cell side, default is twice the median box extent
+    :return: two int64 arrays (i, j)
+    """
+    num = boxes_min.shape[0]
+    if num < 2:
+        return np.zeros([0], np.int64), np.zeros([0], np.int64)
+
+    if cell_size is None:
+        cell_size = 2 * np.median(np.max(boxes_max - boxes_min, axis=1))
+    cell_size = max(float(cell_size), 1.)
+
+    origin = boxes_min.min(axis=0)
+    cell_min = np.floor((boxes_min - origin) / cell_size).astype(np.int64)
+    cell_max = np.floor((boxes_max - origin) / cell_size).astype(np.int64)
+    grid_w = cell_max[:, 0].max() + 1
+
+    # 1. register every box in all the cells its bounding rectangle covers
+    span = cell_max - cell_min + 1
+    count = span[:, 0] * span[:, 1]
+    box_ind = np.repeat(np.arange(num), count)
+    local = np.arange(box_ind.size) - np.repeat(np.cumsum(count) - count, count)
+    cell_x = cell_min[box_ind, 0] + local % span[box_ind, 0]
+    cell_y = cell_min[box_ind, 1] + local // span[box_ind, 0]
+    cell_id = cell_y * grid_w + cell_x
+
+    sort_ind = np.argsort(cell_id, kind='mergesort')
+    box_ind, cell_id = box_ind[sort_ind], cell_id[sort_ind]
+
+    # 2. pair every entry with all the entries of its cell
+    group_start = np.flatnonzero(np.concatenate([[True], cell_id[1:] != cell_id[:-1]]))
+    group_size = np.diff(np.append(group_start, cell_id.size))
+    entry_group = np.repeat(np.arange(group_start.size), group_size)
+    entry_size = group_size[entry_group]
+    first = np.repeat(np.arange(box_ind.size), entry_size)
+    offset = np.arange(first.size) - np.repeat(np.cumsum(entry_size) - entry_size, entry_size)
+    second = np.repeat(group_start[entry_group], entry_size) + offset
+
+    ii, jj = box_ind[first], box_ind[second]
+    valid = ii < jj
+    ii, jj, pair_cell = ii[valid], jj[valid], cell_id[first[valid]]
+
+    overlap = np.logical_and(np.all(boxes_min[ii] <= boxes_max[jj], axis=1),
+                             np.all(boxes_max[ii] >= boxes_min[jj], axis=1))
+    ii, jj, pair_cell = ii[overlap], jj[overlap], pair_cell[overlap]
+
+    # boxes sharing several cells meet several times, only report the pair in
+    # the cell holding the top-left corner of their overlap
+    ref_cell = np.floor((np.maximum(boxes_min[ii], boxes_min[jj]) - origin) / cell_size).astype(np.int64)
+    unique = ref_cell[:, 1] * grid_w + ref_cell[:, 0] == pair_cell
+    return ii[unique], jj[unique]
+
+
+def iou_rotate_cpu(boxes1, boxes2, chunk_size=2 ** 16):
+    """
+    vectorized rotated iou, drop-in for cv2.rotatedRectangleIntersection loops
+    :param boxes1: [N, 5], format [x_c, y_c, w, h, theta]
+    :param boxes2: [M, 5]
+    :param chunk_size: max number of box pairs clipped at once, bounds memory
+    :return: [N, M] iou matrix
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape([-1, np.shape(boxes1)[-1]])[:, :5]
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape([-1, np.shape(boxes2)[-1]])[:, :5]
+    corners1 = rbox_corners(boxes1)
+    corners2 = rbox_corners(boxes2)
+    area1 = boxes1[:, 2] * boxes1[:, 3]
+    area2 = boxes2[:, 2] * boxes2[:, 3]
+    return _convex_iou_matrix(corners1, area1, corners2, area2, chunk_size)
+
+
+def _convex_iou_matrix(corners1, area1, corners2, area2, chunk_size, dtype=np.float32):
+    num1, num2 = corners1.shape[0], corners2.shape[0]
+    ious = np.zeros([num1, num2], dtype=dtype)
+    if num1 == 0 or num2 == 0:
+        return ious
+
+    min1, max1 = corners1.min(axis=1), corners1.max(axis=1)
+    min2, max2 = corners2.min(axis=1), corners2.max(axis=1)
+
+    rows = max(1, chunk_size // num2)
+    for start in range(0, num1, rows):
+        end = min(start + rows, num1)
+        # only clip the pairs whose horizontal bounding rectangles overlap
+        overlap = np.logical_and(
+            np.all(min1[start:end, None, :] <= max2[None, :, :], axis=2),
+            np.all(max1[start:end, None, :] >= min2[None, :, :], axis=2))
+        ii, jj = np.nonzero(overlap)
+        if ii.size == 0:
+            continue
+        ii += start
+        inter = rotate_intersection_area(corners1[ii], corners2[jj])
+        union = area1[ii] + area2[jj] - inter
+        ious[ii, jj] = np.clip(inter / np.maximum(union, 1e-12), 0., 1.)
+
+    return ious
+
+
+def quad_corners(quads):
+    """
+    :param quads: [N, 8], x1, y1, ..., x4, y4 in clockwise or counter-clockwise order
+    :return: [N, 4, 2] counter-clockwise corners and [N, ] areas
+    """
+    corners = np.asarray(quads, dtype=np.float64).reshape([-1, 4, 2])
+    signed_area = 0.5 * np.sum(_cross(corners, np.roll(corners, -1, axis=1)), axis=1)
+    corners = np.where((signed_area < 0)[:, None, None], corners[:, ::-1, :], corners)
+    return corners, np.abs(signed_area)
+
+
+def quad_iou_cpu(quads1, quads2, chunk_size=2 ** 16):
+    """
+    iou of convex quadrilaterals, e.g. DOTA polygons, same kernel as iou_rotate_cpu
+    :param quads1: [N, 8]
+    :param quads2: [M, 8]
+    :return: [N, M] float64 iou matrix
+    """
+    corners1, area1 = quad_corners(np.reshape(quads1, [-1, np.shape(quads1)[-1]])[:, :8])
+    corners2, area2 = quad_corners(np.reshape(quads2, [-1, np.shape(quads2)[-1]])[:, :8])
+    return _convex_iou_matrix(corners1, area1, corners2, area2, chunk_size, dtype=np.float64)
+
+
 def iou_rotate_calculate1(boxes1, boxes2, use_gpu=True, gpu_id=0):
 
-    # start = time.time()
     if use_gpu:
         ious = rbbx_overlaps(boxes1, boxes2, gpu_id)
     else:
-        area1 = boxes1[:, 2] * boxes1[:, 3]
-        area2 = boxes2[:, 2] * boxes2[:, 3]
-        ious = []
-        for i, box1 in enumerate(boxes1):
-            temp_ious = []
-            r1 = ((box1[0], box1[1]), (box1[2], box1[3]), box1[4])
-            for j, box2 in enumerate(boxes2):
-                r2 = ((box2[0], box2[1]), (box2[2], box2[3]), box2[4])
-
-                int_pts = cv2.rotatedRectangleIntersection(r1, r2)[1]
-                if int_pts is not None:
-                    order_pts = cv2.convexHull(int_pts, returnPoints=True)
-
-                    int_area = cv2.contourArea(order_pts)
-
-                    inter = int_area * 1.0 / (area1[i] + area2[j] - int_area)
-                    temp_ious.append(inter)
-                else:
-                    temp_ious.append(0.0)
-            ious.append(temp_ious)
-
-    # print('{}s'.format(time.time() - start))
+        ious = iou_rotate_cpu(boxes1, boxes2)
 
     return np.array(ious, dtype=np.float32)
 
 
 def iou_rotate_calculate2(boxes1, boxes2):
+    """
+    iou of aligned pairs (boxes1[i], boxes2[i])
+    :return: [N, 1]
+    """
+    if boxes1.shape[0] == 0:
+        return np.array([], dtype=np.float32)
+
+    boxes1 = np.asarray(boxes1, dtype=np.float64)
+    boxes2 = np.asarray(boxes2, dtype=np.float64)
+    area1 = boxes1[:, 2] * boxes1[:, 3]
+    area2 = boxes2[:, 2] * boxes2[:, 3]
+    inter = rotate_intersection_area(rbox_corners(boxes1[:, :5]), rbox_corners(boxes2[:, :5]))
+    ious = np.clip(inter / np.maximum(area1 + area2 - inter, 1e-12), 0., 1.)
+
+    return np.reshape(ious, [-1, 1]).astype(np.float32)
+
+
+def iou_rotate_calculate_cv2(boxes1, boxes2):
+    """
+    reference implementation with one cv2 call per pair, kept for parity checks
+    """
+    area1 = boxes1[:, 2] * boxes1[:, 3]
+    area2 = boxes2[:, 2] * boxes2[:, 3]
     ious = []
-    if boxes1.shape[0] != 0:
-        area1 = boxes1[:, 2] * boxes1[:, 3]
-        area2 = boxes2[:, 2] * boxes2[:, 3]
-
-        for i in range(boxes1.shape[0]):
-            temp_ious = []
-            r1 = ((boxes1[i][0], boxes1[i][1]), (boxes1[i][2], boxes1[i][3]), boxes1[i][4])
-            r2 = ((boxes2[i][0], boxes2[i][1]), (boxes2[i][2], boxes2[i][3]), boxes2[i][4])
+    for i, box1 in enumerate(boxes1):
+        temp_ious = []
+        r1 = ((box1[0], box1[1]), (box1[2], box1[3]), box1[4])
+        for j, box2 in enumerate(boxes2):
+            r2 = ((box2[0], box2[1]), (box2[2], box2[3]), box2[4])
 
             int_pts = cv2.rotatedRectangleIntersection(r1, r2)[1]
             if int_pts is not None:
@@ -84,37 +277,46 @@ def iou_rotate_calculate2(boxes1, boxes2):
 
                 int_area = cv2.contourArea(order_pts)
 
-                inter = int_area * 1.0 / (area1[i] + area2[i] - int_area)
+                inter = int_area * 1.0 / (area1[i] + area2[j] - int_area)
                 temp_ious.append(inter)
             else:
                 temp_ious.append(0.0)
-            ious.append(temp_ious)
+        ious.append(temp_ious)
 
     return np.array(ious, dtype=np.float32)
 
 
+def _random_rboxes(num, img_size=1000, max_side=100):
+    boxes = np.zeros([num, 5], dtype=np.float32)
+    boxes[:, :2] = np.random.uniform(0, img_size, [num, 2])
+    boxes[:, 2:4] = np.random.uniform(2, max_side, [num, 2])
+    boxes[:, 4] = np.random.uniform(-90, 0, [num])
+    return boxes
+
+
 if __name__ == '__main__':
-    import os
-    # os.environ["CUDA_VISIBLE_DEVICES"] = '13'
     boxes1 = np.array([[50, 50, 10, 70, -45]], np.float32)
 
     boxes2 = np.array([[50, 50, 10, 70, -50]], np.float32)
 
     print(iou_rotate_calculate2(boxes1, boxes2))
 
-    # start = time.time()
-    # with tf.Session() as sess:
-    #     ious = iou_rotate_calculate1(boxes1, boxes2, use_gpu=False)
-    #     print(sess.run(ious))
-    #     print('{}s'.format(time.time() - start))
-
-    # start = time.time()
-    # for _ in range(10):
-    #     ious = rbbox_overlaps.rbbx_overlaps(boxes1, boxes2)
-    # print('{}s'.format(time.time() - start))
-    # print(ious)
-
-    # print(ovr)
-
-
-
+    # parity with the cv2 path
+    np.random.seed(0)
+    boxes1 = _random_rboxes(300, img_size=300)
+    boxes2 = np.concatenate([_random_rboxes(200, img_size=300), boxes1[:100]], axis=0)
+    diff = np.abs(iou_rotate_cpu(boxes1, boxes2) - iou_rotate_calculate_cv2(boxes1, boxes2))
+    print('max |iou_rotate_cpu - cv2|: {}'.format(diff.max()))
+    diff = np.abs(iou_rotate_calculate2(boxes1, boxes2[:300]) - iou_rotate_calculate_cv2(boxes1, boxes2[:300]).diagonal()[:, None])
+    print('max |iou_rotate_calculate2 - cv2|: {}'.format(diff.max()))
+
+    # micro-benchmark
+    for num1, num2 in [(1000, 1000), (10000, 100)]:
+        boxes1, boxes2 = _random_rboxes(num1), _random_rboxes(num2)
+        start = time.time()
+        iou_rotate_cpu(boxes1, boxes2)
+        vec_cost = time.time() - start
+        start = time.time()
+        iou_rotate_calculate_cv2(boxes1, boxes2)
+        cv2_cost = time.time() - start
+        print('{}x{}: iou_rotate_cpu {:.3f}s, cv2 {:.3f}s'.format(num1, num2, vec_cost, cv2_cost))
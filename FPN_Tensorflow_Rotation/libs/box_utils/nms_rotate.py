@@ -8,6 +8,7 @@ import numpy as np
 import cv2
 from libs.configs import cfgs
 import tensorflow as tf
+from libs.box_utils import iou_rotate
 from libs.box_utils.rotate_polygon_nms import rotate_gpu_nms
 
 
@@ -41,14 +42,102 @@ def nms_rotate(decode_boxes, scores, iou_threshold, max_output_size,
     return keep
 
 
-def nms_rotate_cpu(boxes, scores, iou_threshold, max_output_size):
+def nms_rotate_cpu(boxes, scores, iou_threshold, max_output_size, chunk_size=2 ** 16):
+    """
+    greedy rotated nms. Candidate pairs come from a grid index over the horizontal
+    bounding rectangles, and only those are clipped exactly (vectorized).
+    :param boxes: format [x_c, y_c, w, h, theta]
+    :param scores: scores of boxes
+    :param iou_threshold: iou threshold
+    :param max_output_size: max number of output
+    :return: the remaining index of boxes
+    """
+    labels = np.zeros([np.shape(scores)[0]], np.int64)
+    return batched_nms_rotate(boxes, scores, labels, iou_threshold, max_output_size, chunk_size)
+
+
+def batched_nms_rotate(boxes, scores, labels, thresholds_per_class, max_output_size=5000, chunk_size=2 ** 16):
+    """
+    multi-class rotated nms in a single pass. Each class is suppressed independently:
+    the classes are shifted apart before building the grid index, so boxes of
+    different classes never become candidate pairs.
+    :param boxes: format [x_c, y_c, w, h, theta]
+    :param scores: scores of boxes
+    :param labels: int class labels of boxes
+    :param thresholds_per_class: iou threshold, a float or a dict {label: threshold}
+    :param max_output_size: max number of output per class
+    :return: the remaining index of boxes, ordered by score
+    """
+    scores = np.asarray(scores).reshape([-1])
+    labels = np.asarray(labels).reshape([-1]).astype(np.int64)
+    num = scores.shape[0]
+    if num == 0 or max_output_size <= 0:
+        return np.zeros([0], np.int64)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape([num, -1])[:, :5]
+
+    if isinstance(thresholds_per_class, dict):
+        threshold = np.zeros([max(labels.max(), max(thresholds_per_class.keys())) + 1])
+        for label, thres in thresholds_per_class.items():
+            threshold[label] = thres
+        missing = set(np.unique(labels)) - set(thresholds_per_class.keys())
+        assert len(missing) == 0, 'no iou threshold for labels {}'.format(sorted(missing))
+    else:
+        threshold = np.full([labels.max() + 1], thresholds_per_class, dtype=np.float64)
+
+    order = scores.argsort(kind='mergesort')[::-1]
+    rank = np.empty([num], np.int64)
+    rank[order] = np.arange(num)
+
+    corners = iou_rotate.rbox_corners(boxes)
+    area = boxes[:, 2] * boxes[:, 3]
+    boxes_min, boxes_max = corners.min(axis=1), corners.max(axis=1)
+    class_offset = (boxes_max[:, 0].max() - boxes_min[:, 0].min() + 1) * (labels - labels.min())
+    boxes_min[:, 0] += class_offset
+    boxes_max[:, 0] += class_offset
+    ii, jj = iou_rotate.overlap_candidate_pairs(boxes_min, boxes_max)
+
+    # keep only the pairs that would suppress, directed from the higher score to the lower one
+    suppress_src, suppress_dst = [np.zeros([0], np.int64)], [np.zeros([0], np.int64)]
+    for start in range(0, ii.size, chunk_size):
+        i, j = ii[start:start + chunk_size], jj[start:start + chunk_size]
+        inter = iou_rotate.rotate_intersection_area(corners[i], corners[j])
+        iou = np.clip(inter / (area[i] + area[j] - inter + cfgs.EPSILON), 0., 1.)
+        hit = iou >= threshold[labels[i]]
+        i, j = i[hit], j[hit]
+        i_first = rank[i] < rank[j]
+        suppress_src.append(np.where(i_first, i, j))
+        suppress_dst.append(np.where(i_first, j, i))
+    suppress_src = np.concatenate(suppress_src)
+    suppress_dst = np.concatenate(suppress_dst)
+
+    sort_ind = np.argsort(suppress_src, kind='mergesort')
+    suppress_src, suppress_dst = suppress_src[sort_ind], suppress_dst[sort_ind]
+    bounds = np.searchsorted(suppress_src, np.arange(num + 1))
+
+    keep = []
+    keep_per_class = np.zeros([labels.max() + 1], np.int64)
+    suppressed = np.zeros([num], dtype=np.bool_)
+    for i in order:
+        if suppressed[i] or keep_per_class[labels[i]] >= max_output_size:
+            continue
+        keep.append(i)
+        keep_per_class[labels[i]] += 1
+        suppressed[suppress_dst[bounds[i]:bounds[i + 1]]] = True
+
+    return np.array(keep, np.int64)
+
+
+def nms_rotate_cpu_cv2(boxes, scores, iou_threshold, max_output_size):
+    """
+    reference implementation with one cv2 call per pair, kept for parity checks
+    """
 
     keep = []
 
     order = scores.argsort()[::-1]
     num = boxes.shape[0]
 
-    suppressed = np.zeros((num), dtype=np.int)
+    suppressed = np.zeros((num), dtype=np.int64)
 
     for _i in range(num):
         if len(keep) >= max_output_size:
@@ -62,7 +151,7 @@ def nms_rotate_cpu(boxes, scores, iou_threshold, max_output_size):
         area_r1 = boxes[i, 2] * boxes[i, 3]
         for _j in range(_i + 1, num):
             j = order[_j]
-            if suppressed[i] == 1:
+            if suppressed[j] == 1:
                 continue
             r2 = ((boxes[j, 0], boxes[j, 1]), (boxes[j, 2], boxes[j, 3]), boxes[j, 4])
             area_r2 = boxes[j, 2] * boxes[j, 3]
@@ -83,8 +172,6 @@ def nms_rotate_cpu(boxes, scores, iou_threshold, max_output_size):
                   cv2.error: /io/opencv/modules/imgproc/src/intersection.cpp:247:
                   error: (-215) intersection.size() <= 8 in function rotatedRectangleIntersection
                 """
-                # print(r1)
-                # print(r2)
                 inter = 0.9999
 
             if inter >= iou_threshold:
@@ -114,6 +201,8 @@ def nms_rotate_gpu(boxes_list, scores, iou_threshold, use_angle_condition=False,
 
 
 if __name__ == '__main__':
+    import time
+
     boxes = np.array([[50, 50, 100, 100, 0],
                       [60, 60, 100, 100, 0],
                       [50, 50, 100, 100, -45.],
@@ -121,10 +210,35 @@ if __name__ == '__main__':
 
     scores = np.array([0.99, 0.88, 0.66, 0.77])
 
-    keep = nms_rotate(tf.convert_to_tensor(boxes, dtype=tf.float32), tf.convert_to_tensor(scores, dtype=tf.float32),
-                      0.7, 5)
-
-    import os
-    os.environ["CUDA_VISIBLE_DEVICES"] = '0'
-    with tf.Session() as sess:
-        print(sess.run(keep))
+    print(nms_rotate_cpu(boxes, scores, 0.7, 5))
+
+    # merged patch detections of a large DOTA scene: clusters of duplicates
+    np.random.seed(0)
+    centers = np.random.uniform(0, 4000, [2500, 2])
+    boxes = np.zeros([10000, 5])
+    boxes[:, :2] = np.repeat(centers, 4, axis=0) + np.random.normal(0, 3, [10000, 2])
+    boxes[:, 2:4] = np.repeat(np.random.uniform(10, 60, [2500, 2]), 4, axis=0)
+    boxes[:, 4] = np.repeat(np.random.uniform(-90, 0, [2500]), 4) + np.random.normal(0, 3, [10000])
+    scores = np.random.rand(10000)
+
+    start = time.time()
+    keep = nms_rotate_cpu(boxes, scores, 0.2, 5000)
+    print('nms_rotate_cpu: {} boxes -> {} in {:.3f}s'.format(len(boxes), len(keep), time.time() - start))
+    start = time.time()
+    keep_cv2 = nms_rotate_cpu_cv2(boxes[:2000], scores[:2000], 0.2, 5000)
+    cost_cv2 = time.time() - start
+    keep = nms_rotate_cpu(boxes[:2000], scores[:2000], 0.2, 5000)
+    print('nms_rotate_cpu_cv2: 2000 boxes in {:.3f}s, same keep: {}'.format(
+        cost_cv2, np.array_equal(np.sort(keep), np.sort(keep_cv2))))
+
+    labels = np.random.randint(1, 16, [10000])
+    thresholds = dict(zip(range(1, 16), np.random.choice([0.0001, 0.1, 0.2, 0.3], 15)))
+    start = time.time()
+    keep = batched_nms_rotate(boxes, scores, labels, thresholds, 5000)
+    cost = time.time() - start
+    keep_per_class = []
+    for label in range(1, 16):
+        index = np.where(labels == label)[0]
+        keep_per_class.extend(index[nms_rotate_cpu(boxes[index], scores[index], thresholds[label], 5000)])
+    print('batched_nms_rotate: 15 classes in {:.3f}s, same keep as per class: {}'.format(
+        cost, np.array_equal(np.sort(keep), np.sort(keep_per_class))))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from libs.box_utils.cython_utils.cython_bbox import bbox_overlaps
+
+# the anchors of make_anchors only change with the image size, so the bins of the last few sizes are reused
+_CACHE_SIZE = 8
+_cached_bins = []
+
+
+def bin_boxes(boxes):
+    """
+    group the boxes by (w, h) and lay every group out on the grid of its distinct x1 and y1,
+    one group per level and anchor shape for the anchors of make_anchors
+    :param boxes: [N, 4] float64, x1, y1, x2, y2
+    :return: list of (inds, table, xs, ys, max_w, max_h). table[iy, ix] is the index of the box at (xs[ix], ys[iy]),
+             -1 if there is none. Groups that do not fit a grid have table None and are computed densely.
+    """
+    widths = np.round((boxes[:, 2] - boxes[:, 0]) * 100).astype(np.int64)
+    heights = np.round((boxes[:, 3] - boxes[:, 1]) * 100).astype(np.int64)
+    heights = heights - heights.min() if len(heights) else heights
+    _, group_ids = np.unique(widths * (heights.max() + 1 if len(heights) else 1) + heights, return_inverse=True)
+    group_ids = group_ids.reshape(-1)
+
+    bins = []
+    for group_id in range(group_ids.max() + 1 if len(group_ids) else 0):
+        inds = np.where(group_ids == group_id)[0]
+        xs, ix = np.unique(boxes[inds, 0], return_inverse=True)
+        ys, iy = np.unique(boxes[inds, 1], return_inverse=True)
+        max_w = np.max(boxes[inds, 2] - boxes[inds, 0])
+        max_h = np.max(boxes[inds, 3] - boxes[inds, 1])
+
+        table = None
+        if len(xs) * len(ys) <= 4 * len(inds):
+            table = np.full((len(ys), len(xs)), -1, dtype=np.int64)
+            table[iy.reshape(-1), ix.reshape(-1)] = inds
+            if np.sum(table >= 0) != len(inds):
+                # two boxes at the same place
+                table = None
+        bins.append((inds, table, xs, ys, max_w, max_h))
+    return bins
+
+
+def cached_bin_boxes(boxes):
+    """
+    bin_boxes of the last _CACHE_SIZE distinct boxes, the towers call it concurrently through tf.py_func
+    """
+    global _cached_bins
+    cached_bins = _cached_bins
+    for cached_boxes, bins in cached_bins:
+        if np.array_equal(cached_boxes, boxes):
+            return bins
+    bins = bin_boxes(boxes)
+    _cached_bins = [(boxes, bins)] + cached_bins[:_CACHE_SIZE - 1]
+    return bins
+
+
+def _pair_overlaps(boxes, query_boxes, box_inds, query_inds):
+    """
+    the overlaps of bbox_overlaps for the given pairs only, same operations in the same order
+    :return: mask of the pairs that intersect, their overlaps
+    """
+    b = boxes[box_inds]
+    q = query_boxes[query_inds]
+    box_area = (q[:, 2] - q[:, 0] + 1) * (q[:, 3] - q[:, 1] + 1)
+    iw = np.minimum(b[:, 2], q[:, 2]) - np.maximum(b[:, 0], q[:, 0]) + 1
+    ih = np.minimum(b[:, 3], q[:, 3]) - np.maximum(b[:, 1], q[:, 1]) + 1
+    keep = (iw > 0) & (ih > 0)
+    iw, ih, b, box_area = iw[keep], ih[keep], b[keep], box_area[keep]
+    ua = (b[:, 2] - b[:, 0] + 1) * (b[:, 3] - b[:, 1] + 1) + box_area - iw * ih
+    return keep, iw * ih / ua
+
+
+def sparse_overlaps(boxes, query_boxes, bins=None):
+    """
+    the non zero entries of bbox_overlaps(boxes, query_boxes), only visiting the boxes of each group
+    whose grid cells can reach the query box
+    :param boxes: [N, 4] float64
+    :param query_boxes: [K, 4] float64
+    :param bins: bin_boxes(boxes), computed if None
+    :return: box_inds, query_inds, overlaps of the intersecting pairs
+    """
+    if bins is None:
+        bins = bin_boxes(boxes)
+
+    all_box_inds, all_query_inds, all_overlaps = [], [], []
+    for inds, table, xs, ys, max_w, max_h in bins:
+        if table is None:
+            overlaps = bbox_overlaps(np.ascontiguousarray(boxes[inds]), np.ascontiguousarray(query_boxes))
+            rows, query_inds = np.nonzero(overlaps)
+            all_box_inds.append(inds[rows])
+            all_query_inds.append(query_inds)
+            all_overlaps.append(overlaps[rows, query_inds])
+            continue
+
+        # a box can only intersect the query box if x2 > qx1 - 1 and x1 < qx2 + 1, one pixel of slack on both sides
+        x_lo = np.searchsorted(xs, query_boxes[:, 0] - max_w - 2, side='left')
+        x_hi = np.searchsorted(xs, query_boxes[:, 2] + 2, side='right')
+        y_lo = np.searchsorted(ys, query_boxes[:, 1] - max_h - 2, side='left')
+        y_hi = np.searchsorted(ys, query_boxes[:, 3] + 2, side='right')
+        nx = x_hi - x_lo
+        counts = nx * (y_hi - y_lo)
+        if counts.sum() == 0:
+            continue
+
+        query_inds = np.repeat(np.arange(len(query_boxes)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        box_inds = table[y_lo[query_inds] + offsets // nx[query_inds], x_lo[query_inds] + offsets % nx[query_inds]]
+        valid = box_inds >= 0
+        box_inds, query_inds = box_inds[valid], query_inds[valid]
+
+        keep, overlaps = _pair_overlaps(boxes, query_boxes, box_inds, query_inds)
+        all_box_inds.append(box_inds[keep])
+        all_query_inds.append(query_inds[keep])
+        all_overlaps.append(overlaps)
+
+    if not all_box_inds:
+        return np.zeros((0,), np.int64), np.zeros((0,), np.int64), np.zeros((0,), np.float64)
+    return np.concatenate(all_box_inds), np.concatenate(all_query_inds), np.concatenate(all_overlaps)
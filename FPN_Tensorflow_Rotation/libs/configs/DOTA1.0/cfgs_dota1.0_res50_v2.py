@@ -105,6 +105,19 @@ VERTICAL_FLIP = False
 HORIZONTAL_FLIP = True
 IMAGE_PYRAMID = False
 
+# tf.data input pipeline of next_batch, False falls back to the queue runners
+USE_TF_DATA = True
+NUM_PARALLEL_CALLS = 16
+SHUFFLE_BUFFER = 64
+PREFETCH_BATCHES = 2
+CACHE_DATASET = False  # keep the decoded images in memory, only for small datasets like HRSC2016
+# w / h boundaries of the aspect ratio buckets when BATCH_SIZE > 1, images are only batched with images
+# of the same bucket and short side. None pads any images together
+BUCKET_BOUNDARIES = [0.75, 1.33]
+# read the rotated and horizontal gtboxes stored by convert_data_to_tfrecord --gt_forms
+# instead of computing them in every training step
+PRECOMPUTED_GT = False
+
 # --------------------------------------------- Network_config
 INITIALIZER = tf.random_normal_initializer(mean=0.0, stddev=0.01)
 BBOX_INITIALIZER = tf.random_normal_initializer(mean=0.0, stddev=0.001)
@@ -127,6 +140,7 @@ KERNEL_SIZE = 3
 RPN_IOU_POSITIVE_THRESHOLD = 0.7
 RPN_IOU_NEGATIVE_THRESHOLD = 0.3
 TRAIN_RPN_CLOOBER_POSITIVES = False
+SPARSE_ANCHOR_TARGET = True  # only the iou of the anchors near each gt, same labels and targets
 
 RPN_MINIBATCH_SIZE = 512  # 256
 RPN_POSITIVE_RATE = 0.5
@@ -153,6 +167,7 @@ FAST_RCNN_MINIBATCH_SIZE = 512  # if is -1, that is train with OHEM
 FAST_RCNN_POSITIVE_RATE = 0.25
 
 ADD_GTBOXES_TO_TRAIN = False
+IN_GRAPH_PROPOSAL_TARGET = True  # sample the fast rcnn minibatch with tf ops instead of tf.py_func
 
 # -------------------------------------------mask config
 USE_SUPERVISED_MASK = False
@@ -14,6 +14,7 @@ import numpy as np
 import numpy.random as npr
 from libs.box_utils.cython_utils.cython_bbox import bbox_overlaps
 from libs.box_utils import encode_and_decode
+from libs.box_utils.sparse_overlaps import sparse_overlaps, cached_bin_boxes
 
 
 def anchor_target_layer(
@@ -46,16 +47,14 @@ def anchor_target_layer(
     labels.fill(-1)
 
     # overlaps between the anchors and the gt boxes
-    overlaps = bbox_overlaps(
-        np.ascontiguousarray(anchors, dtype=np.float),
-        np.ascontiguousarray(gt_boxes, dtype=np.float))
-
-    argmax_overlaps = overlaps.argmax(axis=1)
-    max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-    gt_argmax_overlaps = overlaps.argmax(axis=0)
-    gt_max_overlaps = overlaps[
-        gt_argmax_overlaps, np.arange(overlaps.shape[1])]
-    gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+    if cfgs.SPARSE_ANCHOR_TARGET:
+        argmax_overlaps, max_overlaps, gt_argmax_overlaps = _match_anchors_sparse(
+            np.ascontiguousarray(anchors, dtype=np.float),
+            np.ascontiguousarray(gt_boxes, dtype=np.float))
+    else:
+        argmax_overlaps, max_overlaps, gt_argmax_overlaps = _match_anchors_dense(
+            np.ascontiguousarray(anchors, dtype=np.float),
+            np.ascontiguousarray(gt_boxes, dtype=np.float))
 
     if not cfgs.TRAIN_RPN_CLOOBER_POSITIVES:
         labels[max_overlaps < cfgs.RPN_IOU_NEGATIVE_THRESHOLD] = 0
@@ -98,6 +97,54 @@ def anchor_target_layer(
     return rpn_labels, rpn_bbox_targets
 
 
+def _match_anchors_dense(anchors, gt_boxes):
+    """
+    :return: argmax_overlaps, max_overlaps of every anchor and the anchors that are the best match of a gt
+    """
+    overlaps = bbox_overlaps(anchors, gt_boxes)
+
+    argmax_overlaps = overlaps.argmax(axis=1)
+    max_overlaps = overlaps[np.arange(anchors.shape[0]), argmax_overlaps]
+    gt_argmax_overlaps = overlaps.argmax(axis=0)
+    gt_max_overlaps = overlaps[
+        gt_argmax_overlaps, np.arange(overlaps.shape[1])]
+    gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+    return argmax_overlaps, max_overlaps, gt_argmax_overlaps
+
+
+def _match_anchors_sparse(anchors, gt_boxes):
+    """
+    same result as _match_anchors_dense from the intersecting (anchor, gt) pairs only,
+    the [num_anchors, num_gt] matrix is never built
+    """
+    anchor_inds, gt_inds, overlaps = sparse_overlaps(anchors, gt_boxes, cached_bin_boxes(anchors))
+
+    # per anchor: largest overlap, lowest gt index on ties, like argmax. Anchors without any pair keep 0, 0
+    argmax_overlaps = np.zeros((anchors.shape[0],), dtype=np.int64)
+    max_overlaps = np.zeros((anchors.shape[0],), dtype=np.float64)
+    gt_max_overlaps = np.zeros((gt_boxes.shape[0],), dtype=np.float64)
+    if len(overlaps):
+        order = np.argsort(anchor_inds * gt_boxes.shape[0] + gt_inds)
+        anchor_inds, gt_inds, overlaps = anchor_inds[order], gt_inds[order], overlaps[order]
+        starts = np.flatnonzero(np.r_[True, anchor_inds[1:] != anchor_inds[:-1]])
+        segment_max = np.maximum.reduceat(overlaps, starts)
+        is_max = np.flatnonzero(overlaps == np.repeat(segment_max, np.diff(np.r_[starts, len(overlaps)])))
+        first = is_max[np.r_[True, anchor_inds[is_max][1:] != anchor_inds[is_max][:-1]]]
+        argmax_overlaps[anchor_inds[first]] = gt_inds[first]
+        max_overlaps[anchor_inds[first]] = overlaps[first]
+
+        order = np.argsort(gt_inds, kind='mergesort')
+        starts = np.flatnonzero(np.r_[True, gt_inds[order][1:] != gt_inds[order][:-1]])
+        gt_max_overlaps[gt_inds[order][starts]] = np.maximum.reduceat(overlaps[order], starts)
+
+    if np.any(gt_max_overlaps == 0):
+        # a gt that touches no anchor has 0 as its max, and every anchor equals it in the dense matrix
+        gt_argmax_overlaps = np.arange(anchors.shape[0])
+    else:
+        gt_argmax_overlaps = np.unique(anchor_inds[overlaps == gt_max_overlaps[gt_inds]])
+    return argmax_overlaps, max_overlaps, gt_argmax_overlaps
+
+
 def _unmap(data, count, inds, fill=0):
     """ Unmap a subset of item (data) back to the original set of items (of
     size count) """
@@ -10,8 +10,10 @@ from __future__ import print_function
 from libs.configs import cfgs
 import numpy as np
 import numpy.random as npr
+import tensorflow as tf
 
 from libs.box_utils import encode_and_decode
+from libs.box_utils.iou import bbox_overlaps_tf
 from libs.box_utils.cython_utils.cython_bbox import bbox_overlaps
 
 
@@ -57,11 +59,8 @@ def _get_bbox_regression_labels(bbox_target_data, num_classes):
     clss = bbox_target_data[:, 0]
     bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
     inds = np.where(clss > 0)[0]
-    for ind in inds:
-        cls = clss[ind]
-        start = int(4 * cls)
-        end = start + 4
-        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
+    cols = (4 * clss[inds]).astype(np.int64)[:, np.newaxis] + np.arange(4)
+    bbox_targets[inds[:, np.newaxis], cols] = bbox_target_data[inds, 1:]
 
     return bbox_targets
 
@@ -80,11 +79,8 @@ def _get_bbox_regression_labels_r(bbox_target_data, num_classes):
     clss = bbox_target_data[:, 0]
     bbox_targets = np.zeros((clss.size, 5 * num_classes), dtype=np.float32)
     inds = np.where(clss > 0)[0]
-    for ind in inds:
-        cls = clss[ind]
-        start = int(5 * cls)
-        end = start + 5
-        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
+    cols = (5 * clss[inds]).astype(np.int64)[:, np.newaxis] + np.arange(5)
+    bbox_targets[inds[:, np.newaxis], cols] = bbox_target_data[inds, 1:]
 
     return bbox_targets
 
@@ -186,3 +182,80 @@ def _sample_rois(all_rois, gt_boxes_h, gt_boxes_r, fg_rois_per_image,
     bbox_targets_r = \
         _get_bbox_regression_labels_r(bbox_target_data_r, num_classes)
     return labels, rois, bbox_targets_r
+
+
+def proposal_target_layer_tf(rpn_rois, gt_boxes_h, gt_boxes_r, seed=None):
+    """
+    proposal_target_layer in the graph, no tf.py_func round trip so that the towers run it concurrently.
+    Same rois, labels and targets for the same sampled rois, the sampling uses tf.random_shuffle.
+    Like the tf.py_func, the outputs are constants for the gradient.
+    :param rpn_rois: [N, 4] float32
+    :param gt_boxes_h: [M, 5] float32, x1, y1, x2, y2, label
+    :param gt_boxes_r: [M, 6] float32, x_c, y_c, w, h, theta, label
+    :param seed: op seed of the sampling
+    :return: rois [R, 4], labels [R, ], bbox_targets [R, 5 * (CLASS_NUM + 1)]
+    """
+    with tf.name_scope('proposal_target_layer'):
+        if cfgs.ADD_GTBOXES_TO_TRAIN:
+            all_rois = tf.concat([rpn_rois, gt_boxes_h[:, :-1]], axis=0)
+        else:
+            all_rois = rpn_rois
+
+        labels, rois, bbox_targets_r, _ = _sample_rois_tf(all_rois, gt_boxes_h, gt_boxes_r,
+                                                          cfgs.FAST_RCNN_MINIBATCH_SIZE, cfgs.CLASS_NUM + 1, seed)
+        # the targets are encoded against the rois: no gradient may flow back into the rpn, as with tf.py_func
+        return tf.stop_gradient(rois), tf.stop_gradient(labels), tf.stop_gradient(bbox_targets_r)
+
+
+def _get_bbox_regression_labels_r_tf(bbox_target_data, labels, num_classes):
+    """
+    _get_bbox_regression_labels_r in the graph, the targets of each foreground roi are scattered
+    into the 5 columns of its class
+    :param bbox_target_data: [N, 5]
+    :param labels: [N, ] float32
+    :return: [N, 5 * num_classes]
+    """
+    fg_inds = tf.reshape(tf.where(labels > 0), [-1])
+    rows = tf.tile(tf.expand_dims(fg_inds, 1), [1, 5])
+    cols = tf.expand_dims(tf.to_int64(tf.gather(labels, fg_inds)) * 5, 1) + tf.range(5, dtype=tf.int64)
+    return tf.scatter_nd(tf.stack([rows, cols], axis=2), tf.gather(bbox_target_data, fg_inds),
+                         shape=tf.to_int64(tf.stack([tf.shape(labels)[0], 5 * num_classes])))
+
+
+def _sample_rois_tf(all_rois, gt_boxes_h, gt_boxes_r, rois_per_image, num_classes, seed=None):
+    """
+    _sample_rois in the graph
+    :param rois_per_image: -1 keeps every foreground and background roi
+    :return: labels, rois, bbox_targets_r and the indices of the sampled rois in all_rois
+    """
+    overlaps = bbox_overlaps_tf(all_rois, gt_boxes_h[:, :-1])
+    gt_assignment = tf.argmax(overlaps, axis=1)
+    max_overlaps = tf.reduce_max(overlaps, axis=1)
+    labels = tf.gather(gt_boxes_h[:, -1], gt_assignment)
+
+    fg_inds = tf.reshape(tf.where(max_overlaps >= cfgs.FAST_RCNN_IOU_POSITIVE_THRESHOLD), [-1])
+    bg_inds = tf.reshape(tf.where(tf.logical_and(max_overlaps < cfgs.FAST_RCNN_IOU_POSITIVE_THRESHOLD,
+                                                 max_overlaps >= cfgs.FAST_RCNN_IOU_NEGATIVE_THRESHOLD)), [-1])
+
+    # sample without replacement: a shuffle, then the first ones
+    if rois_per_image == -1:
+        fg_rois_per_this_image = tf.size(fg_inds)
+        bg_rois_per_this_image = tf.size(bg_inds)
+    else:
+        fg_rois_per_image = int(np.round(cfgs.FAST_RCNN_POSITIVE_RATE * rois_per_image))
+        fg_rois_per_this_image = tf.minimum(fg_rois_per_image, tf.size(fg_inds))
+        bg_rois_per_this_image = tf.minimum(rois_per_image - fg_rois_per_this_image, tf.size(bg_inds))
+    fg_inds = tf.random_shuffle(fg_inds, seed=seed)[:fg_rois_per_this_image]
+    bg_inds = tf.random_shuffle(bg_inds, seed=None if seed is None else seed + 1)[:bg_rois_per_this_image]
+    keep_inds = tf.concat([fg_inds, bg_inds], axis=0)
+
+    # clamp labels for the background rois to 0
+    labels = tf.gather(labels, keep_inds) * tf.to_float(tf.range(tf.size(keep_inds)) < fg_rois_per_this_image)
+    rois = tf.gather(all_rois, keep_inds)
+
+    bbox_target_data_r = encode_and_decode.encode_boxes_rotate_tf(
+        unencode_boxes=tf.gather(gt_boxes_r, tf.gather(gt_assignment, keep_inds))[:, :-1],
+        reference_boxes=rois,
+        scale_factors=cfgs.ROI_SCALE_FACTORS)
+    bbox_targets_r = _get_bbox_regression_labels_r_tf(bbox_target_data_r, labels, num_classes)
+    return labels, rois, bbox_targets_r, keep_inds
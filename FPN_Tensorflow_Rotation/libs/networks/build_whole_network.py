@@ -16,7 +16,7 @@ from libs.losses import losses
 from libs.box_utils import show_box_in_tensor
 from libs.detection_oprations.proposal_opr import postprocess_rpn_proposals
 from libs.detection_oprations.anchor_target_layer_without_boxweight import anchor_target_layer
-from libs.detection_oprations.proposal_target_layer import proposal_target_layer
+from libs.detection_oprations.proposal_target_layer import proposal_target_layer, proposal_target_layer_tf
 from libs.box_utils import mask_utils
 from libs.label_name_dict.label_dict import *
 from libs.box_utils import nms_rotate
@@ -619,10 +619,14 @@ class DetectionNetwork(object):
             with tf.control_dependencies([fpn_labels]):
                 with tf.variable_scope('sample_RCNN_minibatch'):  # 在RPN输出的Proposal中筛选出用于Fast RCNN回归的小批量样本
                     # 对这些sample出来的minibatch，找到它们对应的gt target
-                    rois, labels, bbox_targets = \
-                        tf.py_func(proposal_target_layer,
-                                   [rois, gtboxes_batch, gtboxes_r_batch],
-                                   [tf.float32, tf.float32, tf.float32])
+                    if cfgs.IN_GRAPH_PROPOSAL_TARGET:
+                        rois, labels, bbox_targets = \
+                            proposal_target_layer_tf(rois, gtboxes_batch, gtboxes_r_batch)
+                    else:
+                        rois, labels, bbox_targets = \
+                            tf.py_func(proposal_target_layer,
+                                       [rois, gtboxes_batch, gtboxes_r_batch],
+                                       [tf.float32, tf.float32, tf.float32])
                     rois = tf.reshape(rois, [-1, 4])
                     labels = tf.to_int32(labels)
                     labels = tf.reshape(labels, [-1])
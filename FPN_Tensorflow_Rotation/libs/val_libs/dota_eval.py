@@ -0,0 +1,294 @@
+# -*- coding:utf-8 -*-
+# --------------------------------------------------------
+# DOTA Task1 (oriented) / Task2 (horizontal) evaluation of the
+# Task<n>_<class>.txt files written by tools/test_dota.py,
+# following the metric of the DOTA devkit (VOC07 11 point AP by default)
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+
+sys.path.append('../../')
+
+from libs.box_utils import iou_rotate
+from libs.val_libs.voc_eval_r import voc_ap, greedy_match
+
+
+def parse_dota_label(filename):
+  """
+  parse a DOTA labelTxt file, lines are 'x1 y1 x2 y2 x3 y3 x4 y4 class difficult',
+  the 'imagesource' and 'gsd' header lines are skipped
+  :return: class names [K, ], difficult [K, ] bool, polygons [K, 8]
+  """
+  names, difficult, polys = [], [], []
+  with open(filename, 'r') as f:
+    for line in f:
+      splitline = line.strip().split(' ')
+      if len(splitline) < 9:
+        continue
+      polys.append([float(x) for x in splitline[:8]])
+      names.append(splitline[8])
+      difficult.append(len(splitline) > 9 and splitline[9] == '1')
+  return names, np.array(difficult, np.bool_), np.array(polys, np.float64).reshape([-1, 8])
+
+
+def load_dota_gt(label_dir, imagenames):
+  """
+  :return: dict of class name -> {image name: {'poly': [K, 8], 'difficult': [K, ]}}
+  """
+  gt = {}
+  for imagename in imagenames:
+    names, difficult, polys = parse_dota_label(os.path.join(label_dir, imagename + '.txt'))
+    names = np.array(names)
+    for cls_name in np.unique(names):
+      keep = names == cls_name
+      gt.setdefault(cls_name, {})[imagename] = {'poly': polys[keep], 'difficult': difficult[keep]}
+  return gt
+
+
+def read_dota_detections(detfile):
+  """
+  stream a Task1 ('img score x1 y1 ... x4 y4') or Task2 ('img score xmin ymin xmax ymax') file
+  :return: image ids [N, ], scores [N, ], boxes [N, 8] or [N, 4]
+  """
+  image_ids, values = [], []
+  with open(detfile, 'r') as f:
+    for line in f:
+      splitline = line.strip().split(' ')
+      if len(splitline) < 6:
+        continue
+      image_ids.append(splitline[0])
+      values.append(splitline[1:])
+  values = np.array(values, np.float64).reshape([len(image_ids), -1])
+  return np.array(image_ids), values[:, 0], values[:, 1:]
+
+
+def hbb_iou(boxes1, boxes2):
+  """
+  horizontal iou with the +1 pixel convention of the DOTA devkit
+  :param boxes1: [N, 4], xmin, ymin, xmax, ymax
+  :param boxes2: [M, 4]
+  :return: [N, M]
+  """
+  ixmin = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+  iymin = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+  ixmax = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+  iymax = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+  inters = np.maximum(ixmax - ixmin + 1., 0.) * np.maximum(iymax - iymin + 1., 0.)
+  area1 = (boxes1[:, 2] - boxes1[:, 0] + 1.) * (boxes1[:, 3] - boxes1[:, 1] + 1.)
+  area2 = (boxes2[:, 2] - boxes2[:, 0] + 1.) * (boxes2[:, 3] - boxes2[:, 1] + 1.)
+  return inters / (area1[:, None] + area2[None, :] - inters)
+
+
+def poly_to_hbb(polys):
+  return np.concatenate([np.min(polys[:, 0::2], axis=1, keepdims=True), np.min(polys[:, 1::2], axis=1, keepdims=True),
+                         np.max(polys[:, 0::2], axis=1, keepdims=True), np.max(polys[:, 1::2], axis=1, keepdims=True)],
+                        axis=1)
+
+
+def dota_eval(detfile, class_gt, ovthreshs=(0.5,), use_07_metric=True, task=1):
+  """
+  AP of one class at several iou thresholds. The detections x gt overlaps of every image
+  are computed once, the greedy score ordered matching then runs for all thresholds together.
+  :param detfile: Task<n>_<class>.txt
+  :param class_gt: {image name: {'poly': [K, 8], 'difficult': [K, ]}} of this class, from load_dota_gt
+  :param ovthreshs: iou thresholds
+  :param task: 1 for oriented polygons, 2 for horizontal boxes
+  :return: list of (rec, prec, ap), one per threshold
+  """
+  ovthreshs = np.array(ovthreshs, np.float64)
+  num_thresh = ovthreshs.shape[0]
+  num_pos = sum([np.sum(~R['difficult']) for R in class_gt.values()])
+
+  image_ids, confidence, BB = read_dota_detections(detfile) if os.path.exists(detfile) else \
+      (np.zeros([0], str), np.zeros([0]), np.zeros([0, 8]))
+
+  nd = image_ids.shape[0]
+  tp = np.zeros([nd, num_thresh])
+  fp = np.zeros([nd, num_thresh])
+
+  if nd > 0:
+    # sort by confidence
+    sorted_ind = np.argsort(-confidence, kind='mergesort')
+    BB = BB[sorted_ind]
+    image_ids = image_ids[sorted_ind]
+
+    # group the detections by image, inside an image they stay in score order
+    group_ind = np.argsort(image_ids, kind='mergesort')
+    group_ids = image_ids[group_ind]
+    starts = np.flatnonzero(np.concatenate([[True], group_ids[1:] != group_ids[:-1]]))
+    ends = np.append(starts[1:], nd)
+
+    for start, end in zip(starts, ends):
+      det_inds = group_ind[start:end]
+      R = class_gt.get(group_ids[start])
+      if R is None or R['poly'].shape[0] == 0:
+        fp[det_inds] = 1.
+        continue
+
+      if task == 1:
+        overlaps = iou_rotate.quad_iou_cpu(BB[det_inds], R['poly'])
+      else:
+        overlaps = hbb_iou(BB[det_inds][:, :4], poly_to_hbb(R['poly']))
+      ovmaxs = np.max(overlaps, axis=1)
+      jmaxs = np.argmax(overlaps, axis=1)
+      tp[det_inds], fp[det_inds] = greedy_match(ovmaxs, jmaxs, R['difficult'], ovthreshs)
+
+  fp = np.cumsum(fp, axis=0)
+  tp = np.cumsum(tp, axis=0)
+  results = []
+  for t in range(num_thresh):
+    rec = tp[:, t] / max(float(num_pos), np.finfo(np.float64).eps)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp[:, t] / np.maximum(tp[:, t] + fp[:, t], np.finfo(np.float64).eps)
+    results.append((rec, prec, voc_ap(rec, prec, use_07_metric)))
+  return results
+
+
+def do_dota_eval(det_dir, label_dir, imagenames=None, ovthreshs=(0.5,), use_07_metric=True, task=1, classes=None):
+  """
+  evaluate the Task<n>_<class>.txt files of det_dir
+  :param imagenames: images to evaluate, default is every file of label_dir
+  :param classes: classes to evaluate, default is every class of the ground truth and of the
+                  Task<n>_<class>.txt files. A class without a file gets AP 0.
+  :return: dict of class name -> list of AP, one per threshold
+  """
+  if imagenames is None:
+    imagenames = sorted([os.path.splitext(name)[0] for name in os.listdir(label_dir) if name.endswith('.txt')])
+  gt = load_dota_gt(label_dir, imagenames)
+
+  if classes is None:
+    det_files = glob.glob(os.path.join(det_dir, 'Task%d_*.txt' % task))
+    det_classes = [os.path.basename(f)[len('Task%d_' % task):-len('.txt')] for f in det_files]
+    classes = sorted(set(gt.keys()) | set(det_classes))
+
+  AP_dict = {}
+  print('{:<20s}'.format('cls') + ''.join(['  AP@{:<5.2f}'.format(t) for t in ovthreshs]))
+  for cls in classes:
+    det_file = os.path.join(det_dir, 'Task%d_%s.txt' % (task, cls))
+    results = dota_eval(det_file, gt.get(cls, {}), ovthreshs=ovthreshs, use_07_metric=use_07_metric, task=task)
+    AP_dict[cls] = [ap for _, _, ap in results]
+    print('{:<20s}'.format(cls) + ''.join(['  {:<8.4f}'.format(ap) for ap in AP_dict[cls]]))
+
+  mAPs = np.mean(np.array(list(AP_dict.values())).reshape([-1, len(ovthreshs)]), axis=0)
+  print('{:<20s}'.format('mAP') + ''.join(['  {:<8.4f}'.format(m) for m in mAPs]))
+  return AP_dict
+
+
+def _make_synthetic_dota(save_dir, num_imgs=458, objs_per_img=63, dets_per_obj=3, task=1, seed=0):
+  """
+  DOTA-val sized set (458 images, ~29k objects, 15 classes) of random polygons and
+  jittered / random detections, used to benchmark the evaluator
+  """
+  from libs.box_utils.coordinate_convert import forward_convert
+
+  rng = np.random.RandomState(seed)
+  classes = ['class%d' % i for i in range(15)]
+  label_dir = os.path.join(save_dir, 'labelTxt')
+  det_dir = os.path.join(save_dir, 'det')
+  for d in [label_dir, det_dir]:
+    if not os.path.exists(d):
+      os.makedirs(d)
+
+  det_lines = dict([(cls, []) for cls in classes])
+  for i in range(num_imgs):
+    imagename = 'P%04d' % i
+    num = rng.randint(1, 2 * objs_per_img)
+    boxes = np.stack([rng.uniform(0, 4000, num), rng.uniform(0, 4000, num),
+                      rng.uniform(8, 150, num), rng.uniform(8, 150, num), rng.uniform(-90, 0, num)], axis=1)
+    labels = rng.randint(0, 15, num)
+    polys = forward_convert(boxes, with_label=False)
+    with open(os.path.join(label_dir, imagename + '.txt'), 'w') as f:
+      f.write('imagesource:GoogleEarth\ngsd:null\n')
+      for poly, label in zip(polys, labels):
+        f.write(' '.join(['%.1f' % x for x in poly]) + ' %s %d\n' % (classes[label], int(rng.rand() < 0.05)))
+
+    jitter = np.repeat(boxes, dets_per_obj, axis=0) + rng.randn(num * dets_per_obj, 5) * [4, 4, 6, 6, 8]
+    jitter[:, 2:4] = np.abs(jitter[:, 2:4]) + 1
+    det_polys = forward_convert(jitter, with_label=False)
+    det_labels = np.repeat(labels, dets_per_obj)
+    for poly, label, score in zip(det_polys, det_labels, rng.rand(det_polys.shape[0])):
+      if task == 1:
+        coords = poly
+      else:
+        coords = poly_to_hbb(poly[None, :])[0]
+      det_lines[classes[label]].append('%s %.3f %s\n' % (imagename, score, ' '.join(['%.1f' % x for x in coords])))
+
+  for cls in classes:
+    with open(os.path.join(det_dir, 'Task%d_%s.txt' % (task, cls)), 'w') as f:
+      f.write(''.join(det_lines[cls]))
+  return det_dir, label_dir
+
+
+def _check_missing_classes(save_dir, task=1):
+  """
+  one image with a plane and a ship, det files for plane (exact) and harbor (a false positive) only:
+  ship has no det file and harbor no ground truth, both must count as AP 0, so the mAP is 1/3
+  :return: True if the classes and APs are the expected ones
+  """
+  label_dir = os.path.join(save_dir, 'missing', 'labelTxt')
+  det_dir = os.path.join(save_dir, 'missing', 'det')
+  for d in [label_dir, det_dir]:
+    if not os.path.exists(d):
+      os.makedirs(d)
+  for f in glob.glob(os.path.join(det_dir, '*.txt')):
+    os.remove(f)
+
+  plane = [10., 10., 60., 10., 60., 40., 10., 40.]
+  ship = [100., 100., 140., 100., 140., 120., 100., 120.]
+  with open(os.path.join(label_dir, 'P0000.txt'), 'w') as f:
+    f.write(' '.join(['%.1f' % x for x in plane]) + ' plane 0\n')
+    f.write(' '.join(['%.1f' % x for x in ship]) + ' ship 0\n')
+
+  for cls, poly in [('plane', plane), ('harbor', [200., 200., 230., 200., 230., 230., 200., 230.])]:
+    coords = poly if task == 1 else poly_to_hbb(np.array([poly]))[0]
+    with open(os.path.join(det_dir, 'Task%d_%s.txt' % (task, cls)), 'w') as f:
+      f.write('P0000 0.900 %s\n' % ' '.join(['%.1f' % x for x in coords]))
+
+  AP_dict = do_dota_eval(det_dir, label_dir, task=task)
+  return sorted(AP_dict.keys()) == ['harbor', 'plane', 'ship'] and \
+      np.allclose([AP_dict['plane'][0], AP_dict['ship'][0], AP_dict['harbor'][0]], [1., 0., 0.])
+
+
+def parse_args():
+  parser = argparse.ArgumentParser('evaluate DOTA Task1/Task2 result files.')
+  parser.add_argument('--det_dir', dest='det_dir',
+                      help='dir of the Task<n>_<class>.txt files',
+                      default='../../tools/test_dota/dota_res', type=str)
+  parser.add_argument('--label_dir', dest='label_dir',
+                      help='DOTA labelTxt dir',
+                      default='/data/dataset/DOTA/val/labelTxt', type=str)
+  parser.add_argument('--task', dest='task',
+                      help='1 for oriented boxes, 2 for horizontal boxes',
+                      default=1, type=int)
+  parser.add_argument('--iou_thresholds', dest='iou_thresholds',
+                      help='comma separated iou thresholds',
+                      default='0.5', type=str)
+  parser.add_argument('--use_07_metric', dest='use_07_metric',
+                      help='1 for VOC07 11 point AP (DOTA devkit), 0 for the area under the PR curve',
+                      default=1, type=int)
+  parser.add_argument('--synthetic', dest='synthetic',
+                      help='benchmark on a generated DOTA-val sized set in this dir',
+                      default='', type=str)
+  return parser.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  ovthreshs = [float(t) for t in args.iou_thresholds.split(',')]
+  det_dir, label_dir = args.det_dir, args.label_dir
+  if args.synthetic:
+    print('classes without det file or ground truth scored 0: %s' % _check_missing_classes(args.synthetic, args.task))
+    det_dir, label_dir = _make_synthetic_dota(args.synthetic, task=args.task)
+
+  start = time.time()
+  do_dota_eval(det_dir, label_dir, ovthreshs=ovthreshs, use_07_metric=bool(args.use_07_metric), task=args.task)
+  print('evaluation cost {:.2f}s'.format(time.time() - start))
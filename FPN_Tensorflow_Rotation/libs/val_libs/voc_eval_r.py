@@ -10,7 +10,10 @@ from __future__ import print_function
 # import matplotlib.pyplot as plt
 import xml.etree.ElementTree as ET
 import os
+import glob
+import hashlib
 import pickle
+import multiprocessing
 import numpy as np
 
 from libs.label_name_dict.label_dict import NAME_LABEL_MAP
@@ -100,6 +103,83 @@ def parse_rec(filename):
   return objects
 
 
+ANNO_CACHE_VERSION = 'v1'
+
+
+def _anno_cache_key(annopath, imagenames):
+  """ md5 of the names and contents of the annotation files of imagenames """
+  md5 = hashlib.md5(ANNO_CACHE_VERSION.encode('utf-8'))
+  for imagename in imagenames:
+    md5.update(imagename.encode('utf-8'))
+    with open(os.path.join(annopath, imagename + '.xml'), 'rb') as f:
+      md5.update(f.read())
+  return md5.hexdigest()
+
+
+def build_annotation_array(annopath, imagenames):
+  """
+  parse the xml files once into a structured array, one row per object:
+  image name, class name, difficult flag and the rotated box [x_c, y_c, w, h, theta].
+  Rows are grouped by image in the order of imagenames.
+  """
+  image_col, name_col, difficult_col, quads = [], [], [], []
+  for imagename in imagenames:
+    tree = ET.parse(os.path.join(annopath, imagename + '.xml'))
+    for obj in tree.findall('object'):
+      bbox = obj.find('bndbox')
+      image_col.append(imagename)
+      name_col.append(obj.find('name').text)
+      difficult_col.append(int(obj.find('difficult').text))
+      # used when test on cropped HRSC2016
+      quads.append([int(bbox.find(tag).text) for tag in ['x0', 'y0', 'x1', 'y1', 'x2', 'y2', 'x3', 'y3']])
+
+  num_objs = len(image_col)
+  max_image_len = max([len(x) for x in image_col] + [1])
+  max_name_len = max([len(x) for x in name_col] + [1])
+  annos = np.zeros(num_objs, dtype=[('image', 'U%d' % max_image_len),
+                                    ('name', 'U%d' % max_name_len),
+                                    ('difficult', np.bool_),
+                                    ('bbox', np.float64, (5,))])
+  if num_objs > 0:
+    annos['image'] = image_col
+    annos['name'] = name_col
+    annos['difficult'] = difficult_col
+    annos['bbox'] = coordinate_convert.backward_convert(np.array(quads, np.float32), with_label=False)
+  return annos
+
+
+def annotation_cache_file(annopath, imagenames, cache_dir=None):
+  """
+  path of the .npy file caching build_annotation_array(annopath, imagenames), built if missing.
+  The file is keyed by the content hash of the xml files: editing, adding or removing an
+  annotation changes the key, and stale cache files of the same directory are removed
+  when a new one is written.
+  """
+  if cache_dir is None:
+    cache_dir = os.path.join(cfgs.ROOT_PATH, 'output/anno_cache')
+  tools.mkdir(cache_dir)
+
+  prefix = 'anno_' + hashlib.md5(os.path.abspath(annopath).encode('utf-8')).hexdigest()[:8]
+  cache_file = os.path.join(cache_dir, '{}_{}.npy'.format(prefix, _anno_cache_key(annopath, imagenames)))
+  if os.path.exists(cache_file):
+    return cache_file
+
+  annos = build_annotation_array(annopath, imagenames)
+  for stale_file in glob.glob(os.path.join(cache_dir, prefix + '_*.npy')):
+    os.remove(stale_file)
+  tmp_file = cache_file + '.tmp.npy'
+  np.save(tmp_file, annos)
+  os.rename(tmp_file, cache_file)
+  return cache_file
+
+
+def load_annotation_cache(annopath, imagenames, cache_dir=None):
+  """
+  annotations of imagenames, memory mapped from the cache file of annotation_cache_file
+  """
+  return np.load(annotation_cache_file(annopath, imagenames, cache_dir), mmap_mode='r')
+
+
 def voc_ap(rec, prec, use_07_metric=False):
   """ ap = voc_ap(rec, prec, [use_07_metric])
   Compute VOC AP given precision and recall.
@@ -134,8 +214,32 @@ def voc_ap(rec, prec, use_07_metric=False):
   return ap
 
 
+def greedy_match(ovmaxs, jmaxs, difficult, ovthreshs):
+  """
+  score ordered greedy matching of the detections of one image, for all the thresholds at once
+  :param ovmaxs: [D, ] best overlap of each detection, detections in score order
+  :param jmaxs: [D, ] index of the gt giving that overlap
+  :param difficult: [G, ] bool, matches to difficult gts count neither as tp nor fp
+  :param ovthreshs: [T, ] iou thresholds
+  :return: tp, fp, [D, T]
+  """
+  tp = np.zeros([len(ovmaxs), len(ovthreshs)])
+  fp = np.zeros([len(ovmaxs), len(ovthreshs)])
+  # det[j, t]: gt j has already been detected at threshold t
+  det = np.zeros([len(difficult), len(ovthreshs)], np.bool_)
+  for d, (ovmax, jmax) in enumerate(zip(ovmaxs, jmaxs)):
+    hit = ovmax > ovthreshs
+    if difficult[jmax]:
+      fp[d] = ~hit
+    else:
+      tp[d] = hit & ~det[jmax]
+      fp[d] = ~hit | det[jmax]
+      det[jmax] |= hit
+  return tp, fp
+
+
 def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
-             use_07_metric=False, use_diff=False):
+             use_07_metric=False, use_diff=False, annos=None):
   '''
 
   :param detpath:
@@ -145,37 +249,47 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
   :param ovthresh:
   :param use_07_metric:
   :param use_diff:
+  :param annos: annotations from load_annotation_cache, loaded here if None
   :return:
   '''
+  return voc_eval_multi(detpath, annopath, test_imgid_list, cls_name, ovthreshs=[ovthresh],
+                        use_07_metric=use_07_metric, use_diff=use_diff, annos=annos)[0]
+
+
+def voc_eval_multi(detpath, annopath, test_imgid_list, cls_name, ovthreshs=(0.5,),
+                   use_07_metric=False, use_diff=False, annos=None):
+  '''
+  voc_eval at several iou thresholds, every detection-gt overlap is computed once
+  :param ovthreshs: iou thresholds
+  :return: list of (rec, prec, ap), one per threshold
+  '''
   # 1. parse xml to get gtboxes
 
   # read list of images
   imagenames = test_imgid_list
 
-  recs = {}
-  for i, imagename in enumerate(imagenames):
-    recs[imagename] = parse_rec(os.path.join(annopath, imagename+'.xml'))
-    # if i % 100 == 0:
-    #   print('Reading annotation for {:d}/{:d}'.format(
-    #     i + 1, len(imagenames)))
+  if annos is None:
+    annos = load_annotation_cache(annopath, imagenames)
 
   # 2. get gtboxes for this class.
+  cls_annos = annos[annos['name'] == cls_name]
   class_recs = {}
-  num_pos = 0
-  # if cls_name == 'person':
-  #   print ("aaa")
   for imagename in imagenames:
-    R = [obj for obj in recs[imagename] if obj['name'] == cls_name]
-    bbox = np.array([x['bbox'] for x in R])
-    if use_diff:
-      difficult = np.array([False for x in R]).astype(np.bool)
-    else:
-      difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-    det = [False] * len(R)
-    num_pos = num_pos + sum(~difficult)  # ignored the diffcult boxes
-    class_recs[imagename] = {'bbox': bbox,
-                             'difficult': difficult,
-                             'det': det} # det means that gtboxes has already been detected
+    class_recs[imagename] = {'bbox': np.zeros([0, 5]),
+                             'difficult': np.zeros([0], np.bool_),
+                             'det': []}
+  if cls_annos.shape[0] > 0:
+    cls_images = cls_annos['image']
+    starts = np.flatnonzero(np.concatenate([[True], cls_images[1:] != cls_images[:-1]]))
+    ends = np.append(starts[1:], cls_images.shape[0])
+    for start, end in zip(starts, ends):
+      difficult = np.array(cls_annos['difficult'][start:end])
+      if use_diff:
+        difficult[:] = False
+      class_recs[cls_images[start]] = {'bbox': np.array(cls_annos['bbox'][start:end]),
+                                       'difficult': difficult,
+                                       'det': [False] * (end - start)}  # det means that gtboxes has already been detected
+  num_pos = sum([np.sum(~R['difficult']) for R in class_recs.values()])  # ignored the diffcult boxes
 
   # 3. read the detection file
   detfile = os.path.join(detpath, "det_"+cls_name+".txt")
@@ -189,8 +303,9 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
   BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
 
   nd = len(image_ids) # num of detections. That, a line is a det_box.
-  tp = np.zeros(nd)
-  fp = np.zeros(nd)
+  ovthreshs = np.array(ovthreshs, np.float64)
+  tp = np.zeros([nd, ovthreshs.shape[0]])
+  fp = np.zeros([nd, ovthreshs.shape[0]])
 
   if BB.shape[0] > 0:
     # sort by confidence
@@ -199,75 +314,83 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
     BB = BB[sorted_ind, :]
     image_ids = [image_ids[x] for x in sorted_ind]  #reorder the img_name
 
+    # group the detections by image, inside an image they stay in score order
+    dets_per_image = {}
+    for d, image_id in enumerate(image_ids):
+      dets_per_image.setdefault(image_id, []).append(d)
+
     # go down dets and mark TPs and FPs
-    for d in range(nd):
-      R = class_recs[image_ids[d]]  # img_id is img_name
-      bb = BB[d, :].astype(float)
-      ovmax = -np.inf
+    for image_id, det_inds in dets_per_image.items():
+      R = class_recs[image_id]  # img_id is img_name
       BBGT = R['bbox'].astype(float)
 
-      if BBGT.size > 0:
-        # compute overlaps
-        # intersection
-        # ixmin = np.maximum(BBGT[:, 0], bb[0])
-        # iymin = np.maximum(BBGT[:, 1], bb[1])
-        # ixmax = np.minimum(BBGT[:, 2], bb[2])
-        # iymax = np.minimum(BBGT[:, 3], bb[3])
-        # iw = np.maximum(ixmax - ixmin + 1., 0.)
-        # ih = np.maximum(iymax - iymin + 1., 0.)
-        # inters = iw * ih
-        #
-        # # union
-        # uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-        #        (BBGT[:, 2] - BBGT[:, 0] + 1.) *
-        #        (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
-        #
-        # overlaps = inters / uni
-        overlaps = []
-        for i in range(len(BBGT)):
-          overlap = iou_rotate.iou_rotate_calculate1(np.array([bb]),
-                                                      BBGT[i],
-                                                      use_gpu=False)[0]
-          overlaps.append(overlap)
-        ovmax = np.max(overlaps)
-        jmax = np.argmax(overlaps)
-
-      if ovmax > ovthresh:
-        if not R['difficult'][jmax]:
-          if not R['det'][jmax]:
-            tp[d] = 1.
-            R['det'][jmax] = 1
-          else:
-            fp[d] = 1.
-      else:
-        fp[d] = 1.
-
-  # 4. get recall, precison and AP
-  fp = np.cumsum(fp)
-  tp = np.cumsum(tp)
-  rec = tp / float(num_pos)
-  # avoid divide by zero in case the first detection matches a difficult
-  # ground truth
-  prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-  ap = voc_ap(rec, prec, use_07_metric)
-
-  return rec, prec, ap
+      if BBGT.size == 0:
+        fp[det_inds] = 1.
+        continue
 
+      # [num_dets, num_gts] overlaps of this image in one call
+      overlaps = iou_rotate.iou_rotate_calculate1(BB[det_inds].astype(float), BBGT, use_gpu=False)
+      ovmaxs = np.max(overlaps, axis=1)
+      jmaxs = np.argmax(overlaps, axis=1)
+      tp[det_inds], fp[det_inds] = greedy_match(ovmaxs, jmaxs, R['difficult'], ovthreshs)
 
-def do_python_eval(test_imgid_list, test_annotation_path):
+  # 4. get recall, precison and AP
+  fp = np.cumsum(fp, axis=0)
+  tp = np.cumsum(tp, axis=0)
+  results = []
+  for t in range(ovthreshs.shape[0]):
+    rec = tp[:, t] / float(num_pos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp[:, t] / np.maximum(tp[:, t] + fp[:, t], np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+    results.append((rec, prec, ap))
+
+  return results
+
+
+def _eval_class(job):
+  """ voc_eval_multi of one class, run in the pool workers. The memory mapped cache is shared between them """
+  cls, detpath, annopath, test_imgid_list, cache_file, use_07_metric, ovthreshs = job
+  return voc_eval_multi(detpath=detpath,
+                        test_imgid_list=test_imgid_list,
+                        cls_name=cls,
+                        annopath=annopath,
+                        use_07_metric=use_07_metric,
+                        ovthreshs=ovthreshs,
+                        annos=np.load(cache_file, mmap_mode='r'))
+
+
+def do_python_eval(test_imgid_list, test_annotation_path, workers=1, ovthreshs=None):
+  """
+  :param ovthreshs: iou thresholds evaluated in the same pass, default is [cfgs.EVAL_THRESHOLD].
+  The per class report is for the first one, a table of AP per class per threshold follows
+  when there are several.
+  """
   # import matplotlib.colors as colors
   # import matplotlib.pyplot as plt
 
+  if ovthreshs is None:
+    ovthreshs = [cfgs.EVAL_THRESHOLD]
+
+  # parsed once for all the classes
+  cache_file = annotation_cache_file(test_annotation_path, test_imgid_list)
+
+  classes = [cls for cls in NAME_LABEL_MAP.keys() if cls != 'back_ground']
+  jobs = [(cls, cfgs.EVALUATE_R_DIR, test_annotation_path, test_imgid_list, cache_file,
+           cfgs.USE_07_METRIC, ovthreshs) for cls in classes]
+  if workers > 1:
+    # map keeps the order of the classes
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    results = pool.map(_eval_class, jobs)
+    pool.close()
+    pool.join()
+  else:
+    results = [_eval_class(job) for job in jobs]
+
   AP_list = []
-  for cls, index in NAME_LABEL_MAP.items():
-    if cls == 'back_ground':
-      continue
-    recall, precision, AP = voc_eval(detpath=cfgs.EVALUATE_R_DIR,
-                                     test_imgid_list=test_imgid_list,
-                                     cls_name=cls,
-                                     annopath=test_annotation_path,
-                                     use_07_metric=cfgs.USE_07_METRIC,
-                                     ovthresh=cfgs.EVAL_THRESHOLD)
+  for cls, cls_results in zip(classes, results):
+    recall, precision, AP = cls_results[0]
     AP_list += [AP]
     print("cls : {}|| Recall: {} || Precison: {}|| AP: {}".format(cls, recall[-1], precision[-1], AP))
     # print("{}_ap: {}".format(cls, AP))
@@ -292,18 +415,29 @@ def do_python_eval(test_imgid_list, test_annotation_path):
 
   print("mAP is : {}".format(np.mean(AP_list)))
 
+  if len(ovthreshs) > 1:
+    AP_table = np.array([[ap for _, _, ap in cls_results] for cls_results in results])  # [num_cls, num_thresh]
+    print('{:<20s}'.format('cls') + ''.join(['  AP@{:<5.2f}'.format(t) for t in ovthreshs]))
+    for cls, cls_aps in zip(classes, AP_table):
+      print('{:<20s}'.format(cls) + ''.join(['  {:<8.4f}'.format(ap) for ap in cls_aps]))
+    mAPs = np.mean(AP_table, axis=0)
+    print('{:<20s}'.format('mAP') + ''.join(['  {:<8.4f}'.format(m) for m in mAPs]))
+    print("mAP@{}:{} is : {}".format(min(ovthreshs), max(ovthreshs), np.mean(mAPs)))
+
 
-def voc_evaluate_detections(all_boxes, test_imgid_list, test_annotation_path):
+def voc_evaluate_detections(all_boxes, test_imgid_list, test_annotation_path, workers=1, ovthreshs=None):
   '''
 
   :param all_boxes: is a list. each item reprensent the detections of a img.
 
   The detections is a array. shape is [-1, 6]. [category, score, xmin, ymin, xmax, ymax]
   Note that: if none detections in this img. that the detetions is : []
+  :param workers: number of processes evaluating the classes in parallel
+  :param ovthreshs: iou thresholds, e.g. np.arange(0.5, 1., 0.05) for AP50:95
   :return:
   '''
 
   write_voc_results_file(all_boxes, test_imgid_list=test_imgid_list,
                          det_save_dir=cfgs.EVALUATE_R_DIR)
-  do_python_eval(test_imgid_list, test_annotation_path)
+  do_python_eval(test_imgid_list, test_annotation_path, workers=workers, ovthreshs=ovthreshs)
 
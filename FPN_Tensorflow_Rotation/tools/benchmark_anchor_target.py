@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+import argparse
+import numpy as np
+import numpy.random as npr
+sys.path.append("../")
+
+from libs.configs import cfgs
+from libs.detection_oprations import anchor_target_layer_without_boxweight as anchor_target
+
+
+def make_anchors_np(img_h, img_w):
+    """
+    the anchors of build_whole_network for an img_h x img_w image, make_anchors of every level in numpy
+    :return: [N, 4] float32
+    """
+    all_anchors = []
+    for base_anchor_size, stride in zip(cfgs.BASE_ANCHOR_SIZE_LIST, cfgs.ANCHOR_STRIDE_LIST):
+        scales = base_anchor_size * np.array(cfgs.ANCHOR_SCALES, np.float32)
+        sqrt_ratios = np.sqrt(np.array(cfgs.ANCHOR_RATIOS, np.float32))
+        ws = (scales[:, np.newaxis] / sqrt_ratios).reshape(-1)
+        hs = (scales[:, np.newaxis] * sqrt_ratios).reshape(-1)
+
+        featuremap_height = int(np.ceil(img_h / stride))
+        featuremap_width = int(np.ceil(img_w / stride))
+        x_centers = np.arange(featuremap_width, dtype=np.float32) * stride
+        y_centers = np.arange(featuremap_height, dtype=np.float32) * stride
+        if cfgs.USE_CENTER_OFFSET:
+            x_centers = x_centers + stride / 2.
+            y_centers = y_centers + stride / 2.
+        x_centers, y_centers = np.meshgrid(x_centers, y_centers)
+
+        ws, x_centers = np.meshgrid(ws, x_centers)
+        hs, y_centers = np.meshgrid(hs, y_centers)
+        anchor_centers = np.stack([x_centers, y_centers], 2).reshape(-1, 2)
+        box_sizes = np.stack([ws, hs], 2).reshape(-1, 2)
+        all_anchors.append(np.concatenate([anchor_centers - 0.5 * box_sizes,
+                                           anchor_centers + 0.5 * box_sizes], axis=1))
+    return np.concatenate(all_anchors, axis=0).astype(np.float32)
+
+
+def small_vehicles(img_h, img_w, num_boxes, seed):
+    """
+    num_boxes horizontal boxes of 8~40 pixels, a parking lot of small vehicles
+    :return: [num_boxes, 5] float32, x1, y1, x2, y2, label
+    """
+    rng = np.random.RandomState(seed)
+    w = rng.uniform(8, 40, size=num_boxes)
+    h = rng.uniform(8, 40, size=num_boxes)
+    x1 = rng.uniform(0, img_w - w)
+    y1 = rng.uniform(0, img_h - h)
+    return np.stack([x1, y1, x1 + w, y1 + h, rng.randint(1, 16, size=num_boxes)], axis=1).astype(np.float32)
+
+
+def run(gt_boxes, img_shape, anchors, sparse, seed):
+    cfgs.SPARSE_ANCHOR_TARGET = sparse
+    npr.seed(seed)
+    start = time.time()
+    labels, targets = anchor_target.anchor_target_layer(gt_boxes, img_shape, anchors)
+    return labels, targets, time.time() - start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('dense vs sparse anchor target layer on scenes of many small objects.')
+    parser.add_argument('--img_h', dest='img_h', help='image height', default=800, type=int)
+    parser.add_argument('--img_w', dest='img_w', help='image width', default=800, type=int)
+    parser.add_argument('--num_boxes', dest='num_boxes', help='gt boxes per image, comma separated',
+                        default='100,500,1000,2000', type=str)
+    parser.add_argument('--steps', dest='steps', help='images per setting', default=5, type=int)
+    parser.add_argument('--max_dense_mb', dest='max_dense_mb', help='skip the dense layer above this overlaps size',
+                        default=2048, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    anchors = make_anchors_np(args.img_h, args.img_w)
+    img_shape = np.array([1, args.img_h, args.img_w, 3], np.int32)
+    print('%d anchors for %dx%d' % (anchors.shape[0], args.img_w, args.img_h))
+    print('%6s %14s %10s %10s %8s %6s' % ('gt', 'dense(MB)', 'dense(s)', 'sparse(s)', 'speedup', 'same'))
+    for num_boxes in [int(n) for n in args.num_boxes.split(',')]:
+        dense_mb = anchors.shape[0] * num_boxes * 8 / 1024. ** 2
+        dense_cost, sparse_cost, same = 0., 0., True
+        for step in range(args.steps):
+            gt_boxes = small_vehicles(args.img_h, args.img_w, num_boxes, step)
+            sparse_labels, sparse_targets, cost = run(gt_boxes, img_shape, anchors, True, step)
+            sparse_cost += cost
+            if dense_mb > args.max_dense_mb:
+                continue
+            dense_labels, dense_targets, cost = run(gt_boxes, img_shape, anchors, False, step)
+            dense_cost += cost
+            same = same and np.array_equal(dense_labels, sparse_labels) and \
+                np.array_equal(dense_targets, sparse_targets)
+        if dense_mb > args.max_dense_mb:
+            print('%6d %14.1f %10s %10.4f %8s %6s' % (num_boxes, dense_mb, '-', sparse_cost / args.steps, '-', '-'))
+        else:
+            print('%6d %14.1f %10.4f %10.4f %8.1f %6s' % (
+                num_boxes, dense_mb, dense_cost / args.steps, sparse_cost / args.steps,
+                dense_cost / sparse_cost, same))
@@ -0,0 +1,81 @@
+# -*- coding:utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+import tensorflow as tf
+sys.path.append("../")
+
+from libs.configs import cfgs
+from data.io import read_tfrecord_multi_gpu
+
+
+def benchmark(pipeline, batch_size, steps, warmup):
+    """
+    pull batches of next_batch without a model, the images/s must stay above what the towers consume
+    (batch_size / per_cost_time of multi_gpu_train) for the GPUs not to wait on the input
+    :return: images/s, mean seconds per batch, mean padding waste
+    """
+    tf.reset_default_graph()
+    pattern = read_tfrecord_multi_gpu.tfrecord_pattern(cfgs.DATASET_NAME, is_training=True)
+    shortside_len = list(cfgs.IMG_SHORT_SIDE_LEN) if cfgs.IMAGE_PYRAMID else cfgs.IMG_SHORT_SIDE_LEN
+    if pipeline == 'tf_data':
+        batch = read_tfrecord_multi_gpu.dataset_next_batch(pattern, batch_size, shortside_len, is_training=True,
+                                                           num_parallel_calls=cfgs.NUM_PARALLEL_CALLS,
+                                                           shuffle_buffer=cfgs.SHUFFLE_BUFFER,
+                                                           prefetch=cfgs.PREFETCH_BATCHES,
+                                                           cache=cfgs.CACHE_DATASET,
+                                                           bucket_boundaries=cfgs.BUCKET_BOUNDARIES)
+    else:
+        batch = read_tfrecord_multi_gpu.queue_next_batch(pattern, batch_size, shortside_len, is_training=True)
+    waste = read_tfrecord_multi_gpu.padding_waste(batch[1], batch[4], batch[5])
+
+    init_op = tf.group(
+        tf.global_variables_initializer(),
+        tf.local_variables_initializer()
+    )
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+
+    with tf.Session(config=config) as sess:
+        sess.run(init_op)
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess, coord)
+
+        for _ in range(warmup):
+            sess.run(batch)
+        start = time.time()
+        total_waste = 0.
+        for _ in range(steps):
+            total_waste += sess.run(waste)
+        cost = time.time() - start
+
+        coord.request_stop()
+        coord.join(threads)
+    return steps * batch_size / cost, cost / steps, total_waste / steps
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('images/s of the training input pipeline.')
+    parser.add_argument('--pipeline', dest='pipeline', help='queue, tf_data or both', default='both', type=str)
+    parser.add_argument('--batch_size', dest='batch_size', help='images per batch',
+                        default=cfgs.BATCH_SIZE * cfgs.NUM_GPU, type=int)
+    parser.add_argument('--steps', dest='steps', help='timed batches', default=200, type=int)
+    parser.add_argument('--warmup', dest='warmup', help='batches before timing', default=20, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    pipelines = ['queue', 'tf_data'] if args.pipeline == 'both' else [args.pipeline]
+    for pipeline in pipelines:
+        img_per_sec, sec_per_batch, waste = benchmark(pipeline, args.batch_size, args.steps, args.warmup)
+        print('%-8s batch_size: %d, %.2f images/s, %.4fs per batch, padding waste %.1f%%' % (
+            pipeline, args.batch_size, img_per_sec, sec_per_batch, waste * 100))
@@ -0,0 +1,182 @@
+# -*- coding:utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import numpy.random as npr
+import tensorflow as tf
+sys.path.append("../")
+
+from libs.configs import cfgs
+from libs.box_utils.cython_utils.cython_bbox import bbox_overlaps
+from libs.detection_oprations import proposal_target_layer as proposal_target
+
+
+def random_scene(img_h, img_w, num_rois, num_gt, seed):
+    """
+    gt boxes and rpn rois jittered around them plus random ones, so that there are fg and bg rois
+    :return: rpn_rois [num_rois, 4], gt_boxes_h [num_gt, 5], gt_boxes_r [num_gt, 6], all float32
+    """
+    rng = np.random.RandomState(seed)
+    w = rng.uniform(10, 100, size=num_gt)
+    h = rng.uniform(10, 100, size=num_gt)
+    x_c = rng.uniform(w / 2, img_w - w / 2)
+    y_c = rng.uniform(h / 2, img_h - h / 2)
+    labels = rng.randint(1, cfgs.CLASS_NUM + 1, size=num_gt)
+    gt_boxes_h = np.stack([x_c - w / 2, y_c - h / 2, x_c + w / 2, y_c + h / 2, labels], axis=1)
+    gt_boxes_r = np.stack([x_c, y_c, w, h, rng.uniform(-90, 0, size=num_gt), labels], axis=1)
+
+    near = rng.randint(0, num_gt, size=num_rois // 2)
+    jitter = rng.normal(0, 0.15, size=(len(near), 4)) * np.stack([w[near], h[near], w[near], h[near]], axis=1)
+    rois_near = gt_boxes_h[near, :4] + jitter
+    x1 = rng.uniform(0, img_w - 20, size=num_rois - len(near))
+    y1 = rng.uniform(0, img_h - 20, size=num_rois - len(near))
+    rois_far = np.stack([x1, y1, x1 + rng.uniform(10, 200, size=len(x1)), y1 + rng.uniform(10, 200, size=len(y1))],
+                        axis=1)
+    rpn_rois = np.concatenate([rois_near, rois_far], axis=0)
+    rpn_rois[:, 2:] = np.maximum(rpn_rois[:, 2:], rpn_rois[:, :2] + 1)
+    return rpn_rois.astype(np.float32), gt_boxes_h.astype(np.float32), gt_boxes_r.astype(np.float32)
+
+
+def reference(rpn_rois, gt_boxes_h, gt_boxes_r, keep_inds):
+    """
+    what _sample_rois returns when npr.choice draws keep_inds, plus the pools it draws from
+    """
+    all_rois = np.vstack((rpn_rois, gt_boxes_h[:, :-1])) if cfgs.ADD_GTBOXES_TO_TRAIN else rpn_rois
+    overlaps = bbox_overlaps(np.ascontiguousarray(all_rois, dtype=np.float),
+                             np.ascontiguousarray(gt_boxes_h[:, :-1], dtype=np.float))
+    gt_assignment = overlaps.argmax(axis=1)
+    max_overlaps = overlaps.max(axis=1)
+    fg_pool = np.where(max_overlaps >= cfgs.FAST_RCNN_IOU_POSITIVE_THRESHOLD)[0]
+    bg_pool = np.where((max_overlaps < cfgs.FAST_RCNN_IOU_POSITIVE_THRESHOLD) &
+                       (max_overlaps >= cfgs.FAST_RCNN_IOU_NEGATIVE_THRESHOLD))[0]
+    if cfgs.FAST_RCNN_MINIBATCH_SIZE == -1:
+        num_fg, num_bg = fg_pool.size, bg_pool.size
+    else:
+        num_fg = int(min(np.round(cfgs.FAST_RCNN_POSITIVE_RATE * cfgs.FAST_RCNN_MINIBATCH_SIZE), fg_pool.size))
+        num_bg = int(min(cfgs.FAST_RCNN_MINIBATCH_SIZE - num_fg, bg_pool.size))
+
+    labels = gt_boxes_h[gt_assignment, -1][keep_inds]
+    labels[num_fg:] = 0
+    rois = all_rois[keep_inds]
+    bbox_target_data_r = proposal_target._compute_targets_r(rois, gt_boxes_r[gt_assignment[keep_inds], :-1], labels)
+    bbox_targets_r = proposal_target._get_bbox_regression_labels_r(bbox_target_data_r, cfgs.CLASS_NUM + 1)
+    return labels, rois, bbox_targets_r, fg_pool, bg_pool, num_fg, num_bg
+
+
+def check_parity(scenes, seed):
+    """
+    the in graph sampling draws other rois than npr.choice, so the draw is checked (sizes, no duplicates,
+    inside the fg/bg pools of _sample_rois, same draw for the same seed) and everything else is compared
+    against the numpy layer given the same draw
+    :return: number of scenes that differ, mean foreground rois per scene
+    """
+    tf.reset_default_graph()
+    placeholders = [tf.placeholder(tf.float32, shape=s) for s in [[None, 4], [None, 5], [None, 6]]]
+    all_rois = tf.concat([placeholders[0], placeholders[1][:, :-1]], axis=0) if cfgs.ADD_GTBOXES_TO_TRAIN \
+        else placeholders[0]
+    outputs = proposal_target._sample_rois_tf(all_rois, placeholders[1], placeholders[2],
+                                              cfgs.FAST_RCNN_MINIBATCH_SIZE, cfgs.CLASS_NUM + 1, seed=seed)
+
+    failed, num_fg_total = 0, 0
+    for rpn_rois, gt_boxes_h, gt_boxes_r in scenes:
+        feed_dict = dict(zip(placeholders, [rpn_rois, gt_boxes_h, gt_boxes_r]))
+        with tf.Session() as sess:
+            labels, rois, bbox_targets_r, keep_inds = sess.run(outputs, feed_dict=feed_dict)
+        with tf.Session() as sess:
+            same_draw = np.array_equal(keep_inds, sess.run(outputs[3], feed_dict=feed_dict))
+
+        ref_labels, ref_rois, ref_bbox_targets_r, fg_pool, bg_pool, num_fg, num_bg = \
+            reference(rpn_rois, gt_boxes_h, gt_boxes_r, keep_inds)
+        ok = same_draw and len(keep_inds) == num_fg + num_bg and len(np.unique(keep_inds)) == len(keep_inds) and \
+            np.all(np.isin(keep_inds[:num_fg], fg_pool)) and np.all(np.isin(keep_inds[num_fg:], bg_pool)) and \
+            np.array_equal(labels, ref_labels) and np.array_equal(rois, ref_rois) and \
+            np.allclose(bbox_targets_r, ref_bbox_targets_r, atol=1e-4)
+        failed += 0 if ok else 1
+        num_fg_total += num_fg
+    return failed, num_fg_total / len(scenes)
+
+
+def check_gradient(scene):
+    """
+    the py_func layer stops the gradient, the in graph one must as well: otherwise the fast rcnn
+    box loss backpropagates through its own targets into the rpn
+    :return: True if rois, labels and bbox_targets have no gradient wrt the rpn rois
+    """
+    tf.reset_default_graph()
+    rpn_rois, gt_boxes_h, gt_boxes_r = [tf.Variable(v, trainable=False) for v in scene]
+    rois, labels, bbox_targets = proposal_target.proposal_target_layer_tf(rpn_rois, gt_boxes_h, gt_boxes_r)
+    grads = tf.gradients(tf.reduce_sum(rois) + tf.reduce_sum(labels) + tf.reduce_sum(bbox_targets), rpn_rois)
+    if all(grad is None for grad in grads):
+        return True
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        return all(not np.any(grad) for grad in sess.run([grad for grad in grads if grad is not None]))
+
+
+def benchmark(scenes, num_towers, in_graph, steps, warmup):
+    """
+    one proposal target layer per tower in the same step, as multi_gpu_train builds them
+    :return: seconds per step
+    """
+    tf.reset_default_graph()
+    outputs = []
+    for i in range(num_towers):
+        # variables, not constants, so that the in graph layer is not folded away
+        rpn_rois, gt_boxes_h, gt_boxes_r = [tf.Variable(v, trainable=False) for v in scenes[i % len(scenes)]]
+        with tf.name_scope('tower_%d' % i):
+            if in_graph:
+                outputs.append(proposal_target.proposal_target_layer_tf(rpn_rois, gt_boxes_h, gt_boxes_r))
+            else:
+                outputs.append(tf.py_func(proposal_target.proposal_target_layer,
+                                          [rpn_rois, gt_boxes_h, gt_boxes_r],
+                                          [tf.float32, tf.float32, tf.float32]))
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for _ in range(warmup):
+            sess.run(outputs)
+        start = time.time()
+        for _ in range(steps):
+            sess.run(outputs)
+        cost = time.time() - start
+    return cost / steps
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('in graph vs tf.py_func proposal target layer: parity and time per step.')
+    parser.add_argument('--img_h', dest='img_h', help='image height', default=800, type=int)
+    parser.add_argument('--img_w', dest='img_w', help='image width', default=800, type=int)
+    parser.add_argument('--num_rois', dest='num_rois', help='rpn rois per image',
+                        default=cfgs.RPN_MAXIMUM_PROPOSAL_TARIN, type=int)
+    parser.add_argument('--num_gt', dest='num_gt', help='gt boxes per image', default=200, type=int)
+    parser.add_argument('--num_scenes', dest='num_scenes', help='scenes of the parity check', default=10, type=int)
+    parser.add_argument('--seed', dest='seed', help='op seed of the in graph sampling', default=0, type=int)
+    parser.add_argument('--num_towers', dest='num_towers', help='towers, comma separated', default='1,2,4', type=str)
+    parser.add_argument('--steps', dest='steps', help='timed steps', default=50, type=int)
+    parser.add_argument('--warmup', dest='warmup', help='steps before timing', default=5, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    npr.seed(args.seed)
+    scenes = [random_scene(args.img_h, args.img_w, args.num_rois, args.num_gt, args.seed + i)
+              for i in range(args.num_scenes)]
+
+    failed, num_fg = check_parity(scenes, args.seed)
+    print('parity: %d/%d scenes differ, %.1f fg rois per scene' % (failed, len(scenes), num_fg))
+    print('gradient stopped: %s' % check_gradient(scenes[0]))
+
+    for num_towers in [int(n) for n in args.num_towers.split(',')]:
+        py_func_cost = benchmark(scenes, num_towers, False, args.steps, args.warmup)
+        in_graph_cost = benchmark(scenes, num_towers, True, args.steps, args.warmup)
+        print('%d towers: py_func %.4fs, in graph %.4fs per step (%.1fx)' % (
+            num_towers, py_func_cost, in_graph_cost, py_func_cost / in_graph_cost))
@@ -122,7 +122,7 @@ def eval_with_plac(img_dir, det_net, num_imgs, image_ext, draw_imgs=False):
         pickle.dump(all_boxes_r, fw2)
 
 
-def eval(num_imgs, img_dir, image_ext, test_annotation_path):
+def eval(num_imgs, img_dir, image_ext, test_annotation_path, workers=1, ovthreshs=None):
 
     faster_rcnn = build_whole_network.DetectionNetwork(base_network_name=cfgs.NET_NAME,
                                                        is_training=False)
@@ -142,7 +142,9 @@ def eval(num_imgs, img_dir, image_ext, test_annotation_path):
     print('rotation eval:')
     voc_eval_r.voc_evaluate_detections(all_boxes=all_boxes_r,
                                        test_imgid_list=real_test_imgname_list,
-                                       test_annotation_path=test_annotation_path)
+                                       test_annotation_path=test_annotation_path,
+                                       workers=workers,
+                                       ovthreshs=ovthreshs)
 
 
 def parse_args():
@@ -162,6 +164,12 @@ def parse_args():
     parser.add_argument('--gpu', dest='gpu',
                         help='gpu index',
                         default='0', type=str)
+    parser.add_argument('--workers', dest='workers',
+                        help='processes evaluating the classes in parallel',
+                        default=1, type=int)
+    parser.add_argument('--iou_thresholds', dest='iou_thresholds',
+                        help='comma separated iou thresholds evaluated in one pass, default is cfgs.EVAL_THRESHOLD',
+                        default='', type=str)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -177,4 +185,5 @@ if __name__ == '__main__':
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
 
-    eval(np.inf, args.img_dir, args.image_ext, args.test_annotation_path)
+    ovthreshs = [float(t) for t in args.iou_thresholds.split(',')] if args.iou_thresholds else None
+    eval(np.inf, args.img_dir, args.image_ext, args.test_annotation_path, args.workers, ovthreshs)
@@ -14,7 +14,7 @@ sys.path.append("../")
 
 from libs.configs import cfgs
 from libs.networks import build_whole_network
-from data.io.read_tfrecord_multi_gpu import next_batch
+from data.io.read_tfrecord_multi_gpu import next_batch, padding_waste
 from libs.box_utils.show_box_in_tensor import draw_boxes_with_categories, draw_boxes_with_categories_and_scores
 from help_utils import tools
 from libs.box_utils.coordinate_convert import backward_convert, get_horizen_minAreaRectangle
@@ -94,11 +94,6 @@ def sum_gradients(tower_grads):
     return sum_grads
 
 
-def get_gtboxes_and_label(gtboxes_and_label_h, gtboxes_and_label_r, num_objects):
-    return gtboxes_and_label_h[:int(num_objects), :].astype(np.float32), \
-           gtboxes_and_label_r[:int(num_objects), :].astype(np.float32)
-
-
 def warmup_lr(init_lr, global_step, warmup_step, num_gpu):
     def warmup(end_lr, global_step, warmup_step):
         start_lr = end_lr * 0.1
@@ -133,17 +128,19 @@ def train():
 
         with tf.name_scope('get_batch'):
             if cfgs.IMAGE_PYRAMID:
-                shortside_len_list = tf.constant(cfgs.IMG_SHORT_SIDE_LEN)
-                shortside_len = tf.random_shuffle(shortside_len_list)[0]
+                # next_batch draws one short side of the list per image
+                shortside_len = list(cfgs.IMG_SHORT_SIDE_LEN)
 
             else:
                 shortside_len = cfgs.IMG_SHORT_SIDE_LEN
 
-            img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch, img_h_batch, img_w_batch = \
-                next_batch(dataset_name=cfgs.DATASET_NAME,
-                           batch_size=cfgs.BATCH_SIZE * num_gpu,
-                           shortside_len=shortside_len,
-                           is_training=True)
+            batch = next_batch(dataset_name=cfgs.DATASET_NAME,
+                               batch_size=cfgs.BATCH_SIZE * num_gpu,
+                               shortside_len=shortside_len,
+                               is_training=True)
+            img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch, img_h_batch, img_w_batch = batch[:6]
+            gt_forms_batch = batch[6] if cfgs.PRECOMPUTED_GT else None
+            tf.summary.scalar('DATA/padding_waste', padding_waste(img_batch, img_h_batch, img_w_batch))
 
         # data processing
         inputs_list = []
@@ -152,16 +149,23 @@ def train():
             if cfgs.NET_NAME in ['resnet152_v1d', 'resnet101_v1d', 'resnet50_v1d']:
                 img = img / tf.constant([cfgs.PIXEL_STD])
 
-            gtboxes_and_label_r = tf.py_func(backward_convert,
-                                             inp=[gtboxes_and_label_batch[i]],
-                                             Tout=tf.float32)
-            gtboxes_and_label_r = tf.reshape(gtboxes_and_label_r, [-1, 6])
+            # drop the padding rows of the batch
+            num_objects = num_objects_batch[i]
+            gtboxes_and_label = gtboxes_and_label_batch[i][:num_objects]
+            label = tf.cast(gtboxes_and_label[:, 8:], tf.float32)
 
-            gtboxes_and_label_h = get_horizen_minAreaRectangle(gtboxes_and_label_batch[i])
-            gtboxes_and_label_h = tf.reshape(gtboxes_and_label_h, [-1, 5])
+            if cfgs.PRECOMPUTED_GT:
+                gt_forms = gt_forms_batch[i][:num_objects]
+                gtboxes_and_label_r = tf.concat([gt_forms[:, :5], label], axis=1)
+                gtboxes_and_label_h = tf.concat([gt_forms[:, 5:], label], axis=1)
+            else:
+                gtboxes_and_label_r = tf.py_func(backward_convert,
+                                                 inp=[gtboxes_and_label],
+                                                 Tout=tf.float32)
+                gtboxes_and_label_r = tf.reshape(gtboxes_and_label_r, [-1, 6])
 
-            num_objects = num_objects_batch[i]
-            num_objects = tf.cast(tf.reshape(num_objects, [-1, ]), tf.float32)
+                gtboxes_and_label_h = get_horizen_minAreaRectangle(gtboxes_and_label)
+                gtboxes_and_label_h = tf.cast(tf.reshape(gtboxes_and_label_h, [-1, 5]), tf.float32)
 
             img_h = img_h_batch[i]
             img_w = img_w_batch[i]
@@ -194,13 +198,8 @@ def train():
                                                 biases_regularizer=biases_regularizer,
                                                 biases_initializer=tf.constant_initializer(0.0)):
 
-                                gtboxes_and_label_h, gtboxes_and_label_r = tf.py_func(get_gtboxes_and_label,
-                                                                                      inp=[inputs_list[i][1],
-                                                                                           inputs_list[i][2],
-                                                                                           inputs_list[i][3]],
-                                                                                      Tout=[tf.float32, tf.float32])
-                                gtboxes_and_label_h = tf.reshape(gtboxes_and_label_h, [-1, 5])
-                                gtboxes_and_label_r = tf.reshape(gtboxes_and_label_r, [-1, 6])
+                                gtboxes_and_label_h = inputs_list[i][1]
+                                gtboxes_and_label_r = inputs_list[i][2]
 
                                 img = inputs_list[i][0]
                                 img_shape = inputs_list[i][-2:]
@@ -6,10 +6,10 @@ from __future__ import division
 
 import os
 import sys
+import time
 import tensorflow as tf
 import cv2
 import numpy as np
-import math
 from tqdm import tqdm
 import argparse
 from multiprocessing import Queue, Process
@@ -18,33 +18,70 @@ sys.path.append("../")
 from data.io.image_preprocess import short_side_resize_for_inference_data
 from libs.networks import build_whole_network
 from help_utils import tools
+from help_utils import dota_tiling
+from help_utils import dota_writer
 from libs.label_name_dict.label_dict import *
 from libs.box_utils import draw_box_in_img
 from libs.box_utils.coordinate_convert import forward_convert, backward_convert
 from libs.box_utils import nms_rotate
-from libs.box_utils.rotate_polygon_nms import rotate_gpu_nms
 
 
-def worker(gpu_id, images, det_net, args, result_queue):
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
-    img_plac = tf.placeholder(dtype=tf.uint8, shape=[None, None, 3])  # is RGB. not BGR
-    img_batch = tf.cast(img_plac, tf.float32)
-
-    img_batch = short_side_resize_for_inference_data(img_tensor=img_batch,
-                                                     target_shortside_len=cfgs.IMG_SHORT_SIDE_LEN,
-                                                     length_limitation=cfgs.IMG_MAX_LENGTH)
-    if cfgs.NET_NAME in ['resnet152_v1d', 'resnet101_v1d', 'resnet50_v1d']:
-        img_batch = (img_batch / 255 - tf.constant(cfgs.PIXEL_MEAN_)) / tf.constant(cfgs.PIXEL_STD)
-    else:
-        img_batch = img_batch - tf.constant(cfgs.PIXEL_MEAN)
+def build_detection_towers(det_net, img_plac, batch_size, is_resize=True):
+    """
+    the detection network handles one image per call, so a batch is run by
+    batch_size towers sharing the same variables, fetched in one sess.run
+    """
+    tower_outputs = []
+    img_rgb = tf.reverse(img_plac, axis=[-1])  # BGR -> RGB
+    with tf.variable_scope(tf.get_variable_scope()):
+        for i in range(batch_size):
+            with tf.name_scope('tower_%d' % i):
+                img_batch = tf.cast(img_rgb[i], tf.float32)
+
+                img_batch = short_side_resize_for_inference_data(img_tensor=img_batch,
+                                                                 target_shortside_len=cfgs.IMG_SHORT_SIDE_LEN,
+                                                                 length_limitation=cfgs.IMG_MAX_LENGTH,
+                                                                 is_resize=is_resize)
+                if cfgs.NET_NAME in ['resnet152_v1d', 'resnet101_v1d', 'resnet50_v1d']:
+                    img_batch = (img_batch / 255 - tf.constant(cfgs.PIXEL_MEAN_)) / tf.constant(cfgs.PIXEL_STD)
+                else:
+                    img_batch = img_batch - tf.constant(cfgs.PIXEL_MEAN)
+
+                img_batch = tf.expand_dims(img_batch, axis=0)
+
+                detection_boxes, detection_scores, detection_category = det_net.build_whole_detection_network(
+                    input_img_batch=img_batch,
+                    gtboxes_batch=None,
+                    gtboxes_r_batch=None,
+                    gpu_id=0)
+                tower_outputs.append([tf.shape(img_batch), detection_boxes, detection_scores, detection_category])
+
+            tf.get_variable_scope().reuse_variables()
 
-    img_batch = tf.expand_dims(img_batch, axis=0)
+    return tower_outputs
 
-    detection_boxes, detection_scores, detection_category = det_net.build_whole_detection_network(
-        input_img_batch=img_batch,
-        gtboxes_batch=None,
-        gtboxes_r_batch=None,
-        gpu_id=0)
+
+def load_img(img_path, args):
+    """
+    decode an image and compute its crop grid, runs in the prefetch threads.
+    The batches are cut from the image by the consumer, so only the decoded image is held.
+    :return: uint8 BGR image, crop grid
+    """
+    img = cv2.imread(img_path)
+    assert img is not None, 'can not read {}'.format(img_path)
+
+    imgH = img.shape[0]
+    imgW = img.shape[1]
+
+    crop_grid = dota_tiling.get_crop_grid(imgH, imgW, args.h_len, args.w_len, args.h_overlap, args.w_overlap)
+    return img, crop_grid
+
+
+def worker(gpu_id, task_queue, det_net, args, result_queue):
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+    img_plac = tf.placeholder(dtype=tf.uint8, shape=[args.batch_size, None, None, 3])  # is BGR, as read by cv2
+
+    tower_outputs = build_detection_towers(det_net, img_plac, args.batch_size)
 
     init_op = tf.group(
         tf.global_variables_initializer(),
@@ -62,114 +99,75 @@ def worker(gpu_id, images, det_net, args, result_queue):
             restorer.restore(sess, restore_ckpt)
             print('restore model %d ...' % gpu_id)
 
-        for img_path in images:
-
-            img = cv2.imread(img_path)
+        timer = dota_tiling.StageTimer()
+        num_imgs, num_tiles, start_time = 0, 0, time.time()
+        images = dota_tiling.iter_task_queue(task_queue)
+        prefetcher = dota_tiling.ImagePrefetcher(images, lambda img_path: load_img(img_path, args),
+                                                 num_threads=args.prefetch_threads,
+                                                 prefetch=args.prefetch,
+                                                 timer=timer)
+        for img_path, (img, crop_grid) in prefetcher:
 
             box_res_rotate = []
             label_res_rotate = []
             score_res_rotate = []
 
-            imgH = img.shape[0]
-            imgW = img.shape[1]
-
-            if imgH < args.h_len:
-                temp = np.zeros([args.h_len, imgW, 3], np.float32)
-                temp[0:imgH, :, :] = img
-                img = temp
-                imgH = args.h_len
-
-            if imgW < args.w_len:
-                temp = np.zeros([imgH, args.w_len, 3], np.float32)
-                temp[:, 0:imgW, :] = img
-                img = temp
-                imgW = args.w_len
+            for crop_batch, batch_grid in dota_tiling.batch_tiles(img, crop_grid, args.h_len, args.w_len,
+                                                                  args.batch_size):
+                num_tiles += len(batch_grid)
+                with timer.time('run'):
+                    batch_outputs = sess.run(tower_outputs, feed_dict={img_plac: crop_batch})
 
-            for hh in range(0, imgH, args.h_len - args.h_overlap):
-                if imgH - hh - 1 < args.h_len:
-                    hh_ = imgH - args.h_len
-                else:
-                    hh_ = hh
-                for ww in range(0, imgW, args.w_len - args.w_overlap):
-                    if imgW - ww - 1 < args.w_len:
-                        ww_ = imgW - args.w_len
-                    else:
-                        ww_ = ww
-                    src_img = img[hh_:(hh_ + args.h_len), ww_:(ww_ + args.w_len), :]
-
-                    resized_img, det_boxes_r_, det_scores_r_, det_category_r_ = \
-                        sess.run(
-                            [img_batch, detection_boxes, detection_scores, detection_category],
-                            feed_dict={img_plac: src_img[:, :, ::-1]}
-                        )
-
-                    resized_h, resized_w = resized_img.shape[1], resized_img.shape[2]
-                    src_h, src_w = src_img.shape[0], src_img.shape[1]
+                # padded tiles at the end of the last batch have no entry in batch_grid
+                for (hh_, ww_), (resized_shape, det_boxes_r_, det_scores_r_, det_category_r_) in \
+                        zip(batch_grid, batch_outputs):
+                    resized_h, resized_w = resized_shape[1], resized_shape[2]
+                    src_h, src_w = args.h_len, args.w_len
 
                     if len(det_boxes_r_) > 0:
                         det_boxes_r_ = forward_convert(det_boxes_r_, False)
-                        det_boxes_r_[:, 0::2] *= (src_w / resized_w)
-                        det_boxes_r_[:, 1::2] *= (src_h / resized_h)
-                        # det_boxes_r_ = backward_convert(det_boxes_r_, False)
-
-                        for ii in range(len(det_boxes_r_)):
-                            box_rotate = det_boxes_r_[ii]
-                            box_rotate[0::2] = box_rotate[0::2] + ww_
-                            box_rotate[1::2] = box_rotate[1::2] + hh_
-                            box_res_rotate.append(box_rotate)
-                            label_res_rotate.append(det_category_r_[ii])
-                            score_res_rotate.append(det_scores_r_[ii])
-
-            box_res_rotate = np.array(box_res_rotate)
-            label_res_rotate = np.array(label_res_rotate)
-            score_res_rotate = np.array(score_res_rotate)
+                        det_boxes_r_[:, 0::2] = det_boxes_r_[:, 0::2] * (src_w / resized_w) + ww_
+                        det_boxes_r_[:, 1::2] = det_boxes_r_[:, 1::2] * (src_h / resized_h) + hh_
+
+                        box_res_rotate.extend(det_boxes_r_)
+                        label_res_rotate.extend(det_category_r_)
+                        score_res_rotate.extend(det_scores_r_)
+
+            box_res_rotate = np.array(box_res_rotate, np.float32).reshape([-1, 8])
+            label_res_rotate = np.array(label_res_rotate, np.int32)
+            score_res_rotate = np.array(score_res_rotate, np.float32)
 
             filter_indices = score_res_rotate >= 0.05
             score_res_rotate = score_res_rotate[filter_indices]
             box_res_rotate = box_res_rotate[filter_indices]
             label_res_rotate = label_res_rotate[filter_indices]
 
-            box_res_rotate_ = []
-            label_res_rotate_ = []
-            score_res_rotate_ = []
             threshold = {'roundabout': 0.1, 'tennis-court': 0.3, 'swimming-pool': 0.1, 'storage-tank': 0.2,
                          'soccer-ball-field': 0.3, 'small-vehicle': 0.2, 'ship': 0.2, 'plane': 0.3,
                          'large-vehicle': 0.1, 'helicopter': 0.2, 'harbor': 0.0001, 'ground-track-field': 0.3,
                          'bridge': 0.0001, 'basketball-court': 0.3, 'baseball-diamond': 0.3}
 
-            for sub_class in range(1, cfgs.CLASS_NUM + 1):
-                index = np.where(label_res_rotate == sub_class)[0]
-                if len(index) == 0:
-                    continue
-                tmp_boxes_r = box_res_rotate[index]
-                tmp_label_r = label_res_rotate[index]
-                tmp_score_r = score_res_rotate[index]
-
-                tmp_boxes_r_ = backward_convert(tmp_boxes_r, False)
-
-                try:
-                    inx = nms_rotate.nms_rotate_cpu(boxes=np.array(tmp_boxes_r_),
-                                                    scores=np.array(tmp_score_r),
-                                                    iou_threshold=threshold[LABEL_NAME_MAP[sub_class]],
+            with timer.time('nms'):
+                inx = nms_rotate.batched_nms_rotate(boxes=backward_convert(box_res_rotate, False),
+                                                    scores=score_res_rotate,
+                                                    labels=label_res_rotate,
+                                                    thresholds_per_class={NAME_LABEL_MAP[cls]: thres
+                                                                          for cls, thres in threshold.items()},
                                                     max_output_size=5000)
-                except:
-                    tmp_boxes_r_ = np.array(tmp_boxes_r_)
-                    tmp = np.zeros([tmp_boxes_r_.shape[0], tmp_boxes_r_.shape[1] + 1])
-                    tmp[:, 0:-1] = tmp_boxes_r_
-                    tmp[:, -1] = np.array(tmp_score_r)
-                    # Note: the IoU of two same rectangles is 0, which is calculated by rotate_gpu_nms
-                    jitter = np.zeros([tmp_boxes_r_.shape[0], tmp_boxes_r_.shape[1] + 1])
-                    jitter[:, 0] += np.random.rand(tmp_boxes_r_.shape[0], ) / 1000
-                    inx = rotate_gpu_nms(np.array(tmp, np.float32) + np.array(jitter, np.float32),
-                                         float(threshold[LABEL_NAME_MAP[sub_class]]), 0)
-
-                box_res_rotate_.extend(np.array(tmp_boxes_r)[inx])
-                score_res_rotate_.extend(np.array(tmp_score_r)[inx])
-                label_res_rotate_.extend(np.array(tmp_label_r)[inx])
+            box_res_rotate_ = box_res_rotate[inx]
+            score_res_rotate_ = score_res_rotate[inx]
+            label_res_rotate_ = label_res_rotate[inx]
 
             result_dict = {'boxes': np.array(box_res_rotate_), 'scores': np.array(score_res_rotate_),
-                           'labels': np.array(label_res_rotate_), 'image_id': img_path}
+                           'labels': np.array(label_res_rotate_), 'image_id': img_path,
+                           'rss': dota_tiling.current_rss_mb()}
             result_queue.put_nowait(result_dict)
+            num_imgs += 1
+
+        cost = max(time.time() - start_time, 1e-6)
+        print('worker %d: %d imgs, %d tiles in %.1fs (%.2f imgs/s, %.2f tiles/s), peak rss %dMB, %s'
+              % (gpu_id, num_imgs, num_tiles, cost, num_imgs / cost, num_tiles / cost, dota_tiling.peak_rss_mb(),
+                 timer.summary()))
 
 
 def test_dota(det_net, real_test_img_list, args, txt_name):
@@ -180,19 +178,21 @@ def test_dota(det_net, real_test_img_list, args, txt_name):
     pbar = tqdm(total=nr_records)
     gpu_num = len(args.gpus.strip().split(','))
 
-    nr_image = math.ceil(nr_records / gpu_num)
     result_queue = Queue(500)
+    task_queue = Queue()
+    dota_tiling.fill_task_queue(task_queue, real_test_img_list, gpu_num)
     procs = []
 
     for i, gpu_id in enumerate(args.gpus.strip().split(',')):
-        start = i * nr_image
-        end = min(start + nr_image, nr_records)
-        split_records = real_test_img_list[start:end]
-        proc = Process(target=worker, args=(int(gpu_id), split_records, det_net, args, result_queue))
-        print('process:%d, start:%d, end:%d' % (i, start, end))
+        proc = Process(target=worker, args=(int(gpu_id), task_queue, det_net, args, result_queue))
+        print('process:%d, gpu:%s' % (i, gpu_id))
         proc.start()
         procs.append(proc)
 
+    if not args.show_box:
+        result_writer = dota_writer.DotaResultWriter(os.path.join(save_path, 'dota_res'), LABEL_NAME_MAP,
+                                                     progress_file=txt_name)
+
     for i in range(nr_records):
         res = result_queue.get()
 
@@ -219,65 +219,40 @@ def test_dota(det_net, real_test_img_list, args, txt_name):
             cv2.imwrite(draw_path, final_detections)
 
         else:
-            CLASS_DOTA = NAME_LABEL_MAP.keys()
-            write_handle = {}
-
-            tools.mkdir(os.path.join(save_path, 'dota_res'))
-            for sub_class in CLASS_DOTA:
-                if sub_class == 'back_ground':
-                    continue
-                write_handle[sub_class] = open(os.path.join(save_path, 'dota_res', 'Task1_%s.txt' % sub_class), 'a+')
-
-            # rboxes = forward_convert(res['boxes'], with_label=False)
+            result_writer.write(res['image_id'].split('/')[-1], res['boxes'], res['scores'], res['labels'])
 
-            for i, rbox in enumerate(res['boxes']):
-                command = '%s %.3f %.1f %.1f %.1f %.1f %.1f %.1f %.1f %.1f\n' % (res['image_id'].split('/')[-1].split('.')[0],
-                                                                                 res['scores'][i],
-                                                                                 rbox[0], rbox[1], rbox[2], rbox[3],
-                                                                                 rbox[4], rbox[5], rbox[6], rbox[7],)
-                write_handle[LABEL_NAME_MAP[res['labels'][i]]].write(command)
-
-            for sub_class in CLASS_DOTA:
-                if sub_class == 'back_ground':
-                    continue
-                write_handle[sub_class].close()
-
-            fw = open(txt_name, 'a+')
-            fw.write('{}\n'.format(res['image_id'].split('/')[-1]))
-            fw.close()
-
-        pbar.set_description("Test image %s" % res['image_id'].split('/')[-1])
+        pbar.set_description("Test image %s, rss %dMB" % (res['image_id'].split('/')[-1], res['rss']))
 
         pbar.update(1)
 
+    if not args.show_box:
+        result_writer.close()
+
     for p in procs:
         p.join()
 
 
 def eval(num_imgs, args):
 
-    txt_name = '{}.txt'.format(cfgs.VERSION)
-    if not args.show_box:
-        if not os.path.exists(txt_name):
-            fw = open(txt_name, 'w')
-            fw.close()
+    txt_name = '{}_manifest.jsonl'.format(cfgs.VERSION)
+    test_imgname_list = [img_name for img_name in os.listdir(args.test_dir)
+                         if img_name.endswith(('.jpg', '.png', '.jpeg', '.tif', '.tiff'))]
 
-        fr = open(txt_name, 'r')
-        img_filter = fr.readlines()
+    assert len(test_imgname_list) != 0, 'test_dir has no imgs there.' \
+                                        ' Note that, we only support img format of (.jpg, .png, and .tiff) '
+
+    if not args.show_box:
+        manifest = dota_writer.RunManifest(txt_name)
         print('****************************'*3)
-        print('Already tested imgs:', img_filter)
+        print('Already tested imgs: %d, recorded in %s' % (len(manifest), txt_name))
         print('****************************'*3)
-        fr.close()
 
-        test_imgname_list = [os.path.join(args.test_dir, img_name) for img_name in os.listdir(args.test_dir)
-                             if img_name.endswith(('.jpg', '.png', '.jpeg', '.tif', '.tiff')) and
-                             (img_name + '\n' not in img_filter)]
-    else:
-        test_imgname_list = [os.path.join(args.test_dir, img_name) for img_name in os.listdir(args.test_dir)
-                             if img_name.endswith(('.jpg', '.png', '.jpeg', '.tif', '.tiff'))]
+        test_imgname_list = [img_name for img_name in test_imgname_list if img_name not in manifest]
+        if len(test_imgname_list) == 0:
+            print('all imgs are tested, remove %s to test again.' % txt_name)
+            return
 
-    assert len(test_imgname_list) != 0, 'test_dir has no imgs there.' \
-                                        ' Note that, we only support img format of (.jpg, .png, and .tiff) '
+    test_imgname_list = [os.path.join(args.test_dir, img_name) for img_name in test_imgname_list]
 
     if num_imgs == np.inf:
         real_test_img_list = test_imgname_list
@@ -289,9 +264,6 @@ def eval(num_imgs, args):
         is_training=False)
     test_dota(det_net=fpn, real_test_img_list=real_test_img_list, args=args, txt_name=txt_name)
 
-    if not args.show_box:
-        os.remove(txt_name)
-
 
 def parse_args():
 
@@ -320,6 +292,15 @@ def parse_args():
     parser.add_argument('--w_overlap', dest='w_overlap',
                         help='width overlap',
                         default=200, type=int)
+    parser.add_argument('--batch_size', dest='batch_size',
+                        help='crops per sess.run',
+                        default=1, type=int)
+    parser.add_argument('--prefetch', dest='prefetch',
+                        help='number of decoded images waiting for the model',
+                        default=4, type=int)
+    parser.add_argument('--prefetch_threads', dest='prefetch_threads',
+                        help='number of image decoding threads per worker',
+                        default=2, type=int)
     args = parser.parse_args()
     return args
 